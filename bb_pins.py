@@ -0,0 +1,31 @@
+#!/usr/bin/python
+
+# bb_pins.py
+# Kernel GPIO numbers of the BeagleBone header pins Pocket NC uses, for finding a pin under /sys/class/gpio.
+# Pins are named as config-pin names them, P8.8, though P8_8 and P8_08 are also accepted.
+
+GPIOS = {
+  "P8.7": 66, "P8.8": 67, "P8.9": 69, "P8.10": 68, "P8.11": 45, "P8.12": 44, "P8.13": 23,
+  "P8.14": 26, "P8.15": 47, "P8.16": 46, "P8.17": 27, "P8.18": 65, "P8.19": 22, "P8.26": 61,
+  "P9.11": 30, "P9.12": 60, "P9.13": 31, "P9.14": 50, "P9.15": 48, "P9.16": 51, "P9.17": 5,
+  "P9.18": 4, "P9.19": 13, "P9.20": 12, "P9.21": 3, "P9.22": 2, "P9.23": 49, "P9.24": 15,
+  "P9.25": 117, "P9.26": 14, "P9.27": 115, "P9.28": 113, "P9.29": 111, "P9.30": 112
+}
+
+# Returns a pin's name as config-pin names it, for example P8.8 for P8_08
+def normalizePin(pin):
+  (header, number) = pin.replace("_", ".").split(".")
+  return "%s.%s" % (header.upper(), int(number))
+
+# Returns the kernel GPIO number of pin, or None if it isn't known
+def gpioNumber(pin):
+  try:
+    return GPIOS.get(normalizePin(pin))
+  except ValueError:
+    return None
+
+def gpioPath(pin):
+  gpio = gpioNumber(pin)
+  if gpio is None:
+    return None
+  return "/sys/class/gpio/gpio%s" % gpio
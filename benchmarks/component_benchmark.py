@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# component_benchmark.py
+# Benchmarks the userspace components against simulated hardware (see simulation/simulate.py) on any
+# Linux box. Each component is run in its own process for --duration seconds, and its loop period, the
+# latency from each simulated change to the component acting on it and its CPU use are reported, along with
+# any other measures its scenario reports.
+#
+# Usage: benchmarks/component_benchmark.py [--duration S] [--latency S] [--fault-rate F] [--json FILE] [component ...]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SETTINGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIMULATE = os.path.join(SETTINGS_DIR, "simulation/simulate.py")
+
+COMPONENTS = [ "hss_sensors", "spindle_voltage", "detect_hss_mprls" ]
+
+def simulate(component, duration, latency, fault_rate):
+  (fd, report_file) = tempfile.mkstemp(prefix="component_benchmark", suffix=".json")
+  os.close(fd)
+  try:
+    with open(os.devnull, 'w') as devnull:
+      subprocess.check_call([ sys.executable, SIMULATE, component,
+                              "--duration", str(duration),
+                              "--latency", str(latency),
+                              "--fault-rate", str(fault_rate),
+                              "--report", report_file ], stdout=devnull)
+    with open(report_file, 'r') as f:
+      return json.load(f)
+  finally:
+    os.remove(report_file)
+
+def ms(summary, key):
+  if summary.get('count', 0) == 0:
+    return "-"
+  return "%.1f" % (summary[key] * 1000)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark userspace components against simulated hardware")
+  parser.add_argument("--duration", type=float, default=20, help="seconds to run each component for")
+  parser.add_argument("--latency", type=float, default=0, help="seconds added to every I2C transaction")
+  parser.add_argument("--fault-rate", type=float, default=0, help="fraction of I2C transactions that fail")
+  parser.add_argument("--json", help="also write the reports to this file")
+  parser.add_argument("components", nargs="*", default=COMPONENTS, help="components to benchmark, all of them by default")
+  args = parser.parse_args()
+
+  reports = []
+  print "%-18s %-16s %10s %10s %10s %10s %8s %6s" % ("component", "measure", "count", "p50 (ms)", "p99 (ms)", "max (ms)", "missed", "CPU %")
+  for component in args.components:
+    report = simulate(component, args.duration, args.latency, args.fault_rate)
+    reports.append(report)
+
+    rows = [ ("loop period", report['loop']) ] + sorted(report['latencies'].items())
+    for (measure, summary) in rows:
+      if measure == "loop period" and summary['count'] == 0:
+        continue
+      print "%-18s %-16s %10d %10s %10s %10s %8s %6.1f" % (component, measure, summary['count'],
+                                                          ms(summary, 'p50'), ms(summary, 'p99'), ms(summary, 'max'),
+                                                          summary.get('missed', "-"), report['cpu_percent'])
+    # other measures a scenario reports, like spindle_voltage's DAC writes per change
+    for (measure, value) in sorted(report.items()):
+      if isinstance(value, float) and measure != 'cpu_percent':
+        print "%-18s %-27s %10.2f" % (component, measure, value)
+    sys.stdout.flush()
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(reports, f, indent=2, sort_keys=True)
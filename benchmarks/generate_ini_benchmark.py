@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+# generate_ini_benchmark.py
+# Benchmarks generating PocketNC.ini with generateINI.py, so changes to generateINI.py or Rockhopper's ini.py
+# that make LinuxCNC startup slower can be caught before they're shipped. It runs on any Linux box: the
+# Settings directory is copied into a temporary POCKETNC_DIRECTORY, with every feature's detect and startup
+# replaced by stubs, and Rockhopper is symlinked in from --rockhopper.
+#
+# Every machine version in versions/ is benchmarked with these feature sets:
+#   none     no features detected
+#   all      every feature detected
+#   scaled   every feature detected plus a synthetic feature whose overlay and append have --scale parameters
+# and each of them is run two ways:
+#   full         generateINI.py --force --no-cache, the work done when something changed
+#   incremental  generateINI.py with PocketNC.ini already up to date, the work done on most boots
+#
+# Reports wall time percentiles and peak memory (max RSS) of generateINI.py for each combination.
+#
+# Usage: benchmarks/generate_ini_benchmark.py [--rockhopper DIR] [--runs N] [--scale N] [--json FILE]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SETTINGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FEATURE_SETS = [ "none", "all", "scaled" ]
+MODES = [ "full", "incremental" ]
+
+SCALED_FEATURE = "benchmark_scaled"
+SCALED_SECTIONS = 20
+
+def percentile(values, p):
+  values = sorted(values)
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+def writeFile(path, contents, executable=False):
+  with open(path, 'w') as f:
+    f.write(contents)
+  if executable:
+    os.chmod(path, 0755)
+
+# Copies the Settings python modules, versions and features into settings_dir. Feature detect.py, detect
+# and startup files are replaced with stubs so nothing touches the hardware. Feature overlays that are
+# generated by startup scripts are taken from their per version overlay.
+def buildSettingsTree(settings_dir, version):
+  os.makedirs(settings_dir)
+  for name in os.listdir(SETTINGS_DIR):
+    if name.endswith(".py"):
+      shutil.copy(os.path.join(SETTINGS_DIR, name), settings_dir)
+  shutil.copytree(os.path.join(SETTINGS_DIR, "versions"), os.path.join(settings_dir, "versions"))
+  writeFile(os.path.join(settings_dir, "version"), "%s\n" % version)
+
+  features_dir = os.path.join(settings_dir, "features")
+  os.makedirs(features_dir)
+  source_features_dir = os.path.join(SETTINGS_DIR, "features")
+  for feature in sorted(os.listdir(source_features_dir)):
+    source = os.path.join(source_features_dir, feature)
+    if not os.path.isdir(source):
+      continue
+
+    dest = os.path.join(features_dir, feature)
+    os.makedirs(dest)
+
+    overlay_path = os.path.join(source, "overlay.inc")
+    if not os.path.isfile(overlay_path):
+      overlay_path = os.path.join(source, "versions", version, "overlay.inc")
+    if os.path.isfile(overlay_path):
+      shutil.copy(overlay_path, os.path.join(dest, "overlay.inc"))
+
+    if os.path.isfile(os.path.join(source, "append.inc")):
+      shutil.copy(os.path.join(source, "append.inc"), dest)
+
+    if os.path.isfile(os.path.join(source, "startup")):
+      writeFile(os.path.join(dest, "startup"), "#!/bin/sh\n", executable=True)
+
+  return features_dir
+
+def addScaledFeature(features_dir, scale):
+  dest = os.path.join(features_dir, SCALED_FEATURE)
+  os.makedirs(dest)
+
+  overlay = []
+  append = []
+  for section in range(SCALED_SECTIONS):
+    overlay.append("[BENCHMARK_%s]" % section)
+    append.append("[BENCHMARK_%s]" % section)
+    for i in range(scale / SCALED_SECTIONS):
+      overlay.append("PARAMETER_%s=%s" % (i, i * 0.001))
+      append.append("REPEATED=%s" % i)
+    overlay.append("")
+    append.append("")
+
+  writeFile(os.path.join(dest, "overlay.inc"), "\n".join(overlay))
+  writeFile(os.path.join(dest, "append.inc"), "\n".join(append))
+
+# Stubs every feature's detection so it's detected or not depending on the feature set
+def stubDetection(features_dir, detected):
+  for feature in os.listdir(features_dir):
+    writeFile(os.path.join(features_dir, feature, "detect.py"), "def detect():\n  return %s\n" % (1 if detected else 0))
+    writeFile(os.path.join(features_dir, feature, "detect.inputs"), "")
+
+# Runs generateINI.py once, returning its wall time in seconds and max RSS in KB
+def runGenerateINI(pocketnc_dir, args):
+  settings_dir = os.path.join(pocketnc_dir, "Settings")
+  env = dict(os.environ, POCKETNC_DIRECTORY=pocketnc_dir)
+
+  with open(os.devnull, 'w') as devnull:
+    start = time.time()
+    p = subprocess.Popen([ sys.executable, os.path.join(settings_dir, "generateINI.py") ] + args, cwd=settings_dir, env=env, stdout=devnull)
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+
+  if status != 0:
+    raise RuntimeError("generateINI.py %s failed with status %s in %s" % (" ".join(args), status, settings_dir))
+
+  return (elapsed, rusage.ru_maxrss)
+
+def benchmark(rockhopper, version, feature_set, mode, runs, scale):
+  pocketnc_dir = tempfile.mkdtemp(prefix="generate_ini_benchmark")
+  try:
+    os.symlink(os.path.abspath(rockhopper), os.path.join(pocketnc_dir, "Rockhopper"))
+    features_dir = buildSettingsTree(os.path.join(pocketnc_dir, "Settings"), version)
+    if feature_set == "scaled":
+      addScaledFeature(features_dir, scale)
+    stubDetection(features_dir, feature_set != "none")
+
+    args = [ "--force", "--no-cache" ] if mode == "full" else []
+
+    # warm up, and for incremental runs, generate the INI that later runs find up to date
+    runGenerateINI(pocketnc_dir, [ "--force" ])
+
+    times = []
+    peak = 0
+    for i in range(runs):
+      (elapsed, maxrss) = runGenerateINI(pocketnc_dir, args)
+      times.append(elapsed)
+      peak = max(peak, maxrss)
+  finally:
+    shutil.rmtree(pocketnc_dir)
+
+  return {
+    'version': version,
+    'features': feature_set,
+    'mode': mode,
+    'runs': runs,
+    'p50': percentile(times, 50),
+    'p90': percentile(times, 90),
+    'p99': percentile(times, 99),
+    'max': max(times),
+    'max_rss_kb': peak
+  }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark PocketNC.ini generation")
+  parser.add_argument("--rockhopper", default=os.path.join(os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc"), "Rockhopper"), help="Rockhopper checkout providing ini.py")
+  parser.add_argument("--runs", type=int, default=20, help="number of timed runs of each combination")
+  parser.add_argument("--scale", type=int, default=5000, help="number of parameters in the synthetic overlay and append of the scaled feature set")
+  parser.add_argument("--json", help="also write the results to this file")
+  args = parser.parse_args()
+
+  if not os.path.isfile(os.path.join(args.rockhopper, "ini.py")):
+    sys.stderr.write("No ini.py in %s, use --rockhopper to point at a Rockhopper checkout\n" % args.rockhopper)
+    sys.exit(1)
+
+  results = []
+  print "%-8s %-8s %-12s %9s %9s %9s %9s %10s" % ("version", "features", "mode", "p50 (s)", "p90 (s)", "p99 (s)", "max (s)", "max RSS KB")
+  for version in sorted(os.listdir(os.path.join(SETTINGS_DIR, "versions"))):
+    for feature_set in FEATURE_SETS:
+      for mode in MODES:
+        r = benchmark(args.rockhopper, version, feature_set, mode, args.runs, args.scale)
+        results.append(r)
+        print "%-8s %-8s %-12s %9.4f %9.4f %9.4f %9.4f %10d" % (r['version'], r['features'], r['mode'], r['p50'], r['p90'], r['p99'], r['max'], r['max_rss_kb'])
+        sys.stdout.flush()
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
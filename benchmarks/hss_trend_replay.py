@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+# hss_trend_replay.py
+# Replays sensor traces through the checks hss_sensors.py can make and reports how long after the
+# trace crossed its cutoff each check tripped (negative if it tripped before), and whether it tripped on
+# a trace that never crossed. The checks are:
+#   raw         a single sample past the cutoff, how hss_sensors.py used to check
+#   filtered    the SensorTrend filtered value past the cutoff
+#   predictive  filtered, or a crossing predicted within --horizon seconds
+#
+# Recorded traces have a sample per line, a time in seconds and a value separated by tabs, commas or
+# spaces, like the spindle logs. Lines that don't parse are skipped. A recorded trace is taken to have
+# crossed its cutoff at the first sample after which it stays past the cutoff for --settle seconds.
+# Without any trace files, synthetic pressure traces are replayed, where the crossing time is known.
+#
+# Usage: benchmarks/hss_trend_replay.py [--cutoff C] [--rising] [--horizon S] [--settle S] [trace ...]
+
+import argparse
+import math
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "features/high_speed_spindle"))
+from sensor_trend import SensorTrend
+
+# Same as hss_sensors.py
+LOW_PRESSURE_CUTOFF = 0.110316
+PRESSURE_PERIOD = 0.05
+DEFAULT_PREDICTION_HORIZON = 2.0
+
+CHECKS = [ "raw", "filtered", "predictive" ]
+
+# Returns (name, samples, crossing), where crossing is the time the noiseless signal crosses the cutoff,
+# or None if it never does
+def syntheticTraces(seed=1):
+  rng = random.Random(seed)
+  duration = 20.0
+  times = [ i * PRESSURE_PERIOD for i in range(int(duration / PRESSURE_PERIOD)) ]
+
+  def trace(name, signal, noise, spikes=0):
+    samples = [ (t, signal(t) + rng.gauss(0, noise)) for t in times ]
+    for i in rng.sample(range(len(samples)), spikes):
+      samples[i] = (samples[i][0], samples[i][1] - 0.05)
+    crossings = [ t for t in times if signal(t) < LOW_PRESSURE_CUTOFF ]
+    return (name, samples, crossings[0] if crossings else None)
+
+  return [
+    # air slowly leaking away, 1 PSI every second and a half
+    trace("slow leak", lambda t: 0.14 - max(0, t - 2) * 0.0046, 0.0005),
+    # a fast leak
+    trace("fast leak", lambda t: 0.14 - max(0, t - 2) * 0.02, 0.0005),
+    # air disconnected
+    trace("step", lambda t: 0.14 if t < 10 else 0.08, 0.0005),
+    # steady pressure with single noisy samples far below the cutoff
+    trace("spikes", lambda t: 0.14, 0.0005, spikes=5),
+    # steady pressure close to the cutoff with a lot of noise
+    trace("noisy", lambda t: 0.118, 0.003),
+  ]
+
+def readTrace(path):
+  samples = []
+  with open(path, 'r') as f:
+    for line in f:
+      fields = re.split(r"[\t, ]+", line.strip())
+      try:
+        samples.append((float(fields[0]), float(fields[1])))
+      except (ValueError, IndexError):
+        pass
+  return samples
+
+def past(value, cutoff, falling):
+  return value < cutoff if falling else value > cutoff
+
+def recordedCrossing(samples, cutoff, falling, settle):
+  for (i, (t, value)) in enumerate(samples):
+    if past(value, cutoff, falling):
+      after = [ v for (s, v) in samples[i:] if s - t <= settle ]
+      if all([ past(v, cutoff, falling) for v in after ]) and samples[-1][0] - t >= settle:
+        return t
+  return None
+
+# Returns a dict mapping each check to the time it first tripped, or None, and the mean time taken
+# to add a sample and run the checks
+def replay(samples, cutoff, falling, horizon):
+  trend = SensorTrend()
+  tripped = dict([ (check, None) for check in CHECKS ])
+
+  start = time.time()
+  for (t, value) in samples:
+    trend.add(t, value)
+    filtered = trend.filtered()
+    seconds = trend.secondsToCutoff(cutoff, falling)
+    trips = { 'raw': past(value, cutoff, falling),
+              'filtered': past(filtered, cutoff, falling),
+              'predictive': past(filtered, cutoff, falling) or (seconds is not None and seconds <= horizon) }
+    for check in CHECKS:
+      if trips[check] and tripped[check] is None:
+        tripped[check] = t
+  elapsed = time.time() - start
+
+  return (tripped, elapsed / max(1, len(samples)))
+
+def formatResult(tripped, crossing):
+  if tripped is None:
+    return "missed" if crossing is not None else "-"
+  if crossing is None:
+    return "false %.2fs" % tripped
+  return "%+.2fs" % (tripped - crossing)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Replay sensor traces through the hss_sensors checks")
+  parser.add_argument("--cutoff", type=float, default=LOW_PRESSURE_CUTOFF, help="cutoff of recorded traces, the low pressure cutoff by default")
+  parser.add_argument("--rising", action="store_true", help="the cutoff of recorded traces is an upper limit")
+  parser.add_argument("--horizon", type=float, default=DEFAULT_PREDICTION_HORIZON, help="prediction horizon of the predictive check in seconds")
+  parser.add_argument("--settle", type=float, default=0.5, help="seconds a recorded trace must stay past the cutoff to count as crossed")
+  parser.add_argument("traces", nargs="*", help="recorded traces to replay instead of the synthetic ones")
+  args = parser.parse_args()
+
+  falling = not args.rising
+  if args.traces:
+    traces = []
+    for path in args.traces:
+      samples = readTrace(path)
+      traces.append((os.path.basename(path), samples, recordedCrossing(samples, args.cutoff, falling, args.settle)))
+  else:
+    traces = syntheticTraces()
+
+  print "%-16s %10s %12s %12s %12s %12s" % ("trace", "crossing", "raw", "filtered", "predictive", "us/sample")
+  for (name, samples, crossing) in traces:
+    (tripped, perSample) = replay(samples, args.cutoff, falling, args.horizon)
+    print "%-16s %10s %12s %12s %12s %12.1f" % (name, "%.2fs" % crossing if crossing is not None else "-",
+                                               formatResult(tripped['raw'], crossing),
+                                               formatResult(tripped['filtered'], crossing),
+                                               formatResult(tripped['predictive'], crossing),
+                                               perSample * 1e6)
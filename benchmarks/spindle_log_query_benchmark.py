@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# spindle_log_query_benchmark.py
+# Times spindle_log_query.py against synthetic spindle logs, as Commanded.csv/Measured.csv and as a
+# spindle log store, both holding the same --days of a busy machine. Each day has --sessions sessions and
+# --changes speed changes, each logged as spindle_logging.py does: the old and new commanded speed, then
+# a measured speed every second for 10 seconds, and a measured speed every minute in between.
+#
+# Reported for each kind of log:
+#   full scan     reading every line of the csv files in python, like grep does, for comparison
+#   first index   building the sparse index, only done once
+#   reindex       opening the logs again once they're indexed
+#   month query   every statistic for the last 30 days
+#   session       every statistic for a single session in the middle of the logs
+#
+# Usage: benchmarks/spindle_log_query_benchmark.py [--days N] [--sessions N] [--changes N] [--keep DIR]
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SETTINGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SETTINGS_DIR, "features/spindle_logging"))
+
+from spindle_log_store import LogStore, COMMANDED, MEASURED
+from spindle_log_query import SpindleLogs, speedError, settleTimes, hoursByBand
+
+START = 1600000000.0
+DAY = 24 * 60 * 60
+
+# Yields ("session", t, uid) and (stream, t, rpm) events, in time order
+def syntheticEvents(days, sessions_per_day, changes_per_day, rng):
+  t = START
+  session_length = DAY / sessions_per_day
+  for session in range(days * sessions_per_day):
+    session_start = START + session * session_length
+    t = session_start
+    yield ("session", t, "%08x-0000-4000-8000-%012x" % (session, rng.getrandbits(48)))
+    rpm = 0.0
+    measured = 0.0
+    while True:
+      t += rng.expovariate(changes_per_day / float(DAY))
+      if t > session_start + session_length - 60:
+        break
+      previous = rpm
+      rpm = rng.choice([ 0.0, 5000.0, 10000.0, 20000.0, 30000.0, 40000.0, 50000.0 ])
+      yield (COMMANDED, t, previous)
+      yield (COMMANDED, t, rpm)
+      for second in range(1, 11):
+        measured = rpm + (measured - rpm) * 0.5 + rng.gauss(0, 20)
+        yield (MEASURED, t + second, max(measured, 0.0))
+      t += 10
+
+def writeLogs(log_dir, events):
+  store = LogStore(os.path.join(log_dir, "store"), flush_interval=float("inf"), retention_bytes=float("inf"))
+  csv = { COMMANDED: open(os.path.join(log_dir, "csv", "Commanded.csv"), 'w'),
+          MEASURED: open(os.path.join(log_dir, "csv", "Measured.csv"), 'w') }
+  for (i, (kind, t, value)) in enumerate(events):
+    # the synthetic times are in the past, so the store never decides to flush on its own
+    if i % 10000 == 0:
+      store.flush()
+    if kind == "session":
+      store.startSession(value, t)
+      for f in csv.values():
+        f.write("%s\t0\tServer Started\t%s\n" % (t, value))
+    else:
+      store.append(kind, t, value)
+      csv[kind].write("%s\t%s\n" % (t, value))
+  store.close()
+  for f in csv.values():
+    f.close()
+  return store
+
+def fullScan(log_dir):
+  lines = 0
+  for name in [ "Commanded.csv", "Measured.csv" ]:
+    with open(os.path.join(log_dir, name), 'r') as f:
+      for line in f:
+        if "\tServer Started\t" not in line:
+          float(line.split("\t")[1])
+        lines += 1
+  return lines
+
+def query(logs, since, until):
+  commanded = logs.read(COMMANDED, since, until)
+  measured = logs.read(MEASURED, since, until)
+  speedError(commanded, measured)
+  settleTimes(commanded, measured, since=since)
+  hoursByBand(commanded, measured, [ session for session in logs.sessions() if since <= session[1] < until ], since=since)
+  return len(commanded[0]) + len(measured[0])
+
+def timed(f, *args):
+  start = time.time()
+  result = f(*args)
+  return (time.time() - start, result)
+
+def directorySize(path):
+  return sum([ os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) ])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time spindle log queries on synthetic logs")
+  parser.add_argument("--days", type=int, default=365, help="days of logs")
+  parser.add_argument("--sessions", type=int, default=2, help="sessions per day")
+  parser.add_argument("--changes", type=int, default=1500, help="speed changes per day")
+  parser.add_argument("--keep", help="write the logs to this directory and keep them, instead of a temporary one")
+  args = parser.parse_args()
+
+  log_dir = args.keep or tempfile.mkdtemp(prefix="spindle_log_query_benchmark")
+  try:
+    for name in [ "csv", "store" ]:
+      if not os.path.isdir(os.path.join(log_dir, name)):
+        os.makedirs(os.path.join(log_dir, name))
+    (seconds, store) = timed(writeLogs, log_dir, syntheticEvents(args.days, args.sessions, args.changes, random.Random(1)))
+    print "Wrote %d days of logs in %.1fs: csv %.1fMB, store %.1fMB" % (args.days, seconds,
+                                                                      directorySize(os.path.join(log_dir, "csv")) / 1e6,
+                                                                      directorySize(os.path.join(log_dir, "store")) / 1e6)
+    # let the store compress its segments, as it would have over the months
+    store.compress.set()
+    while any([ name.endswith(".seg") for name in os.listdir(os.path.join(log_dir, "store")) ]):
+      time.sleep(0.1)
+    print "Compressed store %.1fMB" % (directorySize(os.path.join(log_dir, "store")) / 1e6)
+    print
+
+    end = START + args.days * DAY
+    print "%-6s %-12s %10s %10s" % ("logs", "operation", "seconds", "samples")
+    (seconds, lines) = timed(fullScan, os.path.join(log_dir, "csv"))
+    print "%-6s %-12s %10.3f %10d" % ("csv", "full scan", seconds, lines)
+    for name in [ "csv", "store" ]:
+      path = os.path.join(log_dir, name)
+      (seconds, logs) = timed(SpindleLogs, path)
+      print "%-6s %-12s %10.3f %10s" % (name, "first index", seconds, "-")
+      (seconds, logs) = timed(SpindleLogs, path)
+      print "%-6s %-12s %10.3f %10s" % (name, "reindex", seconds, "-")
+      (seconds, samples) = timed(query, logs, end - 30 * DAY, end)
+      print "%-6s %-12s %10.3f %10d" % (name, "month query", seconds, samples)
+      (since, until) = logs.sessionRange(logs.sessions()[len(logs.sessions()) // 2][0])
+      (seconds, samples) = timed(query, logs, since, until)
+      print "%-6s %-12s %10.3f %10d" % (name, "session", seconds, samples)
+      sys.stdout.flush()
+  finally:
+    if not args.keep:
+      shutil.rmtree(log_dir)
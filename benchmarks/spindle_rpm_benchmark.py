@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# spindle_rpm_benchmark.py
+# Compares spindle_clock.py's edge timestamp measurement with the pulse counter spindle_voltage.py used
+# to have, which counted edges in a callback and published pulses per second once a second.
+#
+# Accuracy is measured offline, on synthetic clock edges with timing jitter, for a range of speeds and
+# pulses per revolution. Each row reports the mean and max error of the published RPM at a steady speed,
+# and how long after a step from that speed to 1.5 times it the published RPM is within 2% of it.
+#
+# CPU cost is measured in real time. The simulated SpindleClock generates edges at --cpu-rpm for
+# --cpu-seconds, while each method handles the edges and publishes the same way spindle_voltage.py does.
+# The baseline row does nothing with the edges, so it's the cost of generating them.
+#
+# Usage: benchmarks/spindle_rpm_benchmark.py [--jitter S] [--cpu-rpm RPM] [--cpu-seconds S]
+
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+SETTINGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SETTINGS_DIR)
+sys.path.insert(0, os.path.join(SETTINGS_DIR, "simulation"))
+
+from spindle_clock import EdgeRing, RpmEstimator
+import Adafruit_BBIO.GPIO as GPIO
+
+SPEEDS = [ 300, 1000, 5000, 24000 ]
+PULSES_PER_REVOLUTION = [ 1, 4 ]
+DURATION = 10.0
+STEP_TIME = 5.0
+WARMUP = 2.0
+
+# The removed pulse counter: spindle_voltage.py slept 0.1s per loop and published once more than a
+# second had passed since the last publish
+class LegacyCounter(object):
+  loop_period = 0.1
+
+  def __init__(self, pulses_per_revolution, start):
+    self.pulses_per_revolution = pulses_per_revolution
+    self.reset_time = start
+    self.pulses = 0
+    self.published = 0.0
+
+  def edge(self, t):
+    self.pulses += 1
+
+  def publish(self, now):
+    duration = now - self.reset_time
+    if duration > 1:
+      self.published = self.pulses / float(self.pulses_per_revolution) / duration * 60
+      self.reset_time = now
+      self.pulses = 0
+    return self.published
+
+class EdgeTimestamps(object):
+  loop_period = 0.05
+
+  def __init__(self, pulses_per_revolution, start):
+    self.ring = EdgeRing()
+    self.estimator = RpmEstimator(self.ring, pulses_per_revolution)
+
+  def edge(self, t):
+    self.ring.push(t)
+
+  def publish(self, now):
+    return self.estimator.measure(now)[0]
+
+METHODS = [ ("counter", LegacyCounter), ("edge times", EdgeTimestamps) ]
+
+# Returns the edge times of a spindle at rpm that steps to step_rpm at STEP_TIME, with gaussian jitter
+def syntheticEdges(rpm, step_rpm, pulses_per_revolution, jitter, rng):
+  edges = []
+  t = 0.0
+  while t < DURATION:
+    speed = rpm if t < STEP_TIME else step_rpm
+    t += 60.0 / (speed * pulses_per_revolution)
+    edges.append(t + rng.gauss(0, jitter))
+  return sorted(edges)
+
+# Replays edges through a method, publishing every loop_period, and returns the published (time, rpm)
+def replay(method, edges, pulses_per_revolution):
+  m = method(pulses_per_revolution, 0.0)
+  published = []
+  i = 0
+  now = m.loop_period
+  while now < DURATION:
+    while i < len(edges) and edges[i] <= now:
+      m.edge(edges[i])
+      i += 1
+    published.append((now, m.publish(now)))
+    now += m.loop_period
+  return published
+
+def accuracy(published, rpm, step_rpm):
+  errors = [ abs(value - rpm) / rpm for (t, value) in published if WARMUP <= t < STEP_TIME ]
+  # the step has settled once every published value after it is within 2%
+  unsettled = [ t for (t, value) in published if t >= STEP_TIME and abs(value - step_rpm) / step_rpm > 0.02 ]
+  settled = [ t for (t, value) in published if t >= STEP_TIME and (not unsettled or t > unsettled[-1]) ]
+  settle = settled[0] - STEP_TIME if settled else None
+  return (sum(errors) / len(errors), max(errors), settle)
+
+def cpuCost(method, rpm, pulses_per_revolution, seconds):
+  m = method(pulses_per_revolution, time.time()) if method else None
+  pin = "BENCHMARK"
+  GPIO.cleanup()
+  GPIO.add_event_detect(pin, GPIO.RISING, (lambda channel: m.edge(time.time())) if m else (lambda channel: None))
+  clock = GPIO.SpindleClock(pin, rpm, pulses_per_revolution)
+
+  before = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+  clock.start()
+  loop_period = m.loop_period if m else 0.1
+  while time.time() - start < seconds:
+    time.sleep(loop_period)
+    if m:
+      m.publish(time.time())
+  clock.stop()
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  elapsed = time.time() - start
+
+  cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+  return (100.0 * cpu / elapsed, clock.edges / elapsed)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare spindle RPM measurement methods")
+  parser.add_argument("--jitter", type=float, default=0.0001, help="standard deviation of the edge timing jitter in seconds")
+  parser.add_argument("--cpu-rpm", type=float, default=24000, help="spindle speed of the CPU cost runs")
+  parser.add_argument("--cpu-seconds", type=float, default=5, help="length of each CPU cost run")
+  args = parser.parse_args()
+
+  rng = random.Random(1)
+
+  print "%-10s %6s %4s %12s %12s %12s" % ("method", "rpm", "ppr", "mean err %", "max err %", "step (s)")
+  for pulses_per_revolution in PULSES_PER_REVOLUTION:
+    for rpm in SPEEDS:
+      edges = syntheticEdges(rpm, rpm * 1.5, pulses_per_revolution, args.jitter, rng)
+      for (name, method) in METHODS:
+        (mean, worst, settle) = accuracy(replay(method, edges, pulses_per_revolution), rpm, rpm * 1.5)
+        print "%-10s %6d %4d %12.3f %12.3f %12s" % (name, rpm, pulses_per_revolution, mean * 100, worst * 100,
+                                                   "%.2f" % settle if settle is not None else "never")
+  print
+
+  print "%-10s %6s %4s %12s %12s" % ("method", "rpm", "ppr", "edges/s", "CPU %")
+  for pulses_per_revolution in PULSES_PER_REVOLUTION:
+    for (name, method) in [ ("baseline", None) ] + METHODS:
+      (cpu, rate) = cpuCost(method, args.cpu_rpm, pulses_per_revolution, args.cpu_seconds)
+      print "%-10s %6d %4d %12.0f %12.1f" % (name, args.cpu_rpm, pulses_per_revolution, rate, cpu)
+      sys.stdout.flush()
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+# feature_detection.py
+# Runs the detect script of every feature in the features directory and reports which features were detected.
+# Detect scripts are run concurrently by a small pool of worker threads, so the time it takes to detect features
+# is bounded by the slowest detect script rather than the sum of all of them. Every detect script is given
+# a timeout. A detect script that doesn't finish in time (for example, a hung I2C probe) is killed and the
+# feature is treated as not detected, so it can never stall LinuxCNC startup.
+#
+# A feature can also provide a detect.py. detect.py must define a detect() function that returns 1 if the
+# feature is detected. It is imported and called in this process, which avoids starting a new bash or python
+# process for every feature, and is used if both exist. A detect() that hangs can't be killed, only abandoned
+# on its thread, and anything it does affects this whole process, so detect.py is only for checks that are
+# pure python and only look at files (like /etc/dogtag or /sys). Anything that touches hardware, like
+# high_speed_spindle's I2C probe, must stay a detect script. If detect.py can't be imported or raises, the
+# feature's detect script, if it has one, is run instead.
+#
+# Detection results are cached in a json file (normally next to PocketNC.ini) and keyed by a cheap fingerprint
+# of everything a detect script looks at. A feature's fingerprint always includes its detect script and the
+# Settings/version file. A feature can list additional inputs in a detect.inputs file, one per line:
+#   <path>           mtime and size of every file matching the glob
+#   exists <path>    only whether a file matching the glob exists
+#   contents <path>  the contents of the file, for small files whose mtime isn't meaningful (/proc, /etc/dogtag)
+# Relative paths are relative to the feature directory. Lines starting with # are ignored. A feature without
+# a detect.inputs file isn't cached, so its detect script runs every time.
+
+import glob
+import hashlib
+import imp
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import Queue
+
+DEFAULT_DETECT_TIMEOUT = 10 # seconds
+DEFAULT_DETECT_WORKERS = 4
+
+def killProcessGroup(p, timedOut):
+  timedOut.set()
+  try:
+    os.killpg(p.pid, signal.SIGKILL)
+  except OSError:
+    # process already exited
+    pass
+
+# Runs a single detect script and returns True if it printed 1.
+# The script is started in its own process group so any children it spawns
+# (detect_hss_mprls.py, cat, etc.) are killed along with it on a timeout.
+def runDetectScript(feature, detect_path, timeout):
+  p = subprocess.Popen([ detect_path ], stdout=subprocess.PIPE, preexec_fn=os.setsid)
+  timedOut = threading.Event()
+  watchdog = threading.Timer(timeout, killProcessGroup, [ p, timedOut ])
+  watchdog.start()
+  try:
+    output = p.communicate()[0]
+  finally:
+    watchdog.cancel()
+    watchdog.join()
+
+  if timedOut.is_set():
+    sys.stderr.write("Timed out after %ss detecting feature, %s\n" % (timeout, feature))
+    return None
+
+  if p.returncode != 0:
+    sys.stderr.write("Error (exit status %s) detecting feature, %s\n" % (p.returncode, feature))
+    return None
+
+  return output.strip() == "1"
+
+# Imports a feature's detect.py. The feature directory is added to sys.path while it's imported
+# so detect.py can import other modules in the feature directory.
+def loadDetectPlugin(feature, plugin_path):
+  feature_path = os.path.dirname(plugin_path)
+  sys.path.insert(0, feature_path)
+  try:
+    return imp.load_source("detect_%s" % feature, plugin_path)
+  finally:
+    sys.path.remove(feature_path)
+
+# Calls a detect.py plugin's detect() function and returns True if it returned 1. An exception raised
+# by detect() is raised again here. The plugin can't be killed like a detect script can, so it's called
+# on its own daemon thread and abandoned if it doesn't return in time.
+def runDetectPlugin(feature, plugin, timeout):
+  result = []
+  error = []
+
+  def run():
+    try:
+      result.append(plugin.detect())
+    except Exception as e:
+      error.append(e)
+
+  t = threading.Thread(target=run)
+  t.daemon = True
+  t.start()
+  t.join(timeout)
+
+  if t.is_alive():
+    sys.stderr.write("Timed out after %ss detecting feature, %s\n" % (timeout, feature))
+    return None
+
+  if error:
+    raise error[0]
+
+  return result[0] == 1 or result[0] == "1"
+
+# Detects a single feature with its detect.py plugin, if it has one that could be imported, falling
+# back to its detect script if the plugin raises or there isn't one.
+def detectFeature(features_dir, feature, plugin, timeout):
+  if plugin:
+    try:
+      return runDetectPlugin(feature, plugin, timeout)
+    except Exception as e:
+      sys.stderr.write("Error in detect.py for feature, %s: %s\n" % (feature, e))
+
+  detect_path = os.path.join(features_dir, feature, "detect")
+  if os.path.isfile(detect_path):
+    return runDetectScript(feature, detect_path, timeout)
+  return None
+
+def statFingerprint(path):
+  try:
+    st = os.stat(path)
+    return "%s:%s:%s" % (path, st.st_mtime, st.st_size)
+  except OSError:
+    return "%s:missing" % path
+
+def contentsFingerprint(path):
+  try:
+    with open(path, 'r') as f:
+      return "%s:%s" % (path, hashlib.sha1(f.read()).hexdigest())
+  except IOError:
+    return "%s:missing" % path
+
+def globFingerprint(pattern, fingerprint):
+  matches = sorted(glob.glob(pattern))
+  if not matches:
+    return [ "%s:missing" % pattern ]
+  return [ fingerprint(path) for path in matches ]
+
+# Returns the fingerprint of the inputs of a feature's detect script, or None if the feature
+# doesn't declare its inputs and so can't be cached.
+def featureFingerprint(features_dir, feature):
+  feature_path = os.path.join(features_dir, feature)
+  inputs_path = os.path.join(feature_path, "detect.inputs")
+
+  if not os.path.isfile(inputs_path):
+    return None
+
+  parts = [
+    statFingerprint(os.path.join(feature_path, "detect")),
+    statFingerprint(os.path.join(feature_path, "detect.py")),
+    statFingerprint(inputs_path),
+    statFingerprint(os.path.join(os.path.dirname(features_dir), "version"))
+  ]
+
+  with open(inputs_path, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if line == "" or line.startswith("#"):
+        continue
+
+      kind = "stat"
+      words = line.split(None, 1)
+      if len(words) == 2 and words[0] in ("exists", "contents"):
+        kind, line = words
+
+      pattern = os.path.join(feature_path, line)
+      if kind == "exists":
+        parts.append("%s:%s" % (pattern, len(glob.glob(pattern)) > 0))
+      elif kind == "contents":
+        parts.extend(globFingerprint(pattern, contentsFingerprint))
+      else:
+        parts.extend(globFingerprint(pattern, statFingerprint))
+
+  return hashlib.sha1("\n".join(parts)).hexdigest()
+
+def readDetectionCache(cache_file):
+  try:
+    with open(cache_file, 'r') as f:
+      cache = json.load(f)
+    if isinstance(cache, dict):
+      return cache
+  except (IOError, ValueError):
+    pass
+  return {}
+
+def writeDetectionCache(cache_file, cache):
+  tmp_file = "%s.tmp" % cache_file
+  try:
+    with open(tmp_file, 'w') as f:
+      json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, cache_file)
+  except (IOError, OSError) as e:
+    sys.stderr.write("Error writing feature detection cache, %s: %s\n" % (cache_file, e))
+
+def isDetectable(features_dir, feature):
+  return os.path.isfile(os.path.join(features_dir, feature, "detect.py")) or os.path.isfile(os.path.join(features_dir, feature, "detect"))
+
+# Returns the names of all features in features_dir that have a detect.py or detect script, sorted by name.
+def listDetectableFeatures(features_dir):
+  return sorted([ feature for feature in os.listdir(features_dir) if isDetectable(features_dir, feature) ])
+
+# Detects every feature in features_dir, running detect scripts on a pool of at most workers threads.
+# Returns a dict mapping feature name to True or False.
+#
+# If cache_file is provided, features whose fingerprint matches the cached one aren't detected again.
+# use_cache=False ignores the cached results and runs every detect script. verify=True also runs every
+# detect script and reports cached results that turned out to be wrong, which means a feature's
+# detect.inputs is missing something. In all cases, the cache is updated with the new results.
+#
+# If timer, a startup_timing.PhaseTimer, is provided, the time taken to detect each feature is recorded.
+def detectFeatures(features_dir, timeout=DEFAULT_DETECT_TIMEOUT, workers=DEFAULT_DETECT_WORKERS, cache_file=None, use_cache=True, verify=False, timer=None):
+  features = listDetectableFeatures(features_dir)
+  results = {}
+
+  cache = readDetectionCache(cache_file) if cache_file else {}
+  fingerprints = dict([ (feature, featureFingerprint(features_dir, feature)) for feature in features ]) if cache_file else {}
+
+  queue = Queue.Queue()
+  for feature in features:
+    cached = cache.get(feature)
+    fingerprint = fingerprints.get(feature)
+    if use_cache and not verify and fingerprint and cached and cached.get('fingerprint') == fingerprint:
+      results[feature] = cached['detected']
+    else:
+      queue.put(feature)
+
+  # Plugins are imported up front, one at a time, because importing modifies sys.path
+  plugins = {}
+  for feature in list(queue.queue):
+    plugin_path = os.path.join(features_dir, feature, "detect.py")
+    if os.path.isfile(plugin_path):
+      try:
+        plugins[feature] = loadDetectPlugin(feature, plugin_path)
+      except Exception as e:
+        sys.stderr.write("Error loading detect.py for feature, %s: %s\n" % (feature, e))
+        plugins[feature] = None
+
+  def worker():
+    while True:
+      try:
+        feature = queue.get_nowait()
+      except Queue.Empty:
+        return
+
+      start = time.time()
+      try:
+        results[feature] = detectFeature(features_dir, feature, plugins.get(feature), timeout)
+      except Exception as e:
+        sys.stderr.write("Error detecting feature, %s: %s\n" % (feature, e))
+        results[feature] = None
+
+      if timer:
+        timer.record("detect %s" % feature, start, time.time() - start)
+
+  threads = [ threading.Thread(target=worker) for i in range(max(1, min(workers, queue.qsize()))) ]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+
+  if cache_file:
+    newCache = {}
+    for feature in features:
+      cached = cache.get(feature)
+      fingerprint = fingerprints[feature]
+
+      if verify and fingerprint and cached and cached.get('fingerprint') == fingerprint and results[feature] is not None and cached['detected'] != results[feature]:
+        sys.stderr.write("Cached detection result for feature, %s, was %s but detect returned %s\n" % (feature, cached['detected'], results[feature]))
+
+      if fingerprint and results[feature] is not None:
+        # failed or timed out detects aren't cached so they're tried again next time
+        newCache[feature] = { 'fingerprint': fingerprint, 'detected': results[feature] }
+
+    if newCache != cache:
+      writeDetectionCache(cache_file, newCache)
+
+  return dict([ (feature, results[feature] is True) for feature in features ])
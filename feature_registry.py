@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+# feature_registry.py
+# Discovers the features in Settings/features, detects them and works out which are active, in one place
+# for generateINI.py, preUpdate and postUpdate. A feature is active if it is detected, unless the
+# calibration overlay overrides it in its POCKETNC_FEATURES section:
+#   [POCKETNC_FEATURES]
+#   INTERLOCK=1            enables the interlock feature even though it has no detect script
+#   HIGH_SPEED_SPINDLE=0   disables the high_speed_spindle feature even if it's detected
+#
+# Detection is done at most once per registry, and detection results are shared between processes
+# through the feature detection cache (see feature_detection.py), so the scripts run during
+# an update or a boot don't repeat each other's work.
+#
+# Run as a script to print the active features and their hooks.
+
+import os
+import sys
+from feature_detection import detectFeatures
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+FEATURES_DIR = os.path.join(POCKETNC_DIRECTORY, "Settings/features")
+CALIBRATION_OVERLAY_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/CalibrationOverlay.inc")
+DETECTION_CACHE_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/feature_detection_cache.json")
+
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
+
+# Files a feature can provide, in the order they're used
+HOOKS = [ "preUpdate", "postUpdate", "startup", "overlay.inc", "append.inc" ]
+
+class FeatureRegistry(object):
+  def __init__(self, features_dir=FEATURES_DIR, calibration_overlay_file=CALIBRATION_OVERLAY_FILE, cache_file=DETECTION_CACHE_FILE):
+    self.features_dir = features_dir
+    self.calibration_overlay_file = calibration_overlay_file
+    self.cache_file = cache_file
+    self._overlay = None
+    self._detected = None
+
+  # Returns the calibration overlay's INI data, or empty INI data if there isn't one
+  def overlay(self):
+    if self._overlay is None:
+      if os.path.isfile(self.calibration_overlay_file):
+        from ini import read_ini_data
+        self._overlay = read_ini_data(self.calibration_overlay_file)
+      else:
+        self._overlay = { 'parameters': [],
+                          'sections': {} }
+    return self._overlay
+
+  # Returns all feature names, sorted
+  def all(self):
+    return sorted([ feature for feature in os.listdir(self.features_dir) if os.path.isdir(os.path.join(self.features_dir, feature)) ])
+
+  # Returns a dict mapping each detectable feature to whether it was detected. Keyword arguments are
+  # passed to feature_detection.detectFeatures the first time this is called. After that, the
+  # result of that detection is returned.
+  def detected(self, **options):
+    if self._detected is None:
+      self._detected = detectFeatures(self.features_dir, cache_file=self.cache_file, **options)
+    return self._detected
+
+  # Returns a dict mapping feature name to True or False for every feature in the
+  # POCKETNC_FEATURES section of the calibration overlay
+  def overrides(self):
+    overrides = {}
+    for param in self.overlay()['parameters']:
+      if param['values']['section'] == "POCKETNC_FEATURES":
+        value = param['values']['value']
+        if value == "1":
+          overrides[param['values']['name'].lower()] = True
+        elif value == "0":
+          overrides[param['values']['name'].lower()] = False
+    return overrides
+
+  # Returns the sorted names of the detected features, with the calibration overlay's overrides applied
+  def active(self, **options):
+    features = set([ feature for (feature, detected) in self.detected(**options).items() if detected ])
+
+    for (feature, enabled) in self.overrides().items():
+      if enabled:
+        features.add(feature)
+      else:
+        features.discard(feature)
+
+    return sorted(features)
+
+  # Returns the path to one of a feature's HOOKS, or None if the feature doesn't have it
+  def hook(self, feature, hook):
+    path = os.path.join(self.features_dir, feature, hook)
+    if os.path.isfile(path):
+      return path
+    return None
+
+  # Returns a dict mapping each of the HOOKS a feature has to its path
+  def hooks(self, feature):
+    return dict([ (hook, self.hook(feature, hook)) for hook in HOOKS if self.hook(feature, hook) ])
+
+_registry = None
+
+# Returns the registry shared by everything in this process
+def getRegistry():
+  global _registry
+  if _registry is None:
+    _registry = FeatureRegistry()
+  return _registry
+
+if __name__ == "__main__":
+  registry = getRegistry()
+  for feature in registry.active():
+    hooks = registry.hooks(feature)
+    print "%s: %s" % (feature, ", ".join([ hook for hook in HOOKS if hook in hooks ]))
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+# configure_pins.py
+# Configures the BeagleBone pins with cape-universal and generates the configure_cape_universal overlay.inc.
+#
+# The pin table (pins, or versions/<version>/pins if it exists) is read once and compared against the current
+# pinmux state and GPIO direction in sysfs. Only the pins that differ are passed to a single config-pin -f
+# call, rather than starting config-pin once for every pin. In the same pass, the BB_GPIO_CONFIG parameter is
+# added to the per version overlay to make overlay.inc. overlay.inc is only regenerated when the pin table
+# or per version overlay changed, which is tracked by a hash of both in .pins_cache. If config-pin fails, its
+# error is written to stderr and .pins_cache isn't written, so nothing is skipped on the next boot. overlay.inc
+# is still generated so PocketNC.ini can be, as it was when each pin was configured separately.
+#
+# Usage: configure_pins.py [--dry-run] [--sysfs-root DIR] [--version VERSION]
+#   --dry-run prints the pins that would be configured instead of running config-pin
+#   --sysfs-root reads the pinmux state from a fake sysfs tree, so this can be tested off the machine
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+
+POCKETNC_DIRECTORY = "/home/pocketnc/pocketnc"
+FEATURE_DIR = os.path.dirname(os.path.abspath(__file__))
+OVERLAY_FILE = os.path.join(FEATURE_DIR, "overlay.inc")
+CACHE_FILE = os.path.join(FEATURE_DIR, ".pins_cache")
+
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
+sys.path.insert(0, os.path.dirname(os.path.dirname(FEATURE_DIR)));
+
+from bb_pins import GPIOS
+
+# Pinmux state and GPIO direction that config-pin sets for each mode. Output directions are
+# only compared as "out", since the value of an output pin may have changed since it was configured.
+MODES = {
+  "in":   ("gpio", "in"),
+  "in-":  ("gpio_pd", "in"),
+  "in+":  ("gpio_pu", "in"),
+  "out":  ("gpio", "out"),
+  "out-": ("gpio", "out"),
+  "out+": ("gpio", "out"),
+  "i2c":  ("i2c", None),
+  "pwm":  ("pwm", None)
+}
+
+def pinTablePath(feature_dir, version):
+  path = os.path.join(feature_dir, "versions", version, "pins")
+  if os.path.isfile(path):
+    return path
+  return os.path.join(feature_dir, "pins")
+
+# Returns a list of (pin, mode) tuples, in the order they appear in the pin table
+def readPinTable(contents):
+  pins = []
+  for line in contents.splitlines():
+    line = line.split("#", 1)[0].strip()
+    if not line:
+      continue
+    (pin, mode) = line.split()[:2]
+    if mode not in MODES:
+      raise ValueError("Unknown mode, %s, for pin, %s" % (mode, pin))
+    pins.append((pin, mode))
+  return pins
+
+def readSysfs(path):
+  try:
+    with open(path, 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+# config-pin names pins P8.8, cape-universal names them P8_08
+def pinmuxStatePath(sysfs_root, pin):
+  (header, number) = pin.split(".")
+  return os.path.join(sysfs_root, "sys/devices/platform/ocp/ocp:%s_%02d_pinmux/state" % (header, int(number)))
+
+def gpioDirectionPath(sysfs_root, pin):
+  return os.path.join(sysfs_root, "sys/class/gpio/gpio%s/direction" % GPIOS[pin])
+
+# Returns the pins whose current pinmux state or GPIO direction don't match their mode
+def differingPins(pins, sysfs_root):
+  differing = []
+  for (pin, mode) in pins:
+    (state, direction) = MODES[mode]
+    if readSysfs(pinmuxStatePath(sysfs_root, pin)) != state:
+      differing.append((pin, mode))
+    elif direction is not None and (pin not in GPIOS or readSysfs(gpioDirectionPath(sysfs_root, pin)) != direction):
+      differing.append((pin, mode))
+  return differing
+
+# Configures all of pins with a single config-pin call. Returns True if it succeeded, otherwise writes
+# config-pin's exit status and error output to stderr and returns False.
+def applyPins(pins):
+  (fd, path) = tempfile.mkstemp(prefix="pins")
+  try:
+    with os.fdopen(fd, 'w') as f:
+      for (pin, mode) in pins:
+        f.write("%s %s\n" % (pin, mode))
+    try:
+      p = subprocess.Popen([ "config-pin", "-f", path ], stderr=subprocess.PIPE)
+    except OSError as e:
+      sys.stderr.write("Error configuring pins, could not run config-pin: %s\n" % e)
+      return False
+    error = p.communicate()[1]
+  finally:
+    os.remove(path)
+
+  if p.returncode != 0:
+    sys.stderr.write("Error configuring pins, config-pin exited with status %s: %s\n" % (p.returncode, error.strip()))
+    return False
+  return True
+
+def readCache(cache_file):
+  try:
+    with open(cache_file, 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Configure BeagleBone pins with cape-universal and generate overlay.inc")
+  parser.add_argument("--dry-run", action="store_true", help="print the pins that would be configured instead of configuring them")
+  parser.add_argument("--sysfs-root", default="/", help="root of the sysfs tree to read the current pin state from")
+  parser.add_argument("--version", help="machine version, detected if not given")
+  args = parser.parse_args()
+
+  if args.version:
+    version = args.version
+  else:
+    from version import getVersion
+    version = getVersion()
+
+  with open(pinTablePath(FEATURE_DIR, version), 'r') as f:
+    pin_table = f.read()
+  version_overlay_path = os.path.join(FEATURE_DIR, "versions", version, "overlay.inc")
+  with open(version_overlay_path, 'r') as f:
+    version_overlay = f.read()
+
+  pins = readPinTable(pin_table)
+  differing = differingPins(pins, args.sysfs_root)
+  configured = True
+
+  if args.dry_run:
+    for (pin, mode) in differing:
+      print "config-pin %s %s" % (pin, mode)
+  elif differing:
+    print "Configuring %s of %s pins" % (len(differing), len(pins))
+    configured = applyPins(differing)
+  else:
+    print "All %s pins already configured" % len(pins)
+
+  pins_hash = hashlib.sha1("%s\n%s\n%s" % (version, pin_table, version_overlay)).hexdigest()
+  if args.dry_run or (configured and readCache(CACHE_FILE) == pins_hash and os.path.isfile(OVERLAY_FILE)):
+    sys.exit(0)
+
+  from ini import read_ini_data, write_ini_data
+  from generate_bb_gpio_config import addBBGpioConfig
+
+  overlay = read_ini_data(version_overlay_path)
+  addBBGpioConfig(overlay)
+  write_ini_data(overlay, OVERLAY_FILE)
+
+  # A failed configuration isn't cached, so everything is done again on the next boot
+  if configured:
+    with open(CACHE_FILE, 'w') as f:
+      f.write("%s\n" % pins_hash)
+  elif os.path.isfile(CACHE_FILE):
+    os.remove(CACHE_FILE)
@@ -0,0 +1,7 @@
+import glob
+
+# Newer kernels configure pins with cape-universal and don't have a capemgr slots file
+def detect():
+  if glob.glob("/sys/devices/bone_capemgr.*/slots"):
+    return 0
+  return 1
@@ -0,0 +1,8 @@
+def detect():
+  try:
+    with open("/etc/dogtag", 'r') as dogtag:
+      if dogtag.read().find("Five Axis Kinematics") > -1:
+        return 1
+  except IOError:
+    pass
+  return 0
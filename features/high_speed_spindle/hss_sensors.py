@@ -1,15 +1,51 @@
 #!/usr/bin/python
 
+# hss_sensors.py
+# Monitors the air pressure and temperature of the high speed spindle and sets abort when either is out
+# of bounds, or its sensor can't be read, while the spindle is on.
+#
+# Each sensor is sampled on its own thread through an i2c_bus device handle that's opened once and reused, so
+# a slow temperature conversion never delays a pressure reading. The MPRLS is polled for the end of its
+# conversion rather than waited on for a fixed time, and the MCP9808 is left converting continuously, so
+# a read just fetches its latest result. The main loop publishes the latest samples to the HAL pins and
+# checks them every LOOP_PERIOD seconds.
+#
+# Sampling starts after h.ready(), so loadusr -W doesn't wait on the sensors. A sensor that hasn't been
+# sampled yet isn't checked, but only for its sampler's stale_after seconds after it starts. After that,
+# and whenever its latest sample is older than stale_after, STALE_PERIODS sample periods plus
+# MPRLS_CONVERSION_TIMEOUT, the sensor is treated as not detected, so a sampler stuck in a read aborts
+# a running spindle instead of leaving its last good value in place.
+#
+# The cutoffs are checked against each sensor's filtered value (see sensor_trend.py), so a single noisy
+# sample doesn't trip an abort. The filtered value, its slope and the predicted number of seconds until it
+# crosses a cutoff (-1 if it isn't heading towards one) are published on the <sensor>_filtered,
+# <sensor>_slope and <sensor>_cutoff_seconds pins. When the predictive_abort parameter is set, an abort
+# also happens when a cutoff is predicted to be crossed within prediction_horizon seconds:
+#   setp hss_sensors.predictive_abort 1
+#   setp hss_sensors.prediction_horizon 2.0
+
 import hal
 import os
+import sys
 import datetime
+import threading
 import time
 
 POCKETNC_DIRECTORY = "/home/pocketnc/pocketnc"
 DETECT_SCRIPT = os.path.join(POCKETNC_DIRECTORY, "Settings/features/high_speed_spindle/detect_hss_mprls.py")
 
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Settings"))
+from i2c_bus import Device
+from sensor_trend import SensorTrend
+
 # MPRLS is pressure sensor
 MPRLS_I2CADDR = 0x18
+MPRLS_STATUS_BUSY = 0x20
+MPRLS_STATUS_INTEGRITY_FAIL = 0x04
+MPRLS_STATUS_MATH_SATURATION = 0x01
+# A conversion takes about 5ms, give up on one after MPRLS_CONVERSION_TIMEOUT seconds
+MPRLS_POLL_INTERVAL = 0.002
+MPRLS_CONVERSION_TIMEOUT = 0.05
 # Upper end of the sensors scale in MPA (25 PSI)
 MPRLS_SCALE_MAX = 0.172369
 # Minimum pressure in MPA below which machine will E-Stop (equals 16 PSI)
@@ -21,6 +57,8 @@ MCP9808_REG_CONFIG = 0x01
 MCP9808_REG_CONFIG_SHUTDOWN = 0x0100
 MCP9808_REG_AMBIENT_TEMP = 0x05
 MCP9808_REG_RESOLUTION = 0x08
+# Resolution of 0.0625C, which takes up to 250ms per conversion
+MCP9808_RESOLUTION = 0x03
 # Spindle min operating temp is 0C, lets put out cutoff at 1 to err on safe side
 LOW_TEMP_CUTOFF = 1
 # Spindle max operating temp is 40C, put cutoff at 39
@@ -30,83 +68,130 @@ HIGH_TEMP_CUTOFF = 48
 #Value returned by sensor read methods if the read fails
 SENSOR_READ_FAIL_VALUE = -999
 
+# Seconds between samples of each sensor, and between checks of the samples in the main loop
+PRESSURE_PERIOD = 0.05
+TEMPERATURE_PERIOD = 0.25
+LOOP_PERIOD = 0.05
+# A sensor whose latest sample is older than this many of its periods, plus MPRLS_CONVERSION_TIMEOUT, is stale
+STALE_PERIODS = 4
+
+# Default number of seconds ahead a crossed cutoff is predicted when predictive_abort is set
+DEFAULT_PREDICTION_HORIZON = 2.0
+
+def openPressureSensor():
+  return Device(MPRLS_I2CADDR)
+
 # Returns pressure reading in MPa
-def readPressure():
-  try:
-    i2c = None
-    try:
-      from Adafruit_GPIO.I2C import Device
-      i2c = Device(MPRLS_I2CADDR, 2)
-    except:
-      from Adafruit_I2C import Adafruit_I2C
-      i2c = Adafruit_I2C(MPRLS_I2CADDR, 1)
-    
-    time.sleep(0.1)
-    
-    # Command to take pressure reading
-    result = i2c.writeList(0xAA, [0x0, 0x0]) 
-    if result is not None:
-      return SENSOR_READ_FAIL_VALUE 
-    
-    time.sleep(0.1)
-    
-    data = i2c.readList(0, 4)
-    raw = data[1] << 16 | data[2] << 8 | data[3] 
-    psi = (raw - 0x19999A) * 25
-    psi /= float(0xE66666 - 0x19999A)
-    mpa = psi * 0.0068947572932
-    return mpa
-  except:
+def readPressure(i2c):
+  # Command to take pressure reading
+  i2c.writeList(0xAA, [0x0, 0x0])
+
+  # The MPRLS sends its status byte first in every read, poll it until the conversion is done
+  deadline = time.time() + MPRLS_CONVERSION_TIMEOUT
+  while True:
+    time.sleep(MPRLS_POLL_INTERVAL)
+    if not i2c.readRaw8() & MPRLS_STATUS_BUSY:
+      break
+    if time.time() > deadline:
+      return SENSOR_READ_FAIL_VALUE
+
+  data = i2c.readList(0, 4)
+  if data[0] & (MPRLS_STATUS_BUSY | MPRLS_STATUS_INTEGRITY_FAIL | MPRLS_STATUS_MATH_SATURATION):
     return SENSOR_READ_FAIL_VALUE
 
+  raw = data[1] << 16 | data[2] << 8 | data[3]
+  psi = (raw - 0x19999A) * 25
+  psi /= float(0xE66666 - 0x19999A)
+  mpa = psi * 0.0068947572932
+  return mpa
+
+# Opens the MCP9808 and puts it in continuous conversion mode
+def openTemperatureSensor():
+  i2c = Device(MCP9808_I2CADDR)
+
+  # Begin, clearing the shutdown bit so it converts continuously, and set the resolution
+  for result in i2c.bus.batch([ (MCP9808_I2CADDR, [ MCP9808_REG_CONFIG, 0x0, 0x0 ], 0),
+                                (MCP9808_I2CADDR, [ MCP9808_REG_RESOLUTION, MCP9808_RESOLUTION ], 0) ]):
+    if isinstance(result, IOError):
+      raise result
+  return i2c
+
 # Returns temperature reading in degrees Celsius
-def readTemperature():
-  try:
-    i2c = None
-    try:
-      from Adafruit_GPIO.I2C import Device
-      i2c = Device(MCP9808_I2CADDR, 2)
-    except:
-      from Adafruit_I2C import Adafruit_I2C
-      i2c = Adafruit_I2C(MCP9808_I2CADDR, 1)
-    
-    # Begin
-    result = i2c.write16(MCP9808_REG_CONFIG, 0x0)
-    if result is not None:
-      return SENSOR_READ_FAIL_VALUE
+def readTemperature(i2c):
+  raw = i2c.readU16BE(MCP9808_REG_AMBIENT_TEMP)
+  temp = raw & 0x0FFF
+  temp /= 16.0
+  if (raw & 0x1000):
+      temp -= 256
+  return temp
 
-    # Set resolution
-    i2c.write8(MCP9808_REG_RESOLUTION, 0x03)
+# Samples a sensor every period seconds on its own thread. open returns a device handle and read takes
+# the handle and returns a reading. The handle is kept until a read fails, then reopened for the next sample.
+# Successful readings are added to a SensorTrend. cutoffs is a list of (cutoff, falling) tuples,
+# see SensorTrend.secondsToCutoff.
+class SensorSampler(threading.Thread):
+  def __init__(self, name, open, read, period, cutoffs):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self.open = open
+    self.read = read
+    self.period = period
+    self.cutoffs = cutoffs
+    self.stale_after = STALE_PERIODS * period + MPRLS_CONVERSION_TIMEOUT
+    self.lock = threading.Lock()
+    self.value = SENSOR_READ_FAIL_VALUE
+    self.sampleTime = None
+    self.startTime = time.time()
+    self.trend = SensorTrend()
 
-    # Wake up
-    conf_reg = None
+  def sample(self, i2c):
     try:
-      conf_reg = (i2c.readU16BE(MCP9808_REG_CONFIG))
+      if i2c is None:
+        i2c = self.open()
+      value = self.read(i2c)
     except:
-      conf_reg = i2c.reverseByteOrder(i2c.readU16(MCP9808_REG_CONFIG))
+      i2c = None
+      value = SENSOR_READ_FAIL_VALUE
 
-    conf_wake = conf_reg & ~MCP9808_REG_CONFIG_SHUTDOWN
-    i2c.write16(MCP9808_REG_CONFIG, conf_wake)
-    time.sleep(0.250)
-    
-    # Read
-    raw = None
-    try:
-      raw = (i2c.readU16BE(MCP9808_REG_AMBIENT_TEMP))
-    except:
-      raw = i2c.reverseByteOrder(i2c.readU16(MCP9808_REG_AMBIENT_TEMP))
-    temp = raw & 0x0FFF
-    temp /= 16.0
-    if (raw & 0x1000):
-        temp -= 256
-    
-    time.sleep(0.250)
-    # Shutdown
-    conf_shutdown = i2c.readU16(MCP9808_REG_CONFIG) | MCP9808_REG_CONFIG_SHUTDOWN
-    i2c.write16(MCP9808_REG_CONFIG, conf_shutdown)
-    return temp
-  except:
-    return SENSOR_READ_FAIL_VALUE
+    now = time.time()
+    with self.lock:
+      self.value = value
+      self.sampleTime = now
+      if value != SENSOR_READ_FAIL_VALUE:
+        self.trend.add(now, value)
+    return i2c
+
+  def run(self):
+    i2c = None
+    while True:
+      start = time.time()
+      i2c = self.sample(i2c)
+      time.sleep(max(0, self.period - (time.time() - start)))
+
+  # Returns (sampleTime, value, filtered, slope, cutoffSeconds), where sampleTime is the time of the latest
+  # sample, or None until the first sample has been taken, filtered is None until the first successful
+  # sample and cutoffSeconds is the predicted time until the nearest cutoff is crossed, or None if the
+  # trend isn't heading towards one
+  def latest(self):
+    with self.lock:
+      predictions = [ self.trend.secondsToCutoff(cutoff, falling) for (cutoff, falling) in self.cutoffs ]
+      predictions = [ seconds for seconds in predictions if seconds is not None ]
+      cutoffSeconds = min(predictions) if predictions else None
+      return (self.sampleTime, self.value, self.trend.filtered(), self.trend.slope(), cutoffSeconds)
+
+  # Whether a sample taken at sampleTime, as returned by latest, is too old to be trusted. Before the
+  # first sample, whether the sampler has been running for longer than a sample should take.
+  def stale(self, sampleTime, now):
+    return now - (sampleTime if sampleTime is not None else self.startTime) > self.stale_after
+
+# Publishes a sampler's trend on the <name>_filtered, <name>_slope and <name>_cutoff_seconds pins
+def publishTrend(name, filtered, slope, cutoffSeconds):
+  h['%s_filtered' % name] = filtered if filtered is not None else SENSOR_READ_FAIL_VALUE
+  h['%s_slope' % name] = slope
+  h['%s_cutoff_seconds' % name] = cutoffSeconds if cutoffSeconds is not None else -1
+
+def predictedCrossing(cutoffSeconds):
+  return h['predictive_abort'] and cutoffSeconds is not None and cutoffSeconds <= h['prediction_horizon']
 
 print "Initializing hss_sensors!"
 h = hal.component("hss_sensors")
@@ -118,13 +203,25 @@ h.newpin("abort", hal.HAL_BIT, hal.HAL_OUT)
 h['abort'] = False
 
 h.newpin('pressure', hal.HAL_FLOAT, hal.HAL_OUT)
-h['pressure'] = readPressure()
+h['pressure'] = SENSOR_READ_FAIL_VALUE
 h.newpin('p_detected', hal.HAL_BIT, hal.HAL_OUT)
-h['p_detected'] = (h['pressure'] != SENSOR_READ_FAIL_VALUE)
+h['p_detected'] = False
 h.newpin('temperature', hal.HAL_FLOAT, hal.HAL_OUT)
-h['temperature'] = readTemperature()
+h['temperature'] = SENSOR_READ_FAIL_VALUE
 h.newpin('t_detected', hal.HAL_BIT, hal.HAL_OUT)
-h['t_detected'] = (h['temperature'] != SENSOR_READ_FAIL_VALUE)
+h['t_detected'] = False
+
+for name in [ 'pressure', 'temperature' ]:
+  h.newpin('%s_filtered' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+  h.newpin('%s_slope' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+  h.newpin('%s_cutoff_seconds' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+  publishTrend(name, None, 0, None)
+
+# abort when a cutoff is predicted to be crossed within prediction_horizon seconds
+h.newparam('predictive_abort', hal.HAL_BIT, hal.HAL_RW)
+h['predictive_abort'] = False
+h.newparam('prediction_horizon', hal.HAL_FLOAT, hal.HAL_RW)
+h['prediction_horizon'] = DEFAULT_PREDICTION_HORIZON
 
 # set to true if aborting due to low pressure
 h.newpin('p_abort', hal.HAL_BIT, hal.HAL_OUT)
@@ -138,37 +235,68 @@ h['t_abort'] = False
 # set to true if aborting because the temperature sensor is not detected
 h.newpin('t_detect_abort', hal.HAL_BIT, hal.HAL_OUT)
 h['t_detect_abort'] = False
+# set to true if aborting because the pressure or temperature is predicted to cross a cutoff
+h.newpin('p_predicted_abort', hal.HAL_BIT, hal.HAL_OUT)
+h['p_predicted_abort'] = False
+h.newpin('t_predicted_abort', hal.HAL_BIT, hal.HAL_OUT)
+h['t_predicted_abort'] = False
 
 h.ready()
 
-abort = False
+pressureSampler = SensorSampler("pressure", openPressureSensor, readPressure, PRESSURE_PERIOD,
+                                [ (LOW_PRESSURE_CUTOFF, True) ])
+temperatureSampler = SensorSampler("temperature", openTemperatureSensor, readTemperature, TEMPERATURE_PERIOD,
+                                   [ (LOW_TEMP_CUTOFF, True), (HIGH_TEMP_CUTOFF, False) ])
+pressureSampler.start()
+temperatureSampler.start()
 
+abort = False
 
 try:
   while True:
-    h['pressure'] = readPressure()
+    now = time.time()
+    (pSampleTime, pressure, pFiltered, pSlope, pCutoffSeconds) = pressureSampler.latest()
+    pStale = pressureSampler.stale(pSampleTime, now)
+    pSampled = pSampleTime is not None or pStale
+    h['pressure'] = SENSOR_READ_FAIL_VALUE if pStale else pressure
     h['p_detected'] = (h['pressure'] != SENSOR_READ_FAIL_VALUE)
-    h['temperature'] = readTemperature()
+    publishTrend('pressure', pFiltered, pSlope, pCutoffSeconds)
+    (tSampleTime, temperature, tFiltered, tSlope, tCutoffSeconds) = temperatureSampler.latest()
+    tStale = temperatureSampler.stale(tSampleTime, now)
+    tSampled = tSampleTime is not None or tStale
+    h['temperature'] = SENSOR_READ_FAIL_VALUE if tStale else temperature
     h['t_detected'] = (h['temperature'] != SENSOR_READ_FAIL_VALUE)
+    publishTrend('temperature', tFiltered, tSlope, tCutoffSeconds)
     abort = False
     if h['spindle_on']:
-      if not h['p_detected']:
+      # a sensor that hasn't been sampled yet can't be checked, until it's stale
+      if not pSampled:
+        pass
+      elif not h['p_detected']:
         h['p_detect_abort'] = True
         abort = True
-      elif h['pressure'] < LOW_PRESSURE_CUTOFF:
+      elif pFiltered < LOW_PRESSURE_CUTOFF:
         h['p_abort'] = True 
         abort = True    
+      elif predictedCrossing(pCutoffSeconds):
+        h['p_predicted_abort'] = True
+        abort = True
       
-      if not h['t_detected']:
+      if not tSampled:
+        pass
+      elif not h['t_detected']:
         h['t_detect_abort'] = True
         abort = True
-      elif h['temperature']  < LOW_TEMP_CUTOFF or h['temperature']  > HIGH_TEMP_CUTOFF:
+      elif tFiltered < LOW_TEMP_CUTOFF or tFiltered > HIGH_TEMP_CUTOFF:
         h['t_abort'] = True 
         abort = True
+      elif predictedCrossing(tCutoffSeconds):
+        h['t_predicted_abort'] = True
+        abort = True
     
     h['abort'] = abort
 
-    time.sleep(1)
+    time.sleep(LOOP_PERIOD)
 
 except KeyboardInterrupt:
   raise SystemExit
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# sensor_trend.py
+# Filters the recent samples of a sensor, so hss_sensors.py can check a reading that isn't thrown off by a
+# single noisy sample and see a steady decline coming before it crosses a cutoff.
+#
+# The last size samples are kept in a fixed size ring buffer. The filtered value is the median of the last
+# median_window samples, so one bad sample is ignored. The slope is a least squares fit over the whole
+# buffer, smoothed with an exponential moving average, in units per second.
+
+# Defaults for samples every 50ms, a quarter second median and a one second slope
+DEFAULT_SIZE = 20
+DEFAULT_MEDIAN_WINDOW = 5
+DEFAULT_SLOPE_ALPHA = 0.3
+
+class SensorTrend(object):
+  def __init__(self, size=DEFAULT_SIZE, median_window=DEFAULT_MEDIAN_WINDOW, slope_alpha=DEFAULT_SLOPE_ALPHA):
+    self.size = size
+    self.median_window = min(median_window, size)
+    self.slope_alpha = slope_alpha
+    self.times = [ 0.0 ] * size
+    self.values = [ 0.0 ] * size
+    self.count = 0
+    self.next = 0
+    self.smoothed_slope = None
+
+  def add(self, t, value):
+    self.times[self.next] = t
+    self.values[self.next] = value
+    self.next = (self.next + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+    slope = self.fitSlope()
+    if slope is not None:
+      if self.smoothed_slope is None:
+        self.smoothed_slope = slope
+      else:
+        self.smoothed_slope += self.slope_alpha * (slope - self.smoothed_slope)
+
+  def clear(self):
+    self.count = 0
+    self.next = 0
+    self.smoothed_slope = None
+
+  # Returns the last n (time, value) samples, oldest first
+  def samples(self, n=None):
+    n = self.count if n is None else min(n, self.count)
+    indices = [ (self.next - n + i) % self.size for i in range(n) ]
+    return [ (self.times[i], self.values[i]) for i in indices ]
+
+  # Returns the median of the last median_window samples, or None if there aren't any
+  def filtered(self):
+    values = sorted([ value for (t, value) in self.samples(self.median_window) ])
+    if not values:
+      return None
+    middle = len(values) // 2
+    if len(values) % 2:
+      return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+  def fitSlope(self):
+    samples = self.samples()
+    if len(samples) < 2:
+      return None
+
+    t0 = samples[0][0]
+    n = float(len(samples))
+    meanT = sum([ t - t0 for (t, value) in samples ]) / n
+    meanV = sum([ value for (t, value) in samples ]) / n
+    covariance = sum([ (t - t0 - meanT) * (value - meanV) for (t, value) in samples ])
+    variance = sum([ (t - t0 - meanT) ** 2 for (t, value) in samples ])
+    if variance == 0:
+      return None
+    return covariance / variance
+
+  # Returns the smoothed slope in units per second, or 0 until there are two samples
+  def slope(self):
+    if self.smoothed_slope is None:
+      return 0.0
+    return self.smoothed_slope
+
+  # Returns the predicted number of seconds until the filtered value crosses cutoff, 0 if it already has,
+  # or None if it isn't heading towards cutoff. falling is True for a lower limit, False for an upper one.
+  # Nothing is predicted until the buffer is full, since a slope fit to a few samples is mostly noise.
+  def secondsToCutoff(self, cutoff, falling):
+    filtered = self.filtered()
+    if filtered is None:
+      return None
+
+    remaining = filtered - cutoff if falling else cutoff - filtered
+    if remaining <= 0:
+      return 0.0
+
+    rate = -self.slope() if falling else self.slope()
+    if self.count < self.size or rate <= 0:
+      return None
+    return remaining / rate
@@ -1,12 +1,20 @@
 #!/usr/bin/python
 
+# interlock.py
+# Pauses programs and inhibits the spindle and feed while the interlock is open. The work is done by the
+# state machine in interlock_state.py, ticked every TICK_PERIOD.
+#
+# How fast it reacts is measured by interlock_latency.py. For each of its transitions, the max and p99
+# latency in seconds and the number of samples are published on latency.<transition>.max, .p99 and
+# .count, and all of it is written to Settings/interlock_latency.json.
+
 import hal
 import os
+import signal
 import time
 
-pauseAlertIssued = False
-spindlePauseAlertIssued = False
-waitForSpindlePeriod = 3 # How long to wait for spindle to spin up before resuming motion
+from interlock_state import Interlock, TICK_PERIOD
+from interlock_latency import InterlockLatency, TRANSITIONS, LATENCY_FILE
 
 h = hal.component('interlock')
 
@@ -45,6 +53,11 @@ h.newpin('pause-alert', hal.HAL_BIT, hal.HAL_OUT)
 h.newpin('exception', hal.HAL_BIT, hal.HAL_OUT)
 h.newpin('exception-alert', hal.HAL_BIT, hal.HAL_OUT)
 
+for name in TRANSITIONS:
+  h.newpin('latency.%s.max' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+  h.newpin('latency.%s.p99' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+  h.newpin('latency.%s.count' % name, hal.HAL_U32, hal.HAL_OUT)
+
 h['pause-program'] = False
 h['resume-program'] = False
 h['spindle-inhibit'] = False
@@ -59,86 +72,34 @@ h['exception-alert'] = False
 
 h.ready()
 
+interlock = Interlock(h)
+latency = InterlockLatency(TICK_PERIOD)
+latency.startDumping(LATENCY_FILE)
+
+# LinuxCNC stops userspace components with SIGTERM, the latencies are written out on the way out
+def stop(signum, frame):
+  raise SystemExit
+signal.signal(signal.SIGTERM, stop)
+
 try:
   while True:
+    now = time.time()
     try:
-      h['pause-program'] = False
-      h['resume-program'] = False
-      h['spindle-stop'] = False
-      h['exception'] = False
-      h['program-paused-by-interlock.not'] =  not h['program-paused-by-interlock']
-
-      if not ( h['program-is-paused'] or ( h['mode-is-mdi'] and h['spindle-is-enabled'] ) ):
-          h['program-paused-by-interlock'] = False
-          h['feed-inhibit'] = False
-
-      if h['closed']:
-        if not h['program-paused-by-interlock']:
-          h['spindle-inhibit'] = False
-          h['feed-inhibit'] = False
-
-        if h['release']:
-          h['program-paused-by-interlock'] = False
-          h['spindle-inhibit'] = False
-          startTime = time.time()
-          # Wait a bit so spindle is up to speed before motion resumes
-          while True:
-            elapsedTime = time.time() - startTime
-            if elapsedTime > waitForSpindlePeriod or not h['closed']:
-              break
-          h['feed-inhibit'] = False
-          h['release'] = False
-        elif h['start-button-pulse'] and h['program-paused-by-interlock']:
-          h['program-paused-by-interlock'] = False
-          h['spindle-inhibit'] = False
-          startTime = time.time()
-          # Wait a bit so spindle is up to speed before motion resumes
-          while True:
-            elapsedTime = time.time() - startTime
-            if elapsedTime > waitForSpindlePeriod or not h['closed']:
-              break
-          h['feed-inhibit'] = False
-          h['resume-program'] = True
-          #necessary to wait here, signal propagation seems to vary and sometimes take longer than 10ms
-          while h['program-is-paused']:
-            time.sleep(.001)
-
-        pauseAlertIssued = False
-        spindlePauseAlertIssued = False
-      else:
-        if h['program-running']:
-          h['pause-program'] = True
-          while abs(h['current-vel']) > 0.0001 :
-            time.sleep(0.001)
-          h['feed-inhibit'] = True
-          h['program-paused-by-interlock'] = True
-          if not pauseAlertIssued:
-            pauseAlertIssued = True
-            h['pause-alert'] = True
-        elif h['program-is-paused']:
-          if h['spindle-is-turning'] and not spindlePauseAlertIssued:
-            spindlePauseAlertIssued = True
-            h['spindle-stop-alert'] = True
-          # We do want to set feed-inhibit and program-paused-by-interlock True here, because the program could already be paused when the interlock is opened
-          h['feed-inhibit'] = True
-          h['program-paused-by-interlock'] = True
-          #set pause-program pin False so it is ready next time it is needed (it's effect occurs when changing state from False to True)
-          h['pause-program'] = False
-          #once Rockhopper has issued alert, be ready to issue alert again in case an attempt is made to start a program without first closing the interlock
-          pauseAlertIssued = h['pause-alert']
-        elif h['spindle-is-enabled']:
-          #If the spindle is on, but the interpreter is idle (not paused or running), then this stop is necessary to ensure the spindle does not resume immediately upon closing the interlock.
-          h['spindle-stop'] = True
-          h['spindle-stop-alert'] = True
-
-        h['spindle-inhibit'] = True
-        h['release'] = False
-
+      interlock.tick(now)
     except Exception as e:
       print 'Exception in interlock component: %s' % (e)
       h['exception'] = True
       h['exception-alert'] = True
-    time.sleep(.01)
+
+    # a problem measuring the interlock mustn't stop the machine
+    try:
+      latency.update(interlock, now)
+    except Exception as e:
+      print 'Exception measuring interlock latency: %s' % (e)
+    time.sleep(TICK_PERIOD)
 
 except KeyboardInterrupt:
-  raise SystemExit
\ No newline at end of file
+  raise SystemExit
+finally:
+  latency.dump(LATENCY_FILE)
+
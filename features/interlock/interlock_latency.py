@@ -0,0 +1,218 @@
+# interlock_latency.py
+# Measures how fast the interlock reacts, for showing to safety reviewers. InterlockLatency.update is
+# called after every tick of the state machine (see interlock_state.py) and watches the interlock's
+# pins, and its state for the start of a resume, for these transitions:
+#   door-to-spindle-inhibit  closed falling edge to spindle-inhibit set
+#   door-to-pause            closed falling edge, while a program is running, to pause-program set
+#   pause-to-stopped         pause-program rising edge to current-vel reaching zero
+#   door-to-feed-inhibit     closed falling edge, while a program is running or paused, to feed-inhibit set
+#   resume-to-spindle        start button or release, while paused by the interlock, to spindle-inhibit cleared
+#   resume-to-feed           start button or release, while paused by the interlock, to feed-inhibit cleared,
+#                            which includes the spin up period
+#   resume-to-running        resume-program rising edge to program-is-paused cleared
+# Pins are only seen once a tick, so each transition is timed from the last tick that hadn't seen its
+# start, to the first tick that sees its end. The latencies are upper bounds that include up to a tick
+# of sampling delay.
+#
+# A transition that has started but whose end can no longer come is abandoned rather than left waiting,
+# so that a much later end, like the operator resuming a program long after resume-program timed out,
+# isn't measured as its latency. After each tick, a started transition is dropped unless the interlock
+# is in one of its PENDING_STATES, the states it can still end from. The door and resume-to-spindle
+# transitions end in the tick that starts them or not at all.
+#
+# Each transition's latencies go into a LatencyHistogram, a fixed array of BUCKETS_PER_DECADE
+# logarithmic buckets per decade from MIN_LATENCY to MAX_LATENCY, so memory doesn't grow however long
+# the machine runs. p99 is the upper edge of the bucket holding the 99th percentile, so it's within
+# about 1/BUCKETS_PER_DECADE of a decade above the true value, and never above the exact max.
+#
+# The histograms are written to LATENCY_FILE every DUMP_PERIOD seconds when they have changed, from a
+# background thread so a slow SD card doesn't delay a tick, as json for Rockhopper:
+#   { "since": <start time>, "time": <dump time>, "tick_period": <s>,
+#     "transitions": { <name>: { "count", "max", "mean", "p50", "p99", "buckets": [ [ <upper edge>, <count> ], ... ] } } }
+# where buckets only lists buckets with a count, and the last upper edge, for latencies beyond
+# MAX_LATENCY, is null.
+
+import array
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from interlock_state import PAUSING, PAUSED, SPINNING_UP, RESUMING, STOPPED_VELOCITY
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+LATENCY_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/interlock_latency.json")
+
+DOOR_TO_SPINDLE_INHIBIT = "door-to-spindle-inhibit"
+DOOR_TO_PAUSE = "door-to-pause"
+PAUSE_TO_STOPPED = "pause-to-stopped"
+DOOR_TO_FEED_INHIBIT = "door-to-feed-inhibit"
+RESUME_TO_SPINDLE = "resume-to-spindle"
+RESUME_TO_FEED = "resume-to-feed"
+RESUME_TO_RUNNING = "resume-to-running"
+TRANSITIONS = [ DOOR_TO_SPINDLE_INHIBIT, DOOR_TO_PAUSE, PAUSE_TO_STOPPED, DOOR_TO_FEED_INHIBIT,
+                RESUME_TO_SPINDLE, RESUME_TO_FEED, RESUME_TO_RUNNING ]
+PENDING_STATES = { DOOR_TO_SPINDLE_INHIBIT: [],
+                   DOOR_TO_PAUSE: [],
+                   PAUSE_TO_STOPPED: [ PAUSING ],
+                   DOOR_TO_FEED_INHIBIT: [ PAUSING ],
+                   RESUME_TO_SPINDLE: [],
+                   RESUME_TO_FEED: [ SPINNING_UP ],
+                   RESUME_TO_RUNNING: [ RESUMING ] }
+
+MIN_LATENCY = 0.0001
+MAX_LATENCY = 100.0
+BUCKETS_PER_DECADE = 10
+# a bucket for latencies under MIN_LATENCY, the logarithmic buckets, and one for those over MAX_LATENCY
+BUCKETS = int(round(math.log10(MAX_LATENCY / MIN_LATENCY) * BUCKETS_PER_DECADE)) + 2
+
+DUMP_PERIOD = 10.0
+
+# Returns the upper edge of bucket, or None for the last one, which has no upper edge
+def bucketEdge(bucket):
+  if bucket >= BUCKETS - 1:
+    return None
+  return MIN_LATENCY * 10 ** (bucket / float(BUCKETS_PER_DECADE))
+
+def bucketIndex(seconds):
+  if seconds < MIN_LATENCY:
+    return 0
+  return min(BUCKETS - 1, int(math.floor(math.log10(seconds / MIN_LATENCY) * BUCKETS_PER_DECADE)) + 1)
+
+class LatencyHistogram(object):
+  def __init__(self):
+    self.buckets = array.array('L', [ 0 ] * BUCKETS)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    self.buckets[bucketIndex(seconds)] += 1
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+
+  # Returns the upper edge of the bucket holding the p'th percentile, no more than the max
+  def percentile(self, p):
+    if self.count == 0:
+      return 0.0
+    rank = int(math.ceil(p / 100.0 * self.count))
+    seen = 0
+    for (bucket, count) in enumerate(self.buckets):
+      seen += count
+      if seen >= rank:
+        edge = bucketEdge(bucket)
+        return self.max if edge is None else min(edge, self.max)
+    return self.max
+
+  def report(self):
+    return { 'count': self.count,
+             'max': self.max,
+             'mean': self.total / self.count if self.count else 0.0,
+             'p50': self.percentile(50),
+             'p99': self.percentile(99),
+             'buckets': [ [ bucketEdge(bucket), count ] for (bucket, count) in enumerate(self.buckets) if count ] }
+
+class InterlockLatency(object):
+  def __init__(self, tick_period):
+    self.tick_period = tick_period
+    self.since = time.time()
+    self.histograms = dict([ (name, LatencyHistogram()) for name in TRANSITIONS ])
+    # start time of each transition that's waiting for its end
+    self.starts = {}
+    self.previous = None
+    self.lastTick = None
+    self.samples = 0
+    # guards the histograms against the dump thread
+    self.lock = threading.Lock()
+
+  # Publishes a transition's max, p99 and count on its latency.<name>.* pins
+  def setPins(self, h, name):
+    histogram = self.histograms[name]
+    h['latency.%s.max' % name] = histogram.max
+    h['latency.%s.p99' % name] = histogram.percentile(99)
+    h['latency.%s.count' % name] = histogram.count & 0xFFFFFFFF
+
+  def finish(self, h, name, now):
+    start = self.starts.pop(name)
+    with self.lock:
+      self.histograms[name].add(now - start)
+      self.samples += 1
+    self.setPins(h, name)
+
+  def cancel(self, names):
+    for name in names:
+      self.starts.pop(name, None)
+
+  # Called after each tick of interlock, an interlock_state.Interlock, with the tick's time
+  def update(self, interlock, now):
+    h = interlock.h
+    pins = dict([ (name, h[name]) for name in [ 'closed', 'program-running', 'program-is-paused', 'pause-program',
+                                                 'resume-program', 'spindle-inhibit', 'feed-inhibit' ] ])
+    pins['state'] = interlock.state
+    previous = self.previous
+    if previous is not None:
+      # an edge happened some time after the last tick, so it's timed from then
+      since = self.lastTick
+      if previous['closed'] and not pins['closed']:
+        self.starts[DOOR_TO_SPINDLE_INHIBIT] = since
+        if previous['program-running']:
+          self.starts[DOOR_TO_PAUSE] = since
+        if previous['program-running'] or previous['program-is-paused']:
+          self.starts[DOOR_TO_FEED_INHIBIT] = since
+
+      # the start button or release was seen by this tick
+      if previous['state'] == PAUSED and pins['state'] == SPINNING_UP:
+        self.starts[RESUME_TO_SPINDLE] = since
+        self.starts[RESUME_TO_FEED] = since
+      if pins['pause-program'] and not previous['pause-program']:
+        self.starts[PAUSE_TO_STOPPED] = now
+      if pins['resume-program'] and not previous['resume-program']:
+        self.starts[RESUME_TO_RUNNING] = now
+
+    for (name, ended) in [ (DOOR_TO_SPINDLE_INHIBIT, pins['spindle-inhibit']),
+                           (DOOR_TO_PAUSE, pins['pause-program']),
+                           (PAUSE_TO_STOPPED, abs(h['current-vel']) <= STOPPED_VELOCITY),
+                           (DOOR_TO_FEED_INHIBIT, pins['feed-inhibit']),
+                           (RESUME_TO_SPINDLE, not pins['spindle-inhibit']),
+                           (RESUME_TO_FEED, not pins['feed-inhibit']),
+                           (RESUME_TO_RUNNING, not pins['program-is-paused']) ]:
+      if ended and name in self.starts:
+        self.finish(h, name, now)
+
+    self.cancel([ name for name in self.starts.keys() if pins['state'] not in PENDING_STATES[name] ])
+
+    self.previous = pins
+    self.lastTick = now
+
+  def report(self):
+    with self.lock:
+      return { 'since': self.since,
+               'time': time.time(),
+               'tick_period': self.tick_period,
+               'transitions': dict([ (name, histogram.report()) for (name, histogram) in self.histograms.items() ]) }
+
+  def dump(self, path):
+    tmp_file = "%s.tmp" % path
+    try:
+      with open(tmp_file, 'w') as f:
+        json.dump(self.report(), f, indent=2, sort_keys=True)
+      os.rename(tmp_file, path)
+    except (IOError, OSError) as e:
+      sys.stderr.write("Error writing interlock latency, %s: %s\n" % (path, e))
+
+  # Starts a thread that dumps to path every period seconds, when there are new samples
+  def startDumping(self, path=LATENCY_FILE, period=DUMP_PERIOD):
+    def run():
+      dumped = None
+      while True:
+        time.sleep(period)
+        if self.samples != dumped:
+          dumped = self.samples
+          self.dump(path)
+    thread = threading.Thread(target=run, name="interlock latency dump")
+    thread.daemon = True
+    thread.start()
+    return thread
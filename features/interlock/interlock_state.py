@@ -0,0 +1,195 @@
+# interlock_state.py
+# The interlock component's state machine, kept apart from interlock.py so it can be driven by anything
+# that reads and writes pins like a hal component (see verify_interlock.py).
+#
+# Interlock.tick is called every TICK_PERIOD with the current time. It reads the input pins, makes at
+# most a few transitions and writes the output pins. Nothing in it waits; a state that has to wait for
+# something, like the spindle spinning up, keeps a deadline and checks it on later ticks. The states are:
+#   closed               the door is closed and the interlock isn't holding anything
+#   open                 the door is open and no program is active, so only the spindle is inhibited
+#   pausing              the door opened while a program was running, pause-program is held until
+#                        current-vel reaches zero
+#   paused-by-interlock  feed is inhibited until the door is closed and release or the start button
+#                        is pressed, or the program is no longer paused
+#   spinning-up          the spindle is allowed to turn again and feed stays inhibited until
+#                        spin_up_period has passed
+#   resuming             resume-program is held until the program is no longer paused, or for
+#                        at most resume_timeout
+# Opening the door while spinning up or resuming goes straight back to pausing or paused-by-interlock.
+
+CLOSED = "closed"
+OPEN = "open"
+PAUSING = "pausing"
+PAUSED = "paused-by-interlock"
+SPINNING_UP = "spinning-up"
+RESUMING = "resuming"
+STATES = [ CLOSED, OPEN, PAUSING, PAUSED, SPINNING_UP, RESUMING ]
+
+TICK_PERIOD = .01
+# How long to wait for the spindle to spin up before resuming motion
+SPIN_UP_PERIOD = 3.0
+# How long to hold resume-program; signal propagation varies and sometimes takes longer than a tick
+RESUME_TIMEOUT = 1.0
+# current-vel at or below this is stopped
+STOPPED_VELOCITY = 0.0001
+
+# Pins that are only held for a tick, or for as long as a state holds them
+PULSE_PINS = [ 'pause-program', 'resume-program', 'spindle-stop', 'exception' ]
+
+class Interlock(object):
+  def __init__(self, h, spin_up_period=SPIN_UP_PERIOD, resume_timeout=RESUME_TIMEOUT):
+    self.h = h
+    self.spin_up_period = spin_up_period
+    self.resume_timeout = resume_timeout
+    self.state = CLOSED
+    self.deadline = None
+    # whether spinning-up goes on to resuming, which it does after the start button but not after release
+    self.resume = False
+    self.pauseAlertIssued = False
+    self.spindlePauseAlertIssued = False
+
+  def enter(self, state, now, deadline=None):
+    self.state = state
+    self.deadline = None if deadline is None else now + deadline
+
+  def tick(self, now):
+    h = self.h
+    for pin in PULSE_PINS:
+      if not (pin == 'pause-program' and self.state == PAUSING or pin == 'resume-program' and self.state == RESUMING):
+        h[pin] = False
+
+    state = self.state
+    if state == CLOSED or state == OPEN:
+      self.tickIdle(now)
+    elif state == PAUSING:
+      self.tickPausing(now)
+    elif state == PAUSED:
+      self.tickPaused(now)
+    elif state == SPINNING_UP:
+      self.tickSpinningUp(now)
+    elif state == RESUMING:
+      self.tickResuming(now)
+
+    h['program-paused-by-interlock.not'] = not h['program-paused-by-interlock']
+
+  # A program is held by the interlock while it's paused, or while the spindle is on in MDI
+  def programHeld(self):
+    h = self.h
+    return h['program-is-paused'] or (h['mode-is-mdi'] and h['spindle-is-enabled'])
+
+  def tickIdle(self, now):
+    if self.h['closed']:
+      self.closed(now)
+    else:
+      self.opened(now)
+
+  # The door is closed and nothing is held
+  def closed(self, now):
+    h = self.h
+    h['program-paused-by-interlock'] = False
+    h['spindle-inhibit'] = False
+    h['feed-inhibit'] = False
+    h['release'] = False
+    self.pauseAlertIssued = False
+    self.spindlePauseAlertIssued = False
+    self.enter(CLOSED, now)
+
+  # The door is open, pause anything that's running and stop the spindle
+  def opened(self, now):
+    h = self.h
+    h['spindle-inhibit'] = True
+    h['release'] = False
+    if h['program-running']:
+      h['pause-program'] = True
+      self.enter(PAUSING, now)
+      self.tickPausing(now)
+    elif h['program-is-paused']:
+      self.paused(now)
+    else:
+      if h['spindle-is-enabled']:
+        # If the spindle is on, but the interpreter is idle (not paused or running), then this stop is necessary to ensure the spindle does not resume immediately upon closing the interlock.
+        h['spindle-stop'] = True
+        h['spindle-stop-alert'] = True
+      if h['program-paused-by-interlock'] and self.programHeld():
+        # held in MDI with the spindle on, which the stop above ends
+        self.enter(PAUSED, now)
+      else:
+        if not self.programHeld():
+          h['feed-inhibit'] = False
+        self.enter(OPEN, now)
+
+  def tickPausing(self, now):
+    h = self.h
+    if not h['closed']:
+      h['spindle-inhibit'] = True
+      h['release'] = False
+    if abs(h['current-vel']) <= STOPPED_VELOCITY:
+      h['feed-inhibit'] = True
+      h['program-paused-by-interlock'] = True
+      if not self.pauseAlertIssued:
+        self.pauseAlertIssued = True
+        h['pause-alert'] = True
+      self.enter(PAUSED, now)
+
+  # The door is open and the program is already paused, which it could be before the door was opened
+  def paused(self, now):
+    h = self.h
+    if h['spindle-is-turning'] and not self.spindlePauseAlertIssued:
+      self.spindlePauseAlertIssued = True
+      h['spindle-stop-alert'] = True
+    h['spindle-inhibit'] = True
+    h['feed-inhibit'] = True
+    h['program-paused-by-interlock'] = True
+    h['release'] = False
+    # once Rockhopper has issued the alert, be ready to issue it again in case an attempt is made to start a program without first closing the interlock
+    self.pauseAlertIssued = h['pause-alert']
+    self.enter(PAUSED, now)
+
+  def tickPaused(self, now):
+    h = self.h
+    if not self.programHeld():
+      # the program was stopped or resumed some other way, so there's nothing left to hold
+      h['program-paused-by-interlock'] = False
+      h['feed-inhibit'] = False
+      self.tickIdle(now)
+    elif not h['closed']:
+      self.opened(now)
+    else:
+      self.pauseAlertIssued = False
+      self.spindlePauseAlertIssued = False
+      if h['release']:
+        self.spinUp(now, False)
+      elif h['start-button-pulse']:
+        self.spinUp(now, True)
+
+  # Lets the spindle turn again, feed stays inhibited until it's up to speed
+  def spinUp(self, now, resume):
+    h = self.h
+    h['program-paused-by-interlock'] = False
+    h['spindle-inhibit'] = False
+    self.resume = resume
+    self.enter(SPINNING_UP, now, self.spin_up_period)
+
+  def tickSpinningUp(self, now):
+    h = self.h
+    if not h['closed']:
+      self.opened(now)
+    elif not self.programHeld():
+      self.closed(now)
+    elif now >= self.deadline:
+      h['feed-inhibit'] = False
+      h['release'] = False
+      if self.resume:
+        h['resume-program'] = True
+        self.enter(RESUMING, now, self.resume_timeout)
+      else:
+        self.closed(now)
+
+  def tickResuming(self, now):
+    h = self.h
+    if not h['closed']:
+      h['resume-program'] = False
+      self.opened(now)
+    elif not h['program-is-paused'] or now >= self.deadline:
+      h['resume-program'] = False
+      self.closed(now)
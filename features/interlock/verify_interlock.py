@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+# verify_interlock.py
+# Transition check for interlock_state.py, run against simulation/hal.py's fake hal component.
+#
+# Every state is reached the way it is on a machine, then ticked once with every combination of the
+# input pins, both before and after the state's deadline. After each tick the safety rules below are
+# checked, and no tick may take longer than MAX_TICK seconds, so none of them waits:
+#   - while the door is open, spindle-inhibit is set, release is cleared and the state isn't closed,
+#     spinning-up or resuming
+#   - in paused-by-interlock, feed-inhibit and program-paused-by-interlock are set
+#   - feed-inhibit is only cleared when no program is held, or when spinning-up reaches its deadline
+#   - spindle-inhibit is only cleared with the door closed
+#   - resume-program is only set in resuming, with the door closed
+#   - program-paused-by-interlock.not is the opposite of program-paused-by-interlock
+# Then a few sequences of ticks, like the door being opened again while spinning up, are run through
+# and checked step by step, and the latencies interlock_latency.py measures for some of them are checked
+# against the times of their steps, on the latency pins and in the dump. The transitions seen are
+# printed. Exits with a non-zero status if any check fails.
+#
+# Usage: features/interlock/verify_interlock.py
+
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+INTERLOCK_DIR = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_DIR = os.path.dirname(os.path.dirname(INTERLOCK_DIR))
+sys.path.insert(0, os.path.join(SETTINGS_DIR, "simulation"))
+
+import hal
+from interlock_state import Interlock, STATES, CLOSED, OPEN, PAUSING, PAUSED, SPINNING_UP, RESUMING, SPIN_UP_PERIOD, RESUME_TIMEOUT, TICK_PERIOD
+from interlock_latency import InterlockLatency, TRANSITIONS
+
+# Far less than the 1ms and 3s waits of the loops a tick replaces would take, with room for a busy machine
+MAX_TICK = 0.05
+
+INPUTS = [ 'closed', 'program-running', 'program-is-paused', 'spindle-is-enabled', 'spindle-is-turning',
+           'mode-is-mdi', 'start-button-pulse', 'release' ]
+OUTPUTS = [ 'pause-program', 'resume-program', 'spindle-inhibit', 'feed-inhibit', 'spindle-stop',
+            'spindle-stop-alert', 'program-paused-by-interlock', 'program-paused-by-interlock.not',
+            'pause-alert', 'exception', 'exception-alert' ]
+
+IDLE = { 'closed': True }
+RUNNING = { 'closed': True, 'program-running': True, 'spindle-is-enabled': True, 'spindle-is-turning': True, 'current-vel': 1.0 }
+
+def component():
+  h = hal.component('interlock')
+  for name in INPUTS:
+    h.newpin(name, hal.HAL_BIT, hal.HAL_IO if name == 'release' else hal.HAL_IN)
+  h.newpin('current-vel', hal.HAL_FLOAT, hal.HAL_IN)
+  for name in OUTPUTS:
+    h.newpin(name, hal.HAL_BIT, hal.HAL_OUT)
+  for name in TRANSITIONS:
+    h.newpin('latency.%s.max' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+    h.newpin('latency.%s.p99' % name, hal.HAL_FLOAT, hal.HAL_OUT)
+    h.newpin('latency.%s.count' % name, hal.HAL_U32, hal.HAL_OUT)
+  h['program-paused-by-interlock.not'] = True
+  h.ready()
+  return h
+
+def setInputs(h, inputs):
+  for name in INPUTS:
+    h.set(name, inputs.get(name, False))
+  h.set('current-vel', inputs.get('current-vel', 0.0))
+
+# The steps, as (seconds since the start, inputs), that take a new interlock to each state
+def setups():
+  opened = dict(RUNNING, closed=False)
+  stopped = dict(opened, **{ 'current-vel': 0.0 })
+  paused = dict(stopped, **{ 'program-running': False, 'program-is-paused': True })
+  closedPaused = dict(paused, closed=True)
+  return [ (CLOSED, [ (0, IDLE) ]),
+           (OPEN, [ (0, dict(IDLE, closed=False)) ]),
+           (PAUSING, [ (0, RUNNING), (1, opened) ]),
+           (PAUSED, [ (0, RUNNING), (1, opened), (2, stopped), (3, paused) ]),
+           (PAUSED, [ (0, RUNNING), (1, opened), (2, stopped), (3, paused), (4, closedPaused) ]),
+           (SPINNING_UP, [ (0, RUNNING), (1, opened), (2, stopped), (3, paused), (4, dict(closedPaused, release=True)) ]),
+           (SPINNING_UP, [ (0, RUNNING), (1, opened), (2, stopped), (3, paused), (4, dict(closedPaused, **{ 'start-button-pulse': True })) ]),
+           (RESUMING, [ (0, RUNNING), (1, opened), (2, stopped), (3, paused), (4, dict(closedPaused, **{ 'start-button-pulse': True })),
+                        (5 + SPIN_UP_PERIOD, closedPaused) ]) ]
+
+class Checker(object):
+  def __init__(self):
+    self.failures = 0
+    self.transitions = {}
+    self.slowest = 0
+
+  def fail(self, message):
+    self.failures += 1
+    if self.failures <= 20:
+      print "FAIL: %s" % message
+
+  def tick(self, interlock, now, inputs, description, latency=None):
+    h = interlock.h
+    setInputs(h, inputs)
+    before = dict([ (name, h.values[name]) for name in OUTPUTS + [ 'release' ] ])
+    state = interlock.state
+    deadline = interlock.deadline
+
+    start = time.time()
+    try:
+      interlock.tick(now)
+    except Exception as e:
+      self.fail("%s: tick raised %r" % (description, e))
+      return
+    self.slowest = max(self.slowest, time.time() - start)
+    if time.time() - start > MAX_TICK:
+      self.fail("%s: tick took %.1fms" % (description, (time.time() - start) * 1000))
+
+    if latency:
+      latency.update(interlock, now)
+
+    self.transitions[(state, interlock.state)] = self.transitions.get((state, interlock.state), 0) + 1
+    self.checkRules(interlock, inputs, before, state, deadline, now, description)
+
+  def checkRules(self, interlock, inputs, before, state, deadline, now, description):
+    values = interlock.h.values
+    description = "%s, %s -> %s" % (description, state, interlock.state)
+    held = inputs.get('program-is-paused') or (inputs.get('mode-is-mdi') and inputs.get('spindle-is-enabled'))
+    if interlock.state not in STATES:
+      self.fail("%s: unknown state" % description)
+    if not inputs.get('closed'):
+      if not values['spindle-inhibit'] or values['release']:
+        self.fail("%s: door open without spindle-inhibit set and release cleared" % description)
+      if interlock.state in [ CLOSED, SPINNING_UP, RESUMING ]:
+        self.fail("%s: door open in a closed state" % description)
+    if interlock.state == PAUSED and not (values['feed-inhibit'] and values['program-paused-by-interlock']):
+      self.fail("%s: paused without feed-inhibit and program-paused-by-interlock" % description)
+    if before['feed-inhibit'] and not values['feed-inhibit']:
+      if held and not (state == SPINNING_UP and now >= deadline):
+        self.fail("%s: feed-inhibit cleared while held" % description)
+    if before['spindle-inhibit'] and not values['spindle-inhibit'] and not inputs.get('closed'):
+      self.fail("%s: spindle-inhibit cleared with the door open" % description)
+    if values['resume-program'] and not (interlock.state == RESUMING and inputs.get('closed')):
+      self.fail("%s: resume-program set outside resuming" % description)
+    if values['program-paused-by-interlock.not'] == values['program-paused-by-interlock']:
+      self.fail("%s: program-paused-by-interlock.not isn't the opposite" % description)
+    if values['exception']:
+      self.fail("%s: exception set" % description)
+
+  # Runs steps of (seconds, inputs, expected state) from time start
+  def run(self, interlock, steps, description, start=0, latency=None):
+    for (i, step) in enumerate(steps):
+      (seconds, inputs) = step[:2]
+      self.tick(interlock, start + seconds, inputs, "%s step %d" % (description, i), latency)
+      if len(step) > 2 and interlock.state != step[2]:
+        self.fail("%s step %d: in %s, expected %s" % (description, i, interlock.state, step[2]))
+
+def checkAllInputs(checker):
+  names = INPUTS + [ 'current-vel' ]
+  cases = 0
+  for (state, steps) in setups():
+    for combination in itertools.product([ False, True ], repeat=len(names)):
+      for late in [ False, True ]:
+        inputs = dict(zip(names, combination))
+        inputs['current-vel'] = 1.0 if inputs['current-vel'] else 0.0
+        interlock = Interlock(component())
+        checker.run(interlock, steps, "setup %s" % state)
+        if interlock.state != state:
+          checker.fail("setup %s ended in %s" % (state, interlock.state))
+          continue
+        now = steps[-1][0] + (max(SPIN_UP_PERIOD, RESUME_TIMEOUT) + 1 if late else 0.01)
+        checker.tick(interlock, now, inputs, "%s with %s" % (state, ", ".join([ name for name in names if inputs[name] ])))
+        cases += 1
+  return cases
+
+def sequenceSteps():
+  opened = dict(RUNNING, closed=False)
+  stopped = dict(opened, **{ 'current-vel': 0.0 })
+  paused = dict(stopped, **{ 'program-running': False, 'program-is-paused': True })
+  closedPaused = dict(paused, closed=True)
+  start = dict(closedPaused, **{ 'start-button-pulse': True })
+  pausing = [ (0, RUNNING, CLOSED), (0.01, opened, PAUSING), (0.5, opened, PAUSING), (0.51, stopped, PAUSED), (0.52, paused, PAUSED) ]
+
+  return [
+    ("resume with the start button",
+     pausing + [ (1, closedPaused, PAUSED), (2, start, SPINNING_UP), (2 + SPIN_UP_PERIOD - 0.01, closedPaused, SPINNING_UP),
+                 (2 + SPIN_UP_PERIOD, closedPaused, RESUMING), (2.01 + SPIN_UP_PERIOD, closedPaused, RESUMING),
+                 (2.02 + SPIN_UP_PERIOD, RUNNING, CLOSED) ]),
+    ("release",
+     pausing + [ (1, dict(closedPaused, release=True), SPINNING_UP), (1 + SPIN_UP_PERIOD, closedPaused, CLOSED) ]),
+    ("door opened while spinning up",
+     pausing + [ (1, start, SPINNING_UP), (2, paused, PAUSED), (3, closedPaused, PAUSED), (4, start, SPINNING_UP),
+                 (4 + SPIN_UP_PERIOD, closedPaused, RESUMING), (4.01 + SPIN_UP_PERIOD, RUNNING, CLOSED) ]),
+    ("door opened while resuming",
+     pausing + [ (1, start, SPINNING_UP), (1 + SPIN_UP_PERIOD, closedPaused, RESUMING),
+                 (1.01 + SPIN_UP_PERIOD, opened, PAUSING), (1.02 + SPIN_UP_PERIOD, stopped, PAUSED) ]),
+    ("resume that never happens",
+     pausing + [ (1, start, SPINNING_UP), (1 + SPIN_UP_PERIOD, closedPaused, RESUMING),
+                 (1 + SPIN_UP_PERIOD + RESUME_TIMEOUT, closedPaused, CLOSED), (60, closedPaused, CLOSED), (61, RUNNING, CLOSED) ]),
+    ("program aborted while paused",
+     pausing + [ (1, dict(IDLE, closed=False), OPEN), (2, IDLE, CLOSED) ]),
+    ("program aborted while spinning up",
+     pausing + [ (1, start, SPINNING_UP), (2, IDLE, CLOSED) ]),
+    ("door opened while paused",
+     [ (0, dict(IDLE, **{ 'program-is-paused': True }), CLOSED), (1, dict(IDLE, closed=False, **{ 'program-is-paused': True }), PAUSED) ]),
+    ("door opened with the spindle on",
+     [ (0, dict(IDLE, **{ 'spindle-is-enabled': True }), CLOSED), (1, { 'spindle-is-enabled': True }, OPEN),
+       (1.01, {}, OPEN), (2, IDLE, CLOSED) ]),
+    ("door opened in MDI with the spindle on",
+     [ (0, dict(RUNNING, **{ 'mode-is-mdi': True }), CLOSED), (1, dict(opened, **{ 'mode-is-mdi': True }), PAUSING),
+       (1.01, { 'mode-is-mdi': True, 'spindle-is-enabled': True }, PAUSED), (1.02, { 'mode-is-mdi': True }, OPEN) ]),
+  ]
+
+def checkSequences(checker):
+  for (description, steps) in sequenceSteps():
+    interlock = Interlock(component())
+    checker.run(interlock, steps, description)
+    h = interlock.h
+
+    # pulses are single rising edges while the state holds them
+    for pin in [ 'pause-program', 'resume-program' ]:
+      edges = [ value for (t, value) in h.writes[pin] ]
+      rises = len([ 1 for (a, b) in zip([ False ] + edges, edges) if b and not a ])
+      expected = len([ 1 for (a, b) in zip(steps, steps[1:]) if b[2] == (PAUSING if pin == 'pause-program' else RESUMING) and a[2] != b[2] ])
+      if rises != expected:
+        checker.fail("%s: %s rose %d times, expected %d" % (description, pin, rises, expected))
+
+  return len(sequenceSteps())
+
+# The latencies interlock_latency.py should measure for some of the sequences, as lists of samples. Door
+# edges and the start button are timed from the tick before the one that sees them.
+EXPECTED_LATENCIES = {
+  "resume with the start button": { 'door-to-spindle-inhibit': [ 0.01 ], 'door-to-pause': [ 0.01 ], 'pause-to-stopped': [ 0.5 ],
+                                    'door-to-feed-inhibit': [ 0.51 ], 'resume-to-spindle': [ 1.0 ],
+                                    'resume-to-feed': [ 1.0 + SPIN_UP_PERIOD ], 'resume-to-running': [ 0.02 ] },
+  # resume-program times out with the program still paused, so the resume that comes much later isn't measured
+  "resume that never happens": { 'door-to-spindle-inhibit': [ 0.01 ], 'door-to-pause': [ 0.01 ], 'pause-to-stopped': [ 0.5 ],
+                                 'door-to-feed-inhibit': [ 0.51 ], 'resume-to-spindle': [ 0.48 ],
+                                 'resume-to-feed': [ 0.48 + SPIN_UP_PERIOD ] },
+  # the first resume is cancelled by the door opening, so only the second one's feed and resume are measured
+  "door opened while spinning up": { 'door-to-spindle-inhibit': [ 0.01, 1.0 ], 'door-to-pause': [ 0.01 ], 'pause-to-stopped': [ 0.5 ],
+                                     'door-to-feed-inhibit': [ 0.51, 1.0 ], 'resume-to-spindle': [ 0.48, 1.0 ],
+                                     'resume-to-feed': [ 1.0 + SPIN_UP_PERIOD ], 'resume-to-running': [ 0.01 ] },
+}
+
+def checkLatencies(checker):
+  latency_dir = tempfile.mkdtemp(prefix="verify_interlock")
+  try:
+    for (description, steps) in sequenceSteps():
+      if description not in EXPECTED_LATENCIES:
+        continue
+      interlock = Interlock(component())
+      latency = InterlockLatency(TICK_PERIOD)
+      checker.run(interlock, steps, description, latency=latency)
+
+      path = os.path.join(latency_dir, "interlock_latency.json")
+      latency.dump(path)
+      with open(path, 'r') as f:
+        dumped = json.load(f)['transitions']
+
+      for name in TRANSITIONS:
+        expected = EXPECTED_LATENCIES[description].get(name, [])
+        histogram = latency.histograms[name]
+        values = interlock.h.values
+        if histogram.count != len(expected) or abs(histogram.max - max(expected + [ 0 ])) > 1e-9:
+          checker.fail("%s: %s measured %d samples, max %s, expected %s" % (description, name, histogram.count, histogram.max, expected))
+        if expected and not (max(expected) / 10 ** (1.0 / 10) <= histogram.percentile(99) <= max(expected)):
+          checker.fail("%s: %s p99 %s isn't within a bucket of %s" % (description, name, histogram.percentile(99), max(expected)))
+        if expected and (values['latency.%s.count' % name] != len(expected) or values['latency.%s.max' % name] != histogram.max or
+                         values['latency.%s.p99' % name] != histogram.percentile(99)):
+          checker.fail("%s: %s pins don't match the histogram" % (description, name))
+        if dumped[name]['count'] != histogram.count or sum([ count for (edge, count) in dumped[name]['buckets'] ]) != histogram.count:
+          checker.fail("%s: %s dump doesn't match the histogram" % (description, name))
+  finally:
+    shutil.rmtree(latency_dir)
+  return len(EXPECTED_LATENCIES)
+
+if __name__ == "__main__":
+  checker = Checker()
+  cases = checkAllInputs(checker)
+  sequences = checkSequences(checker)
+  latencies = checkLatencies(checker)
+
+  print "%-22s %-22s %8s" % ("from", "to", "ticks")
+  for ((a, b), count) in sorted(checker.transitions.items(), key=lambda item: (STATES.index(item[0][0]), STATES.index(item[0][1]))):
+    print "%-22s %-22s %8d" % (a, b, count)
+  print
+  print "Checked %d input combinations, %d sequences and latencies of %d sequences, slowest tick %.3fms" % (cases, sequences, latencies, checker.slowest * 1000)
+  if checker.failures:
+    print "%d checks failed" % checker.failures
+    sys.exit(1)
@@ -0,0 +1,7 @@
+import glob
+
+# Older kernels have a capemgr slots file that the PocketNCdriver overlay is loaded through
+def detect():
+  if glob.glob("/sys/devices/bone_capemgr.*/slots"):
+    return 1
+  return 0
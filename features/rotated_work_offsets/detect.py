@@ -0,0 +1,2 @@
+def detect():
+  return 1
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# spindle_log_export.py
+# Regenerates Commanded.csv and Measured.csv, in the tab separated format spindle_logging.py used to
+# write, from the segments of the spindle log store (see spindle_log_store.py):
+#   <time>\t0\tServer Started\t<uuid>
+#   <time>\t<rpm>
+# Values are written as floats, so a commanded speed of 0 is 0.0.
+#
+# Usage: ./spindle_log_export.py [--logs DIR] [--output DIR] [--since TIME] [--until TIME]
+
+import argparse
+import heapq
+import os
+import sys
+
+from spindle_log_store import LOG_DIR, STREAMS, CSV_FILES, listSegments, readSegment, readSessions, iterRecords
+
+# Yields (time, line) for each record of stream, oldest first
+def recordLines(log_dir, stream, since, until):
+  for (sequence, segment_stream, path, compressed) in listSegments(log_dir):
+    if segment_stream != stream:
+      continue
+    try:
+      (created, records) = readSegment(path)
+    except (IOError, ValueError) as e:
+      sys.stderr.write("Skipping %s: %s\n" % (path, e))
+      continue
+
+    for (t, value, session) in iterRecords(records):
+      if since <= t < until:
+        yield (t, "%s\t%s\n" % (t, value))
+
+def sessionLines(sessions, since, until):
+  for (uid, start) in sorted([ session for session in sessions if session[0] is not None ], key=lambda session: session[1]):
+    if since <= start < until:
+      yield (start, "%s\t0\tServer Started\t%s\n" % (start, uid))
+
+def export(log_dir, stream, path, since=0, until=float("inf")):
+  sessions = readSessions(log_dir)
+  lines = 0
+  with open(path, 'w') as f:
+    # a session starts before any record logged at the same time
+    for (t, order, line) in heapq.merge(((t, 0, line) for (t, line) in sessionLines(sessions, since, until)),
+                                        ((t, 1, line) for (t, line) in recordLines(log_dir, stream, since, until))):
+      f.write(line)
+      lines += 1
+  return lines
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Export the spindle log store as Commanded.csv and Measured.csv")
+  parser.add_argument("--logs", default=LOG_DIR, help="directory of the spindle log store")
+  parser.add_argument("--output", default=".", help="directory to write the csv files to")
+  parser.add_argument("--since", type=float, default=0, help="only export lines logged at or after this unix time")
+  parser.add_argument("--until", type=float, default=float("inf"), help="only export lines logged before this unix time")
+  args = parser.parse_args()
+
+  # the store moves csv files it finds in its directory into itself, which would duplicate every record
+  if os.path.realpath(args.output) == os.path.realpath(args.logs):
+    sys.stderr.write("Not exporting into the spindle log store's directory, %s, choose another --output\n" % args.logs)
+    sys.exit(1)
+
+  for stream in STREAMS:
+    path = os.path.join(args.output, CSV_FILES[stream])
+    lines = export(args.logs, stream, path, args.since, args.until)
+    print "Wrote %d lines to %s" % (lines, path)
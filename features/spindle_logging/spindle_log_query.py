@@ -0,0 +1,497 @@
+#!/usr/bin/python
+
+# spindle_log_query.py
+# Time range and session queries over the spindle logs, with summary statistics, without reading (or
+# pushing out of the page cache) more of the logs than a query needs. It needs NumPy.
+#
+# Two kinds of logs are read, and used together when both exist:
+#   the spindle log store    segments written by spindle_log_store.py. Each segment's time range is kept in
+#                            the store's INDEX_FILE. Open segments are memory mapped and binary searched,
+#                            compressed segments that overlap the query are decompressed.
+#   Commanded/Measured.csv   the text logs spindle_logging.py used to write. A sparse index of the time and
+#                            offset of every CSV_INDEX_LINES'th line, and the offset of every "Server Started"
+#                            line, is kept in <file>.index and extended as the file grows. A query parses
+#                            only the lines between the index entries around it, from a memory map. The
+#                            store moves these in when it's first opened, so they're only left in logs that
+#                            haven't been written by the store yet, like ones copied off an older machine.
+# The logs are assumed to be in time order, as they're appended as they happen.
+#
+# Statistics:
+#   error    measured vs commanded speed, for measured samples taken at least --settle seconds after the
+#            last speed change
+#   settle   time from each speed change to the first measured sample within --tolerance of it. Measured
+#            samples are logged once a second after a change, so this is to the second.
+#   hours    hours spent commanded at each --band-width RPM band. A speed is counted until the next
+#            speed change, or the last thing logged in its session, whichever is first.
+#
+# Usage: ./spindle_log_query.py [--logs DIR] [--since TIME] [--until TIME] [--session UUID]
+#                               [--settle S] [--tolerance F] [--band-width RPM] [error] [settle] [hours]
+#   TIME is a unix time or a local YYYY-MM-DD[THH:MM[:SS]], UUID can be abbreviated.
+
+import argparse
+import datetime
+import json
+import mmap
+import os
+import sys
+import time
+
+import numpy as np
+
+from spindle_log_store import LOG_DIR, STREAMS, COMMANDED, MEASURED, HEADER, RECORD, CSV_FILES, listSegments, readHeader, readSegment, readSessions
+
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+
+CSV_INDEX_LINES = 4096
+CSV_INDEX_CHUNK = 16 * 1024 * 1024
+SESSION_MARKER = "\tServer Started\t"
+
+RECORD_DTYPE = np.dtype([ ('time', '<f8'), ('value', '<f8'), ('session', '<u4') ])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+DEFAULT_SETTLE = 3.0
+DEFAULT_TOLERANCE = 0.02
+DEFAULT_BAND_WIDTH = 5000.0
+
+EMPTY = (np.zeros(0), np.zeros(0))
+
+def readJson(path):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return None
+
+def writeJson(path, data):
+  tmp_path = "%s.tmp" % path
+  try:
+    with open(tmp_path, 'w') as f:
+      json.dump(data, f)
+    os.rename(tmp_path, path)
+  except (IOError, OSError) as e:
+    # the index is only a cache, a read only log directory just means it's rebuilt every time
+    sys.stderr.write("Error writing %s: %s\n" % (path, e))
+
+# Returns the (times, values) of the records in a memory mapped or decompressed array of RECORD_DTYPE
+# between since and until
+def sliceRecords(records, since, until):
+  times = records['time']
+  first = np.searchsorted(times, since, 'left')
+  end = np.searchsorted(times, until, 'left')
+  return (np.array(times[first:end]), np.array(records['value'][first:end]))
+
+class StoreLogs(object):
+  def __init__(self, log_dir):
+    self.log_dir = log_dir
+    self.index = self.updateIndex()
+
+  # Returns { segment name: [ size, mtime, first time, last time ] }, updating INDEX_FILE for segments
+  # that are new or have changed
+  def updateIndex(self):
+    index_path = os.path.join(self.log_dir, INDEX_FILE)
+    cached = readJson(index_path) or {}
+    if cached.get('version') != INDEX_VERSION:
+      cached = {}
+    cached = cached.get('segments', {})
+
+    index = {}
+    for (sequence, stream, path, compressed) in listSegments(self.log_dir):
+      name = os.path.basename(path)
+      st = os.stat(path)
+      entry = cached.get(name)
+      if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+        index[name] = entry
+        continue
+
+      records = self.records(path, compressed)
+      if records is None:
+        continue
+      if len(records):
+        index[name] = [ st.st_size, st.st_mtime, float(records['time'][0]), float(records['time'][-1]) ]
+      else:
+        index[name] = [ st.st_size, st.st_mtime, None, None ]
+
+    if index != cached:
+      writeJson(index_path, { 'version': INDEX_VERSION, 'segments': index })
+    return index
+
+  # Returns the records of a segment as an array of RECORD_DTYPE, memory mapped if it isn't compressed,
+  # or None if it can't be read
+  def records(self, path, compressed):
+    try:
+      if compressed:
+        return np.frombuffer(readSegment(path)[1], dtype=RECORD_DTYPE)
+
+      with open(path, 'rb') as f:
+        readHeader(f.read(HEADER.size), path)
+      count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+      if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+      return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+    except (IOError, ValueError) as e:
+      sys.stderr.write("Skipping %s: %s\n" % (path, e))
+      return None
+
+  # Returns a list of (uuid, start time)
+  def sessions(self):
+    return [ session for session in readSessions(self.log_dir) if session[0] is not None ]
+
+  # Returns (times, values) of the stream's records logged from since until before until
+  def read(self, stream, since, until):
+    parts = []
+    for (sequence, segment_stream, path, compressed) in listSegments(self.log_dir):
+      entry = self.index.get(os.path.basename(path))
+      if segment_stream != stream or not entry or entry[2] is None or entry[3] < since or entry[2] >= until:
+        continue
+      records = self.records(path, compressed)
+      if records is not None:
+        parts.append(sliceRecords(records, since, until))
+    return concatenate(parts)
+
+  # Returns (times, values) of the stream's last record logged before since, or no records
+  def readBefore(self, stream, since):
+    for (sequence, segment_stream, path, compressed) in reversed(listSegments(self.log_dir)):
+      entry = self.index.get(os.path.basename(path))
+      if segment_stream != stream or not entry or entry[2] is None or entry[2] >= since:
+        continue
+      records = self.records(path, compressed)
+      if records is not None:
+        last = np.searchsorted(records['time'], since, 'left') - 1
+        return (np.array(records['time'][last:last + 1]), np.array(records['value'][last:last + 1]))
+    return EMPTY
+
+class CsvIndex(object):
+  def __init__(self, path):
+    self.path = path
+    self.index_path = "%s.index" % path
+    self.data = self.update()
+
+  # Returns the index of the csv file, extending the cached one if the file has grown since it was made
+  def update(self):
+    size = os.path.getsize(self.path)
+    index = readJson(self.index_path)
+    with open(self.path, 'rb') as f:
+      head = f.read(64)
+    if not index or index.get('version') != INDEX_VERSION or index['head'] != head.encode("hex") or index['size'] > size:
+      index = { 'version': INDEX_VERSION, 'head': head.encode("hex"), 'size': 0, 'lines': 0,
+                'times': [], 'offsets': [], 'sessions': [] }
+
+    if index['size'] < size:
+      with open(self.path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          self.extend(index, m, size)
+        finally:
+          m.close()
+      writeJson(self.index_path, index)
+    return index
+
+  # Indexes the complete lines from index['size'] up to size
+  def extend(self, index, m, size):
+    position = index['size']
+    while position < size:
+      chunk = m[position:min(size, position + CSV_INDEX_CHUNK)]
+      end = chunk.rfind("\n") + 1
+      if end == 0:
+        # no complete line left, the last line is still being written
+        break
+      chunk = chunk[:end]
+
+      newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+      starts = np.concatenate([ [ 0 ], newlines[:-1] + 1 ])
+      lines = index['lines'] + np.arange(len(starts))
+      for start in starts[lines % CSV_INDEX_LINES == 0]:
+        try:
+          t = float(chunk[start:start + 64].split("\t", 1)[0])
+        except ValueError:
+          continue
+        index['times'].append(t)
+        index['offsets'].append(position + int(start))
+
+      marker = chunk.find(SESSION_MARKER)
+      while marker >= 0:
+        start = chunk.rfind("\n", 0, marker) + 1
+        line_end = chunk.find("\n", marker) + 1
+        fields = chunk[start:line_end].rstrip("\n").split("\t")
+        try:
+          index['sessions'].append([ position + start, line_end - start, float(fields[0]), fields[3] ])
+        except (ValueError, IndexError):
+          pass
+        marker = chunk.find(SESSION_MARKER, line_end)
+
+      index['lines'] += len(starts)
+      position += end
+    index['size'] = position
+
+  # Returns the byte range of the file that holds every line logged from since until before until
+  def range(self, since, until):
+    times = self.data['times']
+    offsets = self.data['offsets']
+    first = np.searchsorted(times, since, 'left') - 1
+    end = np.searchsorted(times, until, 'left')
+    return (offsets[first] if first >= 0 else 0,
+            offsets[end] if end < len(offsets) else self.data['size'])
+
+class CsvLogs(object):
+  def __init__(self, log_dir):
+    self.paths = dict([ (stream, os.path.join(log_dir, CSV_FILES[stream])) for stream in STREAMS ])
+    self.indices = dict([ (stream, CsvIndex(path)) for (stream, path) in self.paths.items() if os.path.isfile(path) ])
+
+  def sessions(self):
+    if COMMANDED not in self.indices:
+      return []
+    return [ (uid, t) for (offset, length, t, uid) in self.indices[COMMANDED].data['sessions'] ]
+
+  def read(self, stream, since, until):
+    index = self.indices.get(stream)
+    if index is None:
+      return EMPTY
+    (times, values) = self.parseRange(stream, index, *index.range(since, until))
+    keep = (times >= since) & (times < until)
+    return (times[keep], values[keep])
+
+  # Returns (times, values) of the stream's last record logged before since, or no records
+  def readBefore(self, stream, since):
+    index = self.indices.get(stream)
+    if index is None:
+      return EMPTY
+    # the lines from the last index entry before since up to the first one at or after it
+    (times, values) = self.parseRange(stream, index, *index.range(since, since))
+    last = np.searchsorted(times, since, 'left')
+    return (times[max(last - 1, 0):last], values[max(last - 1, 0):last])
+
+  # Returns (times, values) of the "<time>\t<value>" lines between the byte offsets start and end
+  def parseRange(self, stream, index, start, end):
+    if start >= end:
+      return EMPTY
+
+    with open(self.paths[stream], 'rb') as f:
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        # Server Started lines are cut out, so the rest is all "<time>\t<value>" lines
+        pieces = []
+        position = start
+        for (offset, length, t, uid) in index.data['sessions']:
+          if start <= offset < end:
+            pieces.append(m[position:offset])
+            position = offset + length
+        pieces.append(m[position:end])
+      finally:
+        m.close()
+
+    return parseLines("".join(pieces))
+
+# Parses "<time>\t<value>" lines into (times, values). Lines that aren't, like one cut short by a power
+# loss, are skipped, but only after the fast path finds there are some.
+def parseLines(text):
+  # fromstring stops at the first thing that isn't a number, so a short result means there's a bad line
+  numbers = np.fromstring(text, dtype=float, sep=" ")
+  if len(numbers) == 2 * text.count("\n"):
+    pairs = numbers.reshape(-1, 2)
+    return (pairs[:, 0], pairs[:, 1])
+
+  times = []
+  values = []
+  for line in text.split("\n"):
+    fields = line.split("\t")
+    if len(fields) == 2:
+      try:
+        (t, value) = (float(fields[0]), float(fields[1]))
+      except ValueError:
+        continue
+      times.append(t)
+      values.append(value)
+  return (np.array(times, dtype=float), np.array(values, dtype=float))
+
+def concatenate(parts):
+  if not parts:
+    return EMPTY
+  return (np.concatenate([ times for (times, values) in parts ]), np.concatenate([ values for (times, values) in parts ]))
+
+# The logs in a directory, the CSV files followed by the store
+class SpindleLogs(object):
+  def __init__(self, log_dir=LOG_DIR):
+    self.sources = []
+    if any([ os.path.isfile(os.path.join(log_dir, name)) for name in CSV_FILES.values() ]):
+      self.sources.append(CsvLogs(log_dir))
+    if listSegments(log_dir):
+      self.sources.append(StoreLogs(log_dir))
+
+  def sessions(self):
+    return sorted(sum([ source.sessions() for source in self.sources ], []), key=lambda session: session[1])
+
+  # Returns (since, until) of the session whose uuid starts with uid. Raises KeyError if there isn't
+  # exactly one.
+  def sessionRange(self, uid):
+    sessions = self.sessions()
+    matches = [ i for (i, (session, start)) in enumerate(sessions) if session.startswith(uid) ]
+    if len(matches) != 1:
+      raise KeyError("%d sessions match %s" % (len(matches), uid))
+    i = matches[0]
+    return (sessions[i][1], sessions[i + 1][1] if i + 1 < len(sessions) else float("inf"))
+
+  # Returns (times, values) of the stream's records logged from since until before until. Commanded
+  # speeds have a 0 at the start of each session, as the "Server Started" lines of the csv files are,
+  # and start with the last one logged before since, the speed that was in effect at since.
+  def read(self, stream, since=0, until=float("inf")):
+    parts = [ source.read(stream, since, until) for source in self.sources ]
+    if stream == COMMANDED:
+      sessions = self.sessions()
+      starts = np.array([ start for (uid, start) in sessions if since <= start < until ], dtype=float)
+      parts.insert(0, (starts, np.zeros(len(starts))))
+
+      # a session starts before a record logged at the same time, so it's listed first and loses a tie
+      earlier = [ start for (uid, start) in sessions if start < since ]
+      before = [ (np.array(earlier[-1:], dtype=float), np.zeros(len(earlier[-1:]))) ]
+      (times, values) = concatenate(before + [ source.readBefore(stream, since) for source in self.sources ])
+      if len(times):
+        last = len(times) - 1 - np.argmax(times[::-1])
+        parts.insert(0, (times[last:last + 1], values[last:last + 1]))
+    (times, values) = concatenate(parts)
+    order = np.argsort(times, kind="mergesort")
+    return (times[order], values[order])
+
+# Returns the commanded speed in effect at each of times, how long it had been in effect and the index
+# of its commanded record, -1 before the first
+def commandedAt(commandedTimes, commandedValues, times):
+  index = np.searchsorted(commandedTimes, times, side="right") - 1
+  valid = index >= 0
+  clipped = np.maximum(index, 0)
+  commanded = np.where(valid, commandedValues[clipped] if len(commandedValues) else 0.0, 0.0)
+  age = np.where(valid, times - commandedTimes[clipped] if len(commandedTimes) else 0.0, 0.0)
+  return (commanded, age, index)
+
+def percentiles(values, ps):
+  if not len(values):
+    return [ float("nan") ] * len(ps)
+  return [ float(np.percentile(values, p)) for p in ps ]
+
+# Returns a dict of measured vs commanded speed statistics, for settled samples while the spindle was on
+def speedError(commanded, measured, settle=DEFAULT_SETTLE):
+  (target, age, index) = commandedAt(commanded[0], commanded[1], measured[0])
+  used = (age >= settle) & (target > 0)
+  error = measured[1][used] - target[used]
+  percent = 100 * np.abs(error) / target[used]
+  (p50, p95) = percentiles(percent, [ 50, 95 ])
+  return { 'samples': int(used.sum()),
+           'mean_error_rpm': float(error.mean()) if len(error) else float("nan"),
+           'mean_abs_error_rpm': float(np.abs(error).mean()) if len(error) else float("nan"),
+           'p50_abs_error_percent': p50,
+           'p95_abs_error_percent': p95 }
+
+# Returns a dict of the times from each speed change from since on to the spindle reaching it
+def settleTimes(commanded, measured, tolerance=DEFAULT_TOLERANCE, since=0):
+  (times, values) = commanded
+  changed = np.flatnonzero((values != np.concatenate([ [ np.nan ], values[:-1] ])) & (values > 0) & (times >= since))
+
+  (target, age, index) = commandedAt(times, values, measured[0])
+  within = (target > 0) & (np.abs(measured[1] - target) <= tolerance * np.abs(target))
+  # measured samples are in time order, so the first of each index is the first to be within tolerance
+  (reached, first) = np.unique(index[within], return_index=True)
+  settled = np.in1d(reached, changed)
+  settle = age[within][first][settled]
+
+  (p50, p95) = percentiles(settle, [ 50, 95 ])
+  return { 'changes': len(changed),
+           'settled': len(settle),
+           'p50_seconds': p50,
+           'p95_seconds': p95,
+           'max_seconds': float(settle.max()) if len(settle) else float("nan") }
+
+# Returns a list of (band start rpm, hours) for each band with any time in it from since on, and the
+# hours the spindle was commanded off
+def hoursByBand(commanded, measured, sessions, band_width=DEFAULT_BAND_WIDTH, since=0):
+  (times, values) = commanded
+  if not len(times):
+    return ([], 0.0)
+
+  # a speed lasts until the next change or the last thing logged in its session, both streams are in
+  # time order, so that's the later of their last records before the next session starts
+  starts = np.array([ start for (uid, start) in sessions ], dtype=float)
+  boundaries = np.concatenate([ starts, [ np.inf ] ])
+  lastLogged = np.full(len(boundaries), -np.inf)
+  for stream_times in [ times, measured[0] ]:
+    if len(stream_times):
+      last = np.searchsorted(stream_times, boundaries, 'left') - 1
+      lastLogged = np.maximum(lastLogged, np.where(last >= 0, stream_times[np.maximum(last, 0)], -np.inf))
+  sessionEnds = lastLogged[np.searchsorted(starts, times, 'right')]
+
+  ends = np.minimum(np.concatenate([ times[1:], [ np.inf ] ]), sessionEnds)
+  # the speed in effect at since is only counted from since
+  hours = np.maximum(ends - np.maximum(times, since), 0) / 3600.0
+
+  on = values > 0
+  bands = np.floor(values[on] / band_width).astype(int)
+  totals = np.bincount(bands, weights=hours[on]) if len(bands) else np.zeros(0)
+  return ([ (band * band_width, float(total)) for (band, total) in enumerate(totals) if total > 0 ], float(hours[~on].sum()))
+
+def parseTime(value):
+  try:
+    return float(value)
+  except ValueError:
+    pass
+  for format in [ "%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S" ]:
+    try:
+      return time.mktime(datetime.datetime.strptime(value, format).timetuple())
+    except ValueError:
+      pass
+  raise argparse.ArgumentTypeError("%s isn't a unix time or YYYY-MM-DD[THH:MM[:SS]]" % value)
+
+STATISTICS = [ "error", "settle", "hours" ]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Query the spindle logs")
+  parser.add_argument("--logs", default=LOG_DIR, help="directory of the spindle logs")
+  parser.add_argument("--since", type=parseTime, default=0, help="start of the time range")
+  parser.add_argument("--until", type=parseTime, default=float("inf"), help="end of the time range")
+  parser.add_argument("--session", help="only the session with this uuid, or the start of it")
+  parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE, help="seconds after a speed change before measured samples count towards the error")
+  parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="fraction of the commanded speed the spindle is settled within")
+  parser.add_argument("--band-width", type=float, default=DEFAULT_BAND_WIDTH, help="width of the RPM bands of the hours statistic")
+  parser.add_argument("statistics", nargs="*", help="statistics to print, %s, all of them by default" % ", ".join(STATISTICS))
+  args = parser.parse_args()
+
+  for statistic in args.statistics:
+    if statistic not in STATISTICS:
+      parser.error("unknown statistic %s, choose from %s" % (statistic, ", ".join(STATISTICS)))
+  statistics = args.statistics or STATISTICS
+
+  start = time.time()
+  logs = SpindleLogs(args.logs)
+  (since, until) = (args.since, args.until)
+  if args.session:
+    try:
+      (sessionSince, sessionUntil) = logs.sessionRange(args.session)
+    except KeyError as e:
+      sys.stderr.write("%s\n" % e.args[0])
+      sys.exit(1)
+    (since, until) = (max(since, sessionSince), min(until, sessionUntil))
+
+  commanded = logs.read(COMMANDED, since, until)
+  measured = logs.read(MEASURED, since, until)
+  print "%d commanded and %d measured samples" % (len(commanded[0]), len(measured[0]))
+
+  if "error" in statistics:
+    print
+    print "Measured vs commanded speed"
+    for (name, value) in sorted(speedError(commanded, measured, args.settle).items()):
+      print "  %-24s %s" % (name, value)
+
+  if "settle" in statistics:
+    print
+    print "Settle time after speed changes"
+    for (name, value) in sorted(settleTimes(commanded, measured, args.tolerance, since).items()):
+      print "  %-24s %s" % (name, value)
+
+  if "hours" in statistics:
+    sessions = [ session for session in logs.sessions() if since <= session[1] < until ]
+    (bands, off) = hoursByBand(commanded, measured, sessions, args.band_width, since)
+    print
+    print "Hours at each commanded speed"
+    for (band, hours) in bands:
+      print "  %6d-%-6d rpm %10.2f" % (band, band + args.band_width, hours)
+    print "  %-15s %10.2f" % ("off", off)
+
+  print
+  print "Query took %.3fs" % (time.time() - start)
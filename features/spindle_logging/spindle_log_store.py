@@ -0,0 +1,420 @@
+#!/usr/bin/python
+
+# spindle_log_store.py
+# Storage for spindle_logging's commanded and measured speeds, bounded in size so it can run for months on
+# the SD card.
+#
+# Each stream is stored as fixed width binary records, RECORD, of (time, value, session), where session
+# is the index of the "Server Started" session in the sessions file, one "<uuid>\t<start time>" line per
+# session. Records are appended to a segment file per stream, <stream>-<sequence>.seg, which starts with
+# a HEADER. Sequence numbers are shared by both streams, so they order segments by age.
+#
+# Appended records are buffered in memory and written out flush_interval seconds after the last flush,
+# or when the store is closed. A segment is closed once it reaches segment_bytes, and every process
+# start opens new segments. A background thread gzips closed segments to <stream>-<sequence>.seg.gz and
+# then deletes the oldest compressed segments while all of them add up to more than retention_bytes.
+#
+# A LogWriter owns a store and is what a sampling loop appends to. Its put never blocks or touches the
+# disk, it queues the record with its sample time for the writer thread, which appends it to the store
+# and flushes it. The queue holds at most max_records; records that don't fit are dropped and counted.
+#
+# A record cut short by a power loss is ignored when the segment is read. spindle_log_export.py
+# regenerates Commanded.csv and Measured.csv from the store.
+#
+# The Commanded.csv and Measured.csv that spindle_logging.py used to write are moved into the store the
+# first time it's opened, by migrateCsvLogs, so they count against retention_bytes and are deleted oldest
+# first like everything else. Their sessions are added to the sessions file and their records written as
+# compressed segments numbered before any existing ones, since they're older. The csv files are then deleted.
+#
+# Settings, in the [POCKETNC] section of PocketNC.ini:
+#   SPINDLE_LOG_FLUSH_INTERVAL    seconds, DEFAULT_FLUSH_INTERVAL
+#   SPINDLE_LOG_SEGMENT_BYTES     DEFAULT_SEGMENT_BYTES
+#   SPINDLE_LOG_RETENTION_BYTES   DEFAULT_RETENTION_BYTES
+#   SPINDLE_LOG_QUEUE_RECORDS     DEFAULT_QUEUE_RECORDS
+
+import Queue
+import gzip
+import os
+import re
+import shutil
+import struct
+import sys
+import threading
+import time
+import zlib
+
+LOG_DIR = "/home/pocketnc/spindle_logs"
+
+COMMANDED = "commanded"
+MEASURED = "measured"
+STREAMS = [ COMMANDED, MEASURED ]
+
+SESSIONS_FILE = "sessions"
+CSV_FILES = { COMMANDED: "Commanded.csv", MEASURED: "Measured.csv" }
+# where migrateCsvLogs writes segments before they're numbered and moved into the store
+MIGRATE_DIR = "migrating"
+
+MAGIC = "SPLG"
+FORMAT_VERSION = 1
+# magic, format version, record size, time the segment was created
+HEADER = struct.Struct("<4sHHd")
+# time, value, session index
+RECORD = struct.Struct("<ddI")
+
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_SEGMENT_BYTES = 1024 * 1024
+DEFAULT_RETENTION_BYTES = 64 * 1024 * 1024
+DEFAULT_QUEUE_RECORDS = 10000
+# How often the background thread checks for segments to compress, in case it wasn't told about one
+COMPRESS_CHECK_PERIOD = 60.0
+
+SEGMENT_RE = re.compile(r"^(%s)-(\d{8})\.seg(\.gz)?$" % "|".join(STREAMS))
+
+def segmentName(stream, sequence):
+  return "%s-%08d.seg" % (stream, sequence)
+
+# Returns a list of (sequence, stream, path, compressed) for every segment in log_dir, oldest first
+def listSegments(log_dir):
+  segments = []
+  if os.path.isdir(log_dir):
+    for name in os.listdir(log_dir):
+      match = SEGMENT_RE.match(name)
+      if match:
+        segments.append((int(match.group(2)), match.group(1), os.path.join(log_dir, name), match.group(3) is not None))
+  return sorted(segments)
+
+# Returns a list of (uuid, start time), indexed by session
+def readSessions(log_dir):
+  sessions = []
+  path = os.path.join(log_dir, SESSIONS_FILE)
+  if os.path.isfile(path):
+    with open(path, 'r') as f:
+      for line in f:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) == 2:
+          try:
+            sessions.append((fields[0], float(fields[1])))
+            continue
+          except ValueError:
+            pass
+        # keep the indices of the sessions after a bad line
+        sessions.append((None, None))
+  return sessions
+
+# Returns the created time in the HEADER at the start of data, read from path. Raises ValueError if it
+# isn't a segment's header.
+def readHeader(data, path):
+  if len(data) < HEADER.size:
+    raise ValueError("%s is too short to be a spindle log segment" % path)
+  (magic, version, record_size, created) = HEADER.unpack_from(data)
+  if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+    raise ValueError("%s isn't a version %d spindle log segment" % (path, FORMAT_VERSION))
+  return created
+
+# Returns (created, records) of a segment, compressed or not, where records is a string of whole RECORDs.
+# Raises ValueError if the segment isn't one.
+def readSegment(path):
+  with open(path, 'rb') as f:
+    data = f.read()
+  if path.endswith(".gz"):
+    data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+  created = readHeader(data, path)
+  end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size
+  return (created, data[HEADER.size:end])
+
+# Yields (time, value, session) for each record in records, as returned by readSegment
+def iterRecords(records):
+  for offset in xrange(0, len(records), RECORD.size):
+    yield RECORD.unpack_from(records, offset)
+
+class Segment(object):
+  def __init__(self, path):
+    self.path = path
+    self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.write(self.fd, HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, time.time()))
+    self.size = HEADER.size
+
+  def write(self, data):
+    os.write(self.fd, data)
+    self.size += len(data)
+
+  def close(self):
+    os.close(self.fd)
+
+class LogStore(object):
+  def __init__(self, log_dir=LOG_DIR, flush_interval=DEFAULT_FLUSH_INTERVAL,
+               segment_bytes=DEFAULT_SEGMENT_BYTES, retention_bytes=DEFAULT_RETENTION_BYTES):
+    self.log_dir = log_dir
+    self.flush_interval = flush_interval
+    self.segment_bytes = segment_bytes
+    self.retention_bytes = retention_bytes
+
+    if not os.path.isdir(log_dir):
+      os.makedirs(log_dir)
+
+    try:
+      migrateCsvLogs(log_dir, segment_bytes)
+    except (IOError, OSError) as e:
+      sys.stderr.write("Error moving the spindle log csv files into the store: %s\n" % e)
+
+    segments = listSegments(log_dir)
+    self.sequence = segments[-1][0] + 1 if segments else 0
+    self.session = len(readSessions(log_dir))
+
+    self.pending = dict([ (stream, []) for stream in STREAMS ])
+    self.segments = {}
+    self.lastFlush = time.time()
+
+    # guards self.segments against the compressor, which mustn't touch an open segment
+    self.lock = threading.Lock()
+    self.compress = threading.Event()
+    self.compressor = threading.Thread(target=self.compressSegments, name="spindle log compressor")
+    self.compressor.daemon = True
+    self.compressor.start()
+
+  # Records the start of a session, whose index is stored with every record appended after it
+  def startSession(self, uid, t):
+    with open(os.path.join(self.log_dir, SESSIONS_FILE), 'a') as f:
+      f.write("%s\t%r\n" % (uid, t))
+    self.session = len(readSessions(self.log_dir)) - 1
+
+  def append(self, stream, t, value):
+    self.pending[stream].append(RECORD.pack(t, value, self.session))
+    if t - self.lastFlush >= self.flush_interval:
+      self.flush()
+
+  # Writes out the buffered records. Errors, like a full SD card, are reported and the records dropped,
+  # so they don't pile up in memory.
+  def flush(self):
+    self.lastFlush = time.time()
+    for stream in STREAMS:
+      pending = self.pending[stream]
+      if not pending:
+        continue
+      self.pending[stream] = []
+
+      try:
+        segment = self.segments.get(stream)
+        if segment is None:
+          segment = self.openSegment(stream)
+        segment.write("".join(pending))
+        if segment.size >= self.segment_bytes:
+          self.closeSegment(stream)
+      except (IOError, OSError) as e:
+        sys.stderr.write("Error writing %d spindle log records to %s: %s\n" % (len(pending), stream, e))
+
+  def openSegment(self, stream):
+    with self.lock:
+      segment = Segment(os.path.join(self.log_dir, segmentName(stream, self.sequence)))
+      self.sequence += 1
+      self.segments[stream] = segment
+    return segment
+
+  def closeSegment(self, stream):
+    with self.lock:
+      self.segments.pop(stream).close()
+    self.compress.set()
+
+  # Flushes and closes the open segments. They're compressed by the next process to use the store.
+  def close(self):
+    self.flush()
+    for stream in self.segments.keys():
+      with self.lock:
+        self.segments.pop(stream).close()
+
+  def compressSegments(self):
+    while True:
+      try:
+        segments = listSegments(self.log_dir)
+        with self.lock:
+          open_paths = [ segment.path for segment in self.segments.values() ]
+        for (sequence, stream, path, compressed) in segments:
+          if not compressed and path not in open_paths:
+            compressSegment(path)
+        enforceRetention(self.log_dir, self.retention_bytes)
+      except (IOError, OSError) as e:
+        sys.stderr.write("Error compressing spindle log segments: %s\n" % e)
+
+      self.compress.wait(COMPRESS_CHECK_PERIOD)
+      self.compress.clear()
+
+# Replaces a closed segment with its gzipped copy
+def compressSegment(path):
+  tmp_path = "%s.gz.tmp" % path
+  with open(path, 'rb') as src:
+    dst = gzip.open(tmp_path, 'wb')
+    try:
+      shutil.copyfileobj(src, dst)
+    finally:
+      dst.close()
+  os.rename(tmp_path, "%s.gz" % path)
+  os.remove(path)
+
+# Writes a compressed segment of records, a list of packed RECORDs, created at the time of the first
+def writeCompressedSegment(path, records):
+  f = gzip.open(path, 'wb')
+  try:
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, RECORD.unpack(records[0])[0]))
+    f.write("".join(records))
+  finally:
+    f.close()
+
+# Moves Commanded.csv and Measured.csv in log_dir, if there are any, into the store as compressed segments
+# of up to segment_bytes, numbered before the existing segments, and deletes them. A line that isn't a
+# "<time>\t0\tServer Started\t<uuid>" session start or a "<time>\t<rpm>" record, like one cut short by a
+# power loss, is skipped. Records before the first session start in a file are stored with session 0.
+#
+# Segments are written to MIGRATE_DIR first, so a failure while reading the csv files or writing the
+# segments leaves the store as it was, and is tried again next time. Sessions already in the sessions file
+# aren't added again.
+def migrateCsvLogs(log_dir, segment_bytes):
+  csv_paths = [ (stream, os.path.join(log_dir, CSV_FILES[stream])) for stream in STREAMS ]
+  csv_paths = [ (stream, path) for (stream, path) in csv_paths if os.path.isfile(path) ]
+  if not csv_paths:
+    return
+
+  migrate_dir = os.path.join(log_dir, MIGRATE_DIR)
+  if os.path.isdir(migrate_dir):
+    shutil.rmtree(migrate_dir)
+  os.makedirs(migrate_dir)
+
+  sessions = readSessions(log_dir)
+  indices = dict([ (uid, i) for (i, (uid, start)) in enumerate(sessions) if uid is not None ])
+  newSessions = []
+  # (time of the first record, stream, path) of each segment written to migrate_dir
+  migrated = []
+
+  def writeMigrated(stream, records):
+    path = os.path.join(migrate_dir, "%s-%d.seg.gz" % (stream, len(migrated)))
+    writeCompressedSegment(path, records)
+    migrated.append((RECORD.unpack(records[0])[0], stream, path))
+
+  max_records = max(1, (segment_bytes - HEADER.size) // RECORD.size)
+  for (stream, path) in csv_paths:
+    session = 0
+    records = []
+    with open(path, 'r') as f:
+      for line in f:
+        fields = line.rstrip("\n").split("\t")
+        try:
+          if len(fields) == 4 and fields[2] == "Server Started":
+            (t, uid) = (float(fields[0]), fields[3])
+            if uid not in indices:
+              indices[uid] = len(sessions) + len(newSessions)
+              newSessions.append((uid, t))
+            session = indices[uid]
+          elif len(fields) == 2:
+            records.append(RECORD.pack(float(fields[0]), float(fields[1]), session))
+        except ValueError:
+          continue
+
+        if len(records) >= max_records:
+          writeMigrated(stream, records)
+          records = []
+    if records:
+      writeMigrated(stream, records)
+
+  if newSessions:
+    with open(os.path.join(log_dir, SESSIONS_FILE), 'a') as f:
+      for (uid, t) in newSessions:
+        f.write("%s\t%r\n" % (uid, t))
+
+  # make room for the migrated segments at the start of the sequence, newest first so no names collide
+  count = len(migrated)
+  for (sequence, stream, path, compressed) in reversed(listSegments(log_dir)):
+    os.rename(path, os.path.join(log_dir, segmentName(stream, sequence + count) + (".gz" if compressed else "")))
+  for (sequence, (first, stream, path)) in enumerate(sorted(migrated)):
+    os.rename(path, os.path.join(log_dir, segmentName(stream, sequence) + ".gz"))
+
+  for (stream, path) in csv_paths:
+    os.remove(path)
+    # and the index spindle_log_query.py keeps of it
+    if os.path.isfile("%s.index" % path):
+      os.remove("%s.index" % path)
+  shutil.rmtree(migrate_dir)
+  sys.stderr.write("Moved %s into the spindle log store as %d segments\n" % (" and ".join([ CSV_FILES[stream] for (stream, path) in csv_paths ]), count))
+
+# Deletes the oldest compressed segments while all segments add up to more than retention_bytes. Open
+# segments are never compressed, so they're never deleted.
+def enforceRetention(log_dir, retention_bytes):
+  segments = [ (path, os.path.getsize(path), compressed) for (sequence, stream, path, compressed) in listSegments(log_dir) ]
+  total = sum([ size for (path, size, compressed) in segments ])
+  for (path, size, compressed) in segments:
+    if total <= retention_bytes:
+      break
+    if compressed:
+      os.remove(path)
+      total -= size
+
+class LogWriter(threading.Thread):
+  # echo, if given, is called from the writer thread with (stream, line) for each record, in the format
+  # of the csv files
+  def __init__(self, store, max_records=DEFAULT_QUEUE_RECORDS, echo=None):
+    threading.Thread.__init__(self, name="spindle log writer")
+    self.daemon = True
+    self.store = store
+    self.echo = echo
+    self.queue = Queue.Queue(max_records)
+    self.dropped = 0
+
+  def startSession(self, uid, t):
+    self.put(("session", uid, t))
+
+  def append(self, stream, t, value):
+    self.put((stream, t, value))
+
+  def put(self, item):
+    try:
+      self.queue.put_nowait(item)
+    except Queue.Full:
+      self.dropped += 1
+
+  def run(self):
+    store = self.store
+    while True:
+      try:
+        item = self.queue.get(timeout=max(0, store.lastFlush + store.flush_interval - time.time()))
+      except Queue.Empty:
+        store.flush()
+        continue
+      if item is None:
+        break
+
+      try:
+        if item[0] == "session":
+          (kind, uid, t) = item
+          store.startSession(uid, t)
+          if self.echo:
+            for stream in STREAMS:
+              self.echo(stream, "%s\t0\tServer Started\t%s" % (t, uid))
+        else:
+          (stream, t, value) = item
+          store.append(stream, t, value)
+          if self.echo:
+            self.echo(stream, "%s\t%s" % (t, value))
+      except (IOError, OSError) as e:
+        sys.stderr.write("Error logging spindle speed: %s\n" % e)
+    store.close()
+
+  # Writes out everything queued so far and closes the store
+  def close(self):
+    self.queue.put(None)
+    self.join()
+
+# Returns a LogStore configured by PocketNC.ini's values
+def openLogStore(iniValues, log_dir=LOG_DIR):
+  from ini_snapshot import getValue
+  return LogStore(log_dir,
+                  flush_interval=float(getValue(iniValues, "POCKETNC", "SPINDLE_LOG_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)),
+                  segment_bytes=int(getValue(iniValues, "POCKETNC", "SPINDLE_LOG_SEGMENT_BYTES", DEFAULT_SEGMENT_BYTES)),
+                  retention_bytes=int(getValue(iniValues, "POCKETNC", "SPINDLE_LOG_RETENTION_BYTES", DEFAULT_RETENTION_BYTES)))
+
+# Returns a started LogWriter of a LogStore, both configured by PocketNC.ini's values
+def openLogWriter(iniValues, log_dir=LOG_DIR, echo=None):
+  from ini_snapshot import getValue
+  writer = LogWriter(openLogStore(iniValues, log_dir),
+                     max_records=int(getValue(iniValues, "POCKETNC", "SPINDLE_LOG_QUEUE_RECORDS", DEFAULT_QUEUE_RECORDS)),
+                     echo=echo)
+  writer.start()
+  return writer
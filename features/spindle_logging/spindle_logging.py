@@ -1,45 +1,68 @@
 #!/usr/bin/python
 
+# spindle_logging.py
+# Logs the commanded spindle speed whenever it changes, and the measured speed after each change and
+# once a minute, to the spindle log store in /home/pocketnc/spindle_logs (see spindle_log_store.py).
+# spindle_log_export.py regenerates the Commanded.csv and Measured.csv this used to write, and the first
+# start after an upgrade moves the old ones into the store (see migrateCsvLogs).
+#
+# The sampling loop only queues each record, with the time it was sampled, for a writer thread (see
+# LogWriter), so a slow SD card or blocked output never delays a sample. Records that don't fit in the
+# queue are dropped and counted on the dropped pin. Each record is also echoed to stderr, as it was
+# before the log store, only when [POCKETNC]SPINDLE_LOG_ECHO=1.
+
 import hal
 import time
 import logging
 import logging.config
 import uuid
 import os
+import signal
+import sys
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+INI_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/PocketNC.ini")
+
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Settings"))
+from ini_snapshot import readIniValues, getValue
+from spindle_log_store import openLogWriter, COMMANDED, MEASURED
 
 h = hal.component("spindle_logging")
 h.newpin("speed_in", hal.HAL_FLOAT, hal.HAL_IN)
 h.newpin("speed_measured", hal.HAL_FLOAT, hal.HAL_IN)
+h.newpin("dropped", hal.HAL_U32, hal.HAL_OUT)
 h.ready()
 
-def ConfigureLogger(name, file):
+def ConfigureLogger(name):
   logger = logging.getLogger(name)
-  formatter = logging.Formatter("%(message)s")
-  fileHandler = logging.FileHandler(file, mode='a')
-  fileHandler.setFormatter(formatter)
   streamFormatter = logging.Formatter("%(name)s %(message)s")
   streamHandler = logging.StreamHandler()
   streamHandler.setFormatter(streamFormatter)
   logger.setLevel(logging.INFO)
-  logger.addHandler(fileHandler)
   logger.addHandler(streamHandler)
 
 commandedName = "CommandedSpindle"
 measuredName = "MeasuredSpindle"
 uid = uuid.uuid4()
 
-if not os.path.isdir("/home/pocketnc/spindle_logs"):
-  os.mkdir("/home/pocketnc/spindle_logs")
+iniValues = readIniValues(INI_FILE)
 
-ConfigureLogger(commandedName, "/home/pocketnc/spindle_logs/Commanded.csv")
-ConfigureLogger(measuredName, "/home/pocketnc/spindle_logs/Measured.csv")
+echo = None
+if int(getValue(iniValues, "POCKETNC", "SPINDLE_LOG_ECHO", 0)):
+  ConfigureLogger(commandedName)
+  ConfigureLogger(measuredName)
+  loggers = { COMMANDED: logging.getLogger(commandedName), MEASURED: logging.getLogger(measuredName) }
+  echo = lambda stream, line: loggers[stream].info(line)
 
-commandedLogger = logging.getLogger(commandedName)
-measuredLogger  = logging.getLogger(measuredName)
+writer = openLogWriter(iniValues, echo=echo)
+
+# LinuxCNC stops userspace components with SIGTERM, the queued records are written out on the way out
+def stop(signum, frame):
+  raise SystemExit
+signal.signal(signal.SIGTERM, stop)
 
 lastMeasurementTime = time.time()
-commandedLogger.info("%s\t0\tServer Started\t%s" % (lastMeasurementTime,uid))
-measuredLogger.info("%s\t0\tServer Started\t%s" % (lastMeasurementTime,uid))
+writer.startSession(uid, lastMeasurementTime)
 
 measurements = 0
 lastRPM = 0
@@ -48,13 +71,14 @@ try:
   while True:
     if h['speed_in'] != lastRPM:
       currentRPM = h['speed_in']
-      commandedLogger.info("%s\t%s" % (time.time(), lastRPM))
-      commandedLogger.info("%s\t%s" % (time.time(), currentRPM))
+      writer.append(COMMANDED, time.time(), lastRPM)
+      writer.append(COMMANDED, time.time(), currentRPM)
       measurements = 10
 
       lastRPM = currentRPM
 
     time.sleep(.1)
+    h['dropped'] = writer.dropped & 0xFFFFFFFF
 
     now = time.time()
     if now-lastMeasurementTime > 60:
@@ -63,10 +87,11 @@ try:
     if now-lastMeasurementTime > 1:
       if measurements > 0:
         rpmMeasured = h['speed_measured']
-        measuredLogger.info("%s\t%s" % (now, rpmMeasured))
+        writer.append(MEASURED, now, rpmMeasured)
         measurements -= 1
         lastMeasurementTime = now
 
 except KeyboardInterrupt:
   raise SystemExit
-
+finally:
+  writer.close()
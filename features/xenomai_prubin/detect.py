@@ -0,0 +1,6 @@
+import os
+
+def detect():
+  if os.path.isfile("/usr/lib/linuxcnc/xenomai/pru_generic.bin"):
+    return 1
+  return 0
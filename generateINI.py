@@ -1,99 +1,132 @@
 #!/usr/bin/python 
 
-from copy import deepcopy
 import os
-import re
-import pprint
 import sys
 from version import getVersion
-import subprocess
-
-POCKETNC_DIRECTORY = "/home/pocketnc/pocketnc"
+import argparse
+from feature_detection import DEFAULT_DETECT_TIMEOUT, DEFAULT_DETECT_WORKERS
+import feature_registry
+from feature_registry import FeatureRegistry
+import ini_merge
+from ini_merge import mergeLayers, featureFlagLayer, MERGE, APPEND
+from ini_manifest import buildManifest, isUpToDate, writeManifest, writeIfChanged
+import ini_snapshot
+from ini_snapshot import loadSnapshot, writeSnapshot
+from startup_scheduler import runStartupScripts, DEFAULT_STARTUP_WORKERS
+from startup_timing import PhaseTimer, formatReport, DEFAULT_HISTORY
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
 VERSION = getVersion()
 
 sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
-from ini import read_ini_data, merge_ini_data, write_ini_data, append_ini_data
+import ini
+from ini import read_ini_data, write_ini_data
 
 INI_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/PocketNC.ini")
 INI_DEFAULT_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/versions/%s/PocketNC.ini" % VERSION)
 CALIBRATION_OVERLAY_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/CalibrationOverlay.inc")
 FEATURES_DIR = os.path.join(POCKETNC_DIRECTORY, "Settings/features")
+DETECTION_CACHE_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/feature_detection_cache.json")
+INI_MANIFEST_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/PocketNC.ini.manifest")
+TIMING_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/startup_timing.json")
+
+# Returns the path of a module's source, even when it was loaded from a .pyc
+def sourcePath(module):
+  return os.path.abspath(module.__file__).replace(".pyc", ".py")
+
+def timedRead(timer, path):
+  with timer.phase("read %s" % os.path.relpath(path, os.path.join(POCKETNC_DIRECTORY, "Settings"))):
+    return read_ini_data(path)
 
 if __name__ == "__main__":
-  defaults = read_ini_data(INI_DEFAULT_FILE)
+  timer = PhaseTimer()
 
-  if os.path.isfile(CALIBRATION_OVERLAY_FILE):
-    overlay = read_ini_data(CALIBRATION_OVERLAY_FILE)
-  else:
-    overlay = { 'parameters': [],
-                'sections': {} }
+  parser = argparse.ArgumentParser(description="Generate PocketNC.ini from the machine version defaults, detected features and the calibration overlay.")
+  parser.add_argument("--detect-timeout", type=float, default=DEFAULT_DETECT_TIMEOUT, help="seconds to wait for each feature's detect script before treating it as not detected")
+  parser.add_argument("--detect-workers", type=int, default=DEFAULT_DETECT_WORKERS, help="maximum number of detect scripts to run at once")
+  parser.add_argument("--no-cache", action="store_true", help="ignore cached detection results and run every detect script")
+  parser.add_argument("--verify", action="store_true", help="run every detect script and report cached detection results that were wrong")
+  parser.add_argument("--startup-workers", type=int, default=DEFAULT_STARTUP_WORKERS, help="maximum number of feature startup scripts to run at once")
+  parser.add_argument("--force", action="store_true", help="generate PocketNC.ini even if none of its inputs changed")
+  parser.add_argument("--timing-history", type=int, default=DEFAULT_HISTORY, help="number of boots to keep in %s" % os.path.basename(TIMING_FILE))
+  parser.add_argument("--timing-summary", action="store_true", help="print how long each phase took")
+  args = parser.parse_args()
 
-  merged = merge_ini_data(defaults, overlay)
+  registry = FeatureRegistry(FEATURES_DIR, CALIBRATION_OVERLAY_FILE, DETECTION_CACHE_FILE)
 
-  features = set()
+  with timer.phase("read %s" % os.path.basename(CALIBRATION_OVERLAY_FILE)):
+    overlay = registry.overlay()
 
   # Auto detected features
-  for feature in os.listdir(FEATURES_DIR):
-    feature_path = os.path.join(FEATURES_DIR, feature)
-    detect_path = os.path.join(feature_path, "detect")
-
-    if os.path.isfile(detect_path):
-      detected = subprocess.check_output(detect_path).strip()
-      if detected == "1":
-        print "Detected feature, %s" % feature
-        features.add(feature)
-
-  # Manually enabled/disabled features
-  for param in overlay['parameters']:
-    section = param['values']['section']
-    name = param['values']['name']
-    value = param['values']['value']
-
-    if section == "POCKETNC_FEATURES":
-      feature = name.lower()
-      if value == "1":
-        features.add(feature)
-      elif value == "0" and feature in features:
-        features.remove(feature)
-        
-
+  with timer.phase("detect"):
+    detected = registry.detected(timeout=args.detect_timeout, workers=args.detect_workers,
+                                 use_cache=not args.no_cache, verify=args.verify, timer=timer)
+  for feature in sorted(detected):
+    if detected[feature]:
+      print "Detected feature, %s" % feature
+
+  # Manually enabled/disabled features are applied by the registry
+  features = registry.active()
+
+  # Startup scripts are all finished before any overlay.inc or append.inc is read, since they could be generated by the scripts.
+  # The active features are passed to them in the POCKETNC_FEATURES environment variable, separated by commas.
+  startups = dict([ (feature, registry.hook(feature, "startup")) for feature in features if registry.hook(feature, "startup") ])
+  startupEnv = dict(os.environ, POCKETNC_FEATURES=",".join(features))
+  with timer.phase("startup"):
+    runStartupScripts(FEATURES_DIR, startups, workers=args.startup_workers, timer=timer, env=startupEnv)
+
+  # Besides the INI files, PocketNC.ini depends on the code that reads, merges and writes them
+  input_paths = [ INI_DEFAULT_FILE, CALIBRATION_OVERLAY_FILE, os.path.abspath(__file__) ]
+  input_paths.extend([ sourcePath(module) for module in [ ini, ini_merge, feature_registry, ini_snapshot ] ])
   for feature in features:
-    dir = os.path.join(FEATURES_DIR, feature)
-
-    feature_overlay_path = os.path.join(dir, "overlay.inc")
-    feature_append_path = os.path.join(dir, "append.inc")
-    feature_startup_path = os.path.join(dir, "startup")
-
-    if os.path.isfile(feature_startup_path):
-      # executed first so overlay.inc and/or append.inc could be generated by the script
-      subprocess.check_output(feature_startup_path);
-
-    if os.path.isfile(feature_overlay_path):
-      feature_overlay = read_ini_data(feature_overlay_path)
-      merged = merge_ini_data(merged, feature_overlay)
-
-    if os.path.isfile(feature_append_path):
-      feature_append = read_ini_data(feature_append_path)
-      merged = append_ini_data(merged, feature_append)
-
-    merged = merge_ini_data(merged, {
-      'parameters': [
-        {
-            'values': {
-                'section': 'POCKETNC_FEATURES',
-                'name': feature.upper(),
-                'value': "1",
-                'comment': '',
-                'help': '',
-                'default': ''
-            }
-        }
-      ],
-      'sections': {
-          'POCKETNC_FEATURES': { 'comment': '', 'help': '' }
-      }
-    });
-
-  merged = merge_ini_data(merged, overlay)
-
-  write_ini_data(merged, INI_FILE);
+    input_paths.append(os.path.join(FEATURES_DIR, feature, "overlay.inc"))
+    input_paths.append(os.path.join(FEATURES_DIR, feature, "append.inc"))
+
+  with timer.phase("manifest"):
+    manifest = buildManifest(input_paths, features)
+    upToDate = not args.force and isUpToDate(INI_MANIFEST_FILE, manifest, INI_FILE)
+
+  if upToDate:
+    print "PocketNC.ini is up to date"
+
+    if loadSnapshot(INI_FILE) is None:
+      with timer.phase("snapshot"):
+        writeSnapshot(read_ini_data(INI_FILE), INI_FILE)
+  else:
+    defaults = timedRead(timer, INI_DEFAULT_FILE)
+    layers = [ (MERGE, overlay) ]
+
+    # Features are applied in sorted order so the generated INI doesn't depend on directory listing order
+    for feature in features:
+      feature_overlay_path = registry.hook(feature, "overlay.inc")
+      feature_append_path = registry.hook(feature, "append.inc")
+
+      if feature_overlay_path:
+        layers.append((MERGE, timedRead(timer, feature_overlay_path)))
+
+      if feature_append_path:
+        layers.append((APPEND, timedRead(timer, feature_append_path)))
+
+      layers.append((MERGE, featureFlagLayer(feature)))
+
+    # The calibration overlay is applied again last so it takes precedence over feature overlays
+    layers.append((MERGE, overlay))
+
+    with timer.phase("merge"):
+      merged = mergeLayers(defaults, layers)
+
+    with timer.phase("write"):
+      if writeIfChanged(INI_FILE, lambda path: write_ini_data(merged, path)):
+        print "Wrote PocketNC.ini"
+      else:
+        print "PocketNC.ini is unchanged"
+
+      writeManifest(INI_MANIFEST_FILE, manifest, INI_FILE)
+
+    with timer.phase("snapshot"):
+      if loadSnapshot(INI_FILE) is None:
+        writeSnapshot(merged, INI_FILE)
+
+  timer.writeReport(TIMING_FILE, args.timing_history)
+  if args.timing_summary:
+    print formatReport(timer.report())
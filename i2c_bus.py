@@ -0,0 +1,478 @@
+#!/usr/bin/python
+
+# i2c_bus.py
+# Shared access to the I2C bus used by the userspace components (the spindle DAC at 0x60, the high speed
+# spindle's MPRLS at 0x18 and MCP9808 at 0x19) and the scripts that probe it (detect_hss_mprls.py at 0x18
+# and version.py at 0x50).
+#
+# A BusManager owns the bus through a single file descriptor and serializes transactions on it, so
+# threads and processes never interleave their reads and writes. It also counts transactions, errors and
+# latency for each device. Each transaction is a write followed by a read, done as one I2C_RDWR ioctl with
+# a repeated start between them. Batches of transactions are run back to back without releasing the bus.
+#
+# While LinuxCNC is running, the bus is owned by the i2c_bus HAL component (./i2c_bus.py serve --hal,
+# loaded from PocketNC.hal), which takes requests from the other processes over a unix socket. getBus
+# returns a client of that server if it's running, otherwise a BusManager private to the process.
+#
+# Device wraps a bus with the register access methods of Adafruit_GPIO's I2C.Device, so components need
+# no Adafruit_GPIO/Adafruit_I2C fallbacks. Errors are raised as IOErrors rather than printed to stdout.
+#
+# FakeBus stands in for the hardware, with devices implemented in python, so all of this can be run on
+# any Linux box:
+#   ./i2c_bus.py serve [--bus N] [--socket PATH] [--hal] [--fake]
+#   ./i2c_bus.py stats [--bus N] [--socket PATH]
+#   ./i2c_bus.py selftest
+
+import argparse
+import ctypes
+import errno
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+
+# Linux kernels before 4.x number the bus on P9.19 and P9.20 1 rather than 2
+def defaultBusNumber():
+  if os.path.exists("/dev/i2c-2") or not os.path.exists("/dev/i2c-1"):
+    return 2
+  return 1
+
+# Seconds to wait for the bus server to answer a request before giving up on it
+REQUEST_TIMEOUT = 1.0
+# Seconds between attempts to connect to the bus server by a process that fell back to its own BusManager
+CLIENT_RETRY_PERIOD = 5.0
+
+def socketPath(bus_number):
+  return os.environ.get("POCKETNC_I2C_SOCKET", "/tmp/pocketnc-i2c-%s.sock" % bus_number)
+
+# From linux/i2c-dev.h and linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+class i2c_msg(ctypes.Structure):
+  _fields_ = [ ('addr', ctypes.c_uint16),
+               ('flags', ctypes.c_uint16),
+               ('len', ctypes.c_uint16),
+               ('buf', ctypes.POINTER(ctypes.c_uint8)) ]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+  _fields_ = [ ('msgs', ctypes.POINTER(i2c_msg)),
+               ('nmsgs', ctypes.c_uint32) ]
+
+# The I2C bus through /dev/i2c-<bus_number>, opened once
+class LinuxBus(object):
+  def __init__(self, bus_number):
+    try:
+      self.fd = os.open("/dev/i2c-%s" % bus_number, os.O_RDWR)
+    except OSError as e:
+      raise IOError(e.errno, "Error opening I2C bus %s: %s" % (bus_number, e.strerror))
+
+  # Writes the bytes in write to the device at address, then reads and returns read_length bytes
+  def transfer(self, address, write, read_length):
+    msgs = []
+    if write or not read_length:
+      write_buf = (ctypes.c_uint8 * len(write))(*write)
+      msgs.append(i2c_msg(address, 0, len(write), write_buf))
+    if read_length:
+      read_buf = (ctypes.c_uint8 * read_length)()
+      msgs.append(i2c_msg(address, I2C_M_RD, read_length, read_buf))
+
+    request = i2c_rdwr_ioctl_data((i2c_msg * len(msgs))(*msgs), len(msgs))
+    fcntl.ioctl(self.fd, I2C_RDWR, request)
+
+    if read_length:
+      return list(read_buf)
+    return []
+
+  def close(self):
+    os.close(self.fd)
+
+# A bus with python devices attached. devices maps an address to an object with a
+# transfer(write, read_length) method. Addresses without a device don't acknowledge.
+class FakeBus(object):
+  def __init__(self, devices=None):
+    self.devices = dict(devices or {})
+
+  def transfer(self, address, write, read_length):
+    if address not in self.devices:
+      raise IOError(errno.ENXIO, "No device at address 0x%02x" % address)
+    return self.devices[address].transfer(write, read_length)
+
+  def close(self):
+    pass
+
+# A device on a FakeBus with 8 bit registers, addressed by the first byte written, like an EEPROM.
+# Reads continue from the last register written.
+class FakeRegisterDevice(object):
+  def __init__(self, registers=None):
+    self.registers = dict(registers or {})
+    self.pointer = 0
+
+  def transfer(self, write, read_length):
+    if write:
+      self.pointer = write[0]
+      for (i, value) in enumerate(write[1:]):
+        self.registers[(self.pointer + i) & 0xFF] = value
+    return [ self.registers.get((self.pointer + i) & 0xFF, 0xFF) for i in range(read_length) ]
+
+class DeviceStats(object):
+  def __init__(self):
+    self.transactions = 0
+    self.errors = 0
+    self.total_latency = 0.0
+    self.max_latency = 0.0
+
+  def record(self, latency, error):
+    self.transactions += 1
+    if error:
+      self.errors += 1
+    self.total_latency += latency
+    self.max_latency = max(self.max_latency, latency)
+
+  def asDict(self):
+    return { 'transactions': self.transactions,
+             'errors': self.errors,
+             'mean_latency': self.total_latency / self.transactions if self.transactions else 0.0,
+             'max_latency': self.max_latency }
+
+# Serializes transactions on a bus, a LinuxBus or FakeBus, and keeps per device stats
+class BusManager(object):
+  def __init__(self, bus):
+    self.bus = bus
+    self.lock = threading.Lock()
+    self.stats_by_address = {}
+
+  # transactions is a list of (address, write, read_length) tuples. Runs them back to back and returns
+  # a list with the bytes read by each, or the IOError it raised.
+  def batch(self, transactions):
+    results = []
+    with self.lock:
+      for (address, write, read_length) in transactions:
+        start = time.time()
+        try:
+          result = self.bus.transfer(address, list(write), read_length)
+        except IOError as e:
+          result = e
+        latency = time.time() - start
+
+        self.stats_by_address.setdefault(address, DeviceStats()).record(latency, isinstance(result, IOError))
+        results.append(result)
+    return results
+
+  def transfer(self, address, write, read_length):
+    result = self.batch([ (address, write, read_length) ])[0]
+    if isinstance(result, IOError):
+      raise result
+    return result
+
+  # Returns a dict mapping device address, as a hex string, to its stats
+  def stats(self):
+    with self.lock:
+      return dict([ ("0x%02x" % address, stats.asDict()) for (address, stats) in self.stats_by_address.items() ])
+
+  def close(self):
+    self.bus.close()
+
+# A client of the bus server, with the same batch, transfer and stats methods as BusManager. A request
+# that isn't answered within REQUEST_TIMEOUT raises an IOError and closes the connection, so a stalled
+# server can't hold the lock forever. The next request reconnects.
+class BusClient(object):
+  def __init__(self, socket_path):
+    self.socket_path = socket_path
+    self.lock = threading.Lock()
+    self.sock = None
+    self.connect()
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(REQUEST_TIMEOUT)
+    self.sock.connect(self.socket_path)
+    self.reader = self.sock.makefile('r')
+
+  def request(self, request):
+    with self.lock:
+      try:
+        if self.sock is None:
+          self.connect()
+        self.sock.sendall("%s\n" % json.dumps(request))
+        line = self.reader.readline()
+        if not line:
+          raise IOError(errno.ECONNRESET, "I2C bus server closed the connection")
+      except (IOError, socket.error) as e:
+        # socket.timeout is a socket.error, with no errno
+        self.close()
+        raise IOError(e.errno or errno.EIO, "Error talking to I2C bus server: %s" % e)
+    return json.loads(line)
+
+  def batch(self, transactions):
+    results = []
+    for result in self.request({ 'batch': [ (address, list(write), read_length) for (address, write, read_length) in transactions ] })['results']:
+      if 'error' in result:
+        results.append(IOError(result['errno'], result['error']))
+      else:
+        results.append(result['data'])
+    return results
+
+  def transfer(self, address, write, read_length):
+    result = self.batch([ (address, write, read_length) ])[0]
+    if isinstance(result, IOError):
+      raise result
+    return result
+
+  def stats(self):
+    return self.request({ 'stats': True })['stats']
+
+  def close(self):
+    if self.sock is not None:
+      self.reader.close()
+      self.sock.close()
+      self.sock = None
+
+_buses = {}
+_buses_lock = threading.Lock()
+# For each bus that fell back to a BusManager because the server wasn't running, when to try it again
+_client_retries = {}
+
+# Returns the bus shared by everything in this process, a client of the bus server if it's running,
+# otherwise a BusManager of the bus itself. Raises an IOError if neither can be opened.
+#
+# A process that started before the server falls back to a BusManager, and tries the server again on
+# calls to getBus at most every CLIENT_RETRY_PERIOD seconds. Once it connects, later calls return the
+# client. A Device made without a bus calls getBus for every transaction, so devices made before the
+# server came up move to it too.
+def getBus(bus_number=None):
+  if bus_number is None:
+    bus_number = defaultBusNumber()
+
+  with _buses_lock:
+    retry = _client_retries.get(bus_number)
+    if bus_number not in _buses or (retry is not None and time.time() >= retry):
+      try:
+        _buses[bus_number] = BusClient(socketPath(bus_number))
+        _client_retries.pop(bus_number, None)
+      except socket.error:
+        if bus_number not in _buses:
+          _buses[bus_number] = BusManager(LinuxBus(bus_number))
+        _client_retries[bus_number] = time.time() + CLIENT_RETRY_PERIOD
+    return _buses[bus_number]
+
+# Makes getBus return bus, a BusManager, BusClient or anything with the same methods, for example
+# a BusManager of a FakeBus to run components without the hardware
+def useBus(bus, bus_number=None):
+  if bus_number is None:
+    bus_number = defaultBusNumber()
+
+  with _buses_lock:
+    _buses[bus_number] = bus
+    _client_retries.pop(bus_number, None)
+
+# A device on the bus, with the methods of Adafruit_GPIO's I2C.Device. Writes return None and
+# failed transactions raise IOErrors. Without a bus, the device uses whatever getBus returns at the time
+# of each transaction, and raises an IOError when it's made if there's no bus at all.
+class Device(object):
+  def __init__(self, address, bus=None):
+    self.address = address
+    self.fixedBus = bus
+    if bus is None:
+      getBus()
+
+  @property
+  def bus(self):
+    return self.fixedBus if self.fixedBus is not None else getBus()
+
+  def transfer(self, write, read_length):
+    return self.bus.transfer(self.address, write, read_length)
+
+  def writeRaw8(self, value):
+    self.transfer([ value & 0xFF ], 0)
+
+  def write8(self, register, value):
+    self.transfer([ register, value & 0xFF ], 0)
+
+  # Writes value least significant byte first, like SMBus write word data
+  def write16(self, register, value):
+    self.transfer([ register, value & 0xFF, (value >> 8) & 0xFF ], 0)
+
+  def writeList(self, register, data):
+    self.transfer([ register ] + list(data), 0)
+
+  def readRaw8(self):
+    return self.transfer([], 1)[0]
+
+  def readU8(self, register):
+    return self.transfer([ register ], 1)[0]
+
+  def readU16(self, register, little_endian=True):
+    (first, second) = self.transfer([ register ], 2)
+    if little_endian:
+      return (second << 8) | first
+    return (first << 8) | second
+
+  def readU16BE(self, register):
+    return self.readU16(register, little_endian=False)
+
+  def readList(self, register, length):
+    return self.transfer([ register ], length)
+
+# Returns True if a device acknowledges a read at address
+def probe(address, bus=None):
+  try:
+    Device(address, bus).readRaw8()
+    return True
+  except IOError:
+    return False
+
+def handleRequest(manager, request):
+  if 'stats' in request:
+    return { 'stats': manager.stats() }
+
+  results = []
+  for result in manager.batch(request['batch']):
+    if isinstance(result, IOError):
+      results.append({ 'error': str(result), 'errno': result.errno or errno.EIO })
+    else:
+      results.append({ 'data': result })
+  return { 'results': results }
+
+def serveConnection(manager, conn):
+  reader = conn.makefile('r')
+  try:
+    for line in reader:
+      try:
+        response = handleRequest(manager, json.loads(line))
+      except (ValueError, KeyError, TypeError) as e:
+        response = { 'results': [], 'error': "Bad request: %s" % e }
+      conn.sendall("%s\n" % json.dumps(response))
+  except socket.error:
+    pass
+  finally:
+    reader.close()
+    conn.close()
+
+# Listens on socket_path, serving each client on its own thread. Returns the listening socket.
+def listen(manager, socket_path):
+  # A socket file left by a server that's no longer running is removed, a running server is left alone
+  if os.path.exists(socket_path):
+    try:
+      BusClient(socket_path).close()
+      raise IOError(errno.EADDRINUSE, "An I2C bus server is already listening on %s" % socket_path)
+    except socket.error:
+      os.remove(socket_path)
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path)
+  server.listen(8)
+
+  def accept():
+    while True:
+      try:
+        (conn, address) = server.accept()
+      except socket.error:
+        return
+      t = threading.Thread(target=serveConnection, args=(manager, conn), name="i2c_bus connection")
+      t.daemon = True
+      t.start()
+
+  t = threading.Thread(target=accept)
+  t.daemon = True
+  t.start()
+  return server
+
+def serve(bus, socket_path, use_hal):
+  import signal
+  manager = BusManager(bus)
+  server = listen(manager, socket_path)
+
+  # LinuxCNC stops userspace components with SIGTERM
+  def stop(signum, frame):
+    raise SystemExit
+  signal.signal(signal.SIGTERM, stop)
+
+  if use_hal:
+    import hal
+    h = hal.component("i2c_bus")
+    h.newpin("transactions", hal.HAL_U32, hal.HAL_OUT)
+    h.newpin("errors", hal.HAL_U32, hal.HAL_OUT)
+    h.ready()
+
+  try:
+    while True:
+      time.sleep(1)
+      if use_hal:
+        stats = manager.stats().values()
+        h['transactions'] = sum([ s['transactions'] for s in stats ]) & 0xFFFFFFFF
+        h['errors'] = sum([ s['errors'] for s in stats ]) & 0xFFFFFFFF
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    os.remove(socket_path)
+    manager.close()
+
+def formatStats(stats):
+  lines = [ "%-8s %12s %8s %14s %14s" % ("device", "transactions", "errors", "mean (ms)", "max (ms)") ]
+  for address in sorted(stats):
+    s = stats[address]
+    lines.append("%-8s %12d %8d %14.3f %14.3f" % (address, s['transactions'], s['errors'], s['mean_latency'] * 1000, s['max_latency'] * 1000))
+  return "\n".join(lines)
+
+# Runs a server on a FakeBus and checks a client sees the same results and stats as the server
+def selftest():
+  import tempfile
+  socket_path = os.path.join(tempfile.mkdtemp(prefix="i2c_bus"), "i2c.sock")
+  manager = BusManager(FakeBus({ 0x50: FakeRegisterDevice({ 0: 0x12, 1: 0x34 }) }))
+  server = listen(manager, socket_path)
+  try:
+    client = BusClient(socket_path)
+    eeprom = Device(0x50, client)
+    assert eeprom.readU8(0) == 0x12
+    assert eeprom.readU16BE(0) == 0x1234
+    assert eeprom.readU16(0) == 0x3412
+    eeprom.write16(2, 0xABCD)
+    assert eeprom.readList(2, 2) == [ 0xCD, 0xAB ]
+    assert probe(0x50, client)
+    assert not probe(0x18, client)
+    try:
+      Device(0x18, client).readU8(0)
+      assert False, "expected an IOError from a missing device"
+    except IOError as e:
+      assert e.errno == errno.ENXIO
+
+    results = client.batch([ (0x50, [ 0 ], 1), (0x18, [], 1), (0x50, [ 1 ], 1) ])
+    assert results[0] == [ 0x12 ] and isinstance(results[1], IOError) and results[2] == [ 0x34 ]
+
+    stats = client.stats()
+    assert stats == manager.stats()
+    assert stats["0x50"]['transactions'] == 8 and stats["0x50"]['errors'] == 0
+    assert stats["0x18"]['transactions'] == 3 and stats["0x18"]['errors'] == 3
+    client.close()
+
+    for t in threading.enumerate():
+      if t.name == "i2c_bus connection":
+        t.join()
+  finally:
+    server.close()
+    os.remove(socket_path)
+    os.rmdir(os.path.dirname(socket_path))
+  print "ok"
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Shared I2C bus server")
+  parser.add_argument("command", choices=[ "serve", "stats", "selftest" ])
+  parser.add_argument("--bus", type=int, default=None, help="I2C bus number, 2 on current kernels")
+  parser.add_argument("--socket", help="unix socket the server listens on")
+  parser.add_argument("--hal", action="store_true", help="run as the i2c_bus HAL component")
+  parser.add_argument("--fake", action="store_true", help="serve an empty fake bus instead of the hardware")
+  args = parser.parse_args()
+
+  bus_number = args.bus if args.bus is not None else defaultBusNumber()
+  socket_path = args.socket or socketPath(bus_number)
+
+  if args.command == "serve":
+    serve(FakeBus() if args.fake else LinuxBus(bus_number), socket_path, args.hal)
+  elif args.command == "stats":
+    print formatStats(BusClient(socket_path).stats())
+  else:
+    selftest()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# ini_manifest.py
+# Keeps track of the inputs that PocketNC.ini was generated from, so generateINI.py can skip merging
+# and writing PocketNC.ini when nothing changed. The manifest is a json file holding a content hash of
+# every input file, the set of active features and a hash of the PocketNC.ini that was written. If
+# PocketNC.ini is edited or removed by hand, its hash no longer matches and it's generated again.
+#
+# When PocketNC.ini does need to be generated, it is written to a temporary file first and only
+# renamed over PocketNC.ini if the contents differ. This avoids needless writes to the SD card
+# and never leaves a partially written PocketNC.ini behind if power is lost.
+
+import hashlib
+import json
+import os
+import sys
+
+def hashFile(path):
+  try:
+    with open(path, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except IOError:
+    return None
+
+# input_paths is a list of files that the generated INI depends on. Files that don't exist
+# are recorded as such, so creating one (a CalibrationOverlay.inc for example) is noticed.
+def buildManifest(input_paths, features):
+  return {
+    'inputs': dict([ (path, hashFile(path)) for path in input_paths ]),
+    'features': sorted(features)
+  }
+
+def readManifest(manifest_file):
+  try:
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+    if isinstance(manifest, dict):
+      return manifest
+  except (IOError, ValueError):
+    pass
+  return None
+
+def writeManifest(manifest_file, manifest, output_file):
+  manifest = dict(manifest)
+  manifest['output'] = hashFile(output_file)
+
+  tmp_file = "%s.tmp" % manifest_file
+  try:
+    with open(tmp_file, 'w') as f:
+      json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
+  except (IOError, OSError) as e:
+    sys.stderr.write("Error writing INI manifest, %s: %s\n" % (manifest_file, e))
+
+# Returns True if output_file was generated from exactly the inputs described by manifest
+def isUpToDate(manifest_file, manifest, output_file):
+  previous = readManifest(manifest_file)
+  if previous is None:
+    return False
+
+  output_hash = hashFile(output_file)
+  if output_hash is None or previous.get('output') != output_hash:
+    return False
+
+  return previous.get('inputs') == manifest['inputs'] and previous.get('features') == manifest['features']
+
+# Calls write(path) to write a file to a temporary path next to output_file, then replaces output_file
+# with it if the contents are different. Returns True if output_file was changed.
+def writeIfChanged(output_file, write):
+  tmp_file = "%s.tmp" % output_file
+  write(tmp_file)
+
+  with open(tmp_file, 'rb') as f:
+    new_contents = f.read()
+
+  try:
+    with open(output_file, 'rb') as f:
+      unchanged = f.read() == new_contents
+  except IOError:
+    unchanged = False
+
+  if unchanged:
+    os.remove(tmp_file)
+    return False
+
+  with open(tmp_file, 'rb') as f:
+    os.fsync(f.fileno())
+  os.rename(tmp_file, output_file)
+  return True
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# ini_merge.py
+# Applies a list of INI layers (overlays and appends) to a base INI in a single pass.
+#
+# Rockhopper's merge_ini_data and append_ini_data copy the whole INI and search the parameter list
+# for every parameter they merge, so calling them once per layer costs layers x parameters. mergeLayers
+# copies the base once and keeps an index of (section, name) to parameter, so each parameter of each
+# layer is applied in constant time. The result is the same as calling merge_ini_data and
+# append_ini_data for each layer in order:
+#   - a merged parameter replaces the value of the first existing parameter with the same section and name,
+#     or is added to the end if there isn't one
+#   - appended parameters are always added to the end, even if a parameter with the same section and name exists
+#   - sections from a layer are added if they don't already exist
+# So where the base or an APPEND layer has left several parameters with the same section and name, a MERGE
+# only updates the first of them and the others keep their values. This is unlike APPEND, which always adds
+# another. verify_ini_merge.py checks this against the Rockhopper functions, and against the golden outputs
+# in ini_merge_golden, for every machine version.
+
+from copy import deepcopy
+
+MERGE = "merge"
+APPEND = "append"
+
+def parameterKey(param):
+  return (param['values']['section'], param['values']['name'])
+
+# Returns the INI data for a layer that sets [POCKETNC_FEATURES]<FEATURE>=1
+def featureFlagLayer(feature):
+  return {
+    'parameters': [
+      {
+          'values': {
+              'section': 'POCKETNC_FEATURES',
+              'name': feature.upper(),
+              'value': "1",
+              'comment': '',
+              'help': '',
+              'default': ''
+          }
+      }
+    ],
+    'sections': {
+        'POCKETNC_FEATURES': { 'comment': '', 'help': '' }
+    }
+  }
+
+# base is INI data as returned by read_ini_data. layers is a list of (MERGE or APPEND, INI data) tuples
+# that are applied in order. Returns new INI data; base and the layers aren't modified.
+def mergeLayers(base, layers):
+  merged = deepcopy(base)
+  parameters = merged['parameters']
+  sections = merged['sections']
+
+  index = {}
+  for param in parameters:
+    index.setdefault(parameterKey(param), param)
+
+  for (mode, layer) in layers:
+    for section in layer['sections']:
+      if section not in sections:
+        sections[section] = deepcopy(layer['sections'][section])
+
+    for param in layer['parameters']:
+      key = parameterKey(param)
+      existing = index.get(key) if mode == MERGE else None
+
+      if existing is not None:
+        existing['values']['value'] = param['values']['value']
+      else:
+        param = deepcopy(param)
+        parameters.append(param)
+        index.setdefault(key, param)
+
+  return merged
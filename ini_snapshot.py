@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# ini_snapshot.py
+# A precompiled snapshot of PocketNC.ini for userspace components that only need to look up a few values.
+# generateINI.py writes the snapshot next to PocketNC.ini whenever it writes PocketNC.ini. It's a marshalled
+# dict mapping (section, name) to the parameter's value, converted to an int or float when it looks like
+# one, so loading it is a single marshal.load instead of parsing the whole INI and searching the parameter
+# list for every key.
+#
+# The snapshot records the mtime and size of the PocketNC.ini it was made from. If PocketNC.ini has
+# changed since (for example, it was edited by hand), the snapshot is ignored and readIniValues falls
+# back to parsing PocketNC.ini.
+#
+# Usage from a component:
+#   from ini_snapshot import readIniValues, getValue
+#   values = readIniValues(INI_FILE)
+#   hiRPM = float(getValue(values, "POCKETNC", "SPINDLE_HIGH_RPM", 10000.0))
+
+import marshal
+import os
+import re
+import sys
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+
+SNAPSHOT_FORMAT = 1
+
+INT_RE = re.compile(r"^[-+]?\d+$")
+FLOAT_RE = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+
+def snapshotPath(ini_file):
+  return "%s.snapshot" % ini_file
+
+def typedValue(value):
+  if INT_RE.match(value):
+    return int(value)
+  if FLOAT_RE.match(value):
+    return float(value)
+  return value
+
+# Returns a dict mapping (section, name) to typed value. As with Rockhopper's get_parameter,
+# the first parameter with a given section and name wins.
+def buildValues(ini_data):
+  values = {}
+  for param in ini_data['parameters']:
+    key = (param['values']['section'], param['values']['name'])
+    if key not in values:
+      values[key] = typedValue(param['values']['value'])
+  return values
+
+def iniStat(ini_file):
+  st = os.stat(ini_file)
+  return (st.st_mtime, st.st_size)
+
+# Writes the snapshot of ini_data, which must be the data that was just written to ini_file
+def writeSnapshot(ini_data, ini_file):
+  snapshot_file = snapshotPath(ini_file)
+  tmp_file = "%s.tmp" % snapshot_file
+  (mtime, size) = iniStat(ini_file)
+
+  try:
+    with open(tmp_file, 'wb') as f:
+      marshal.dump((SNAPSHOT_FORMAT, mtime, size, buildValues(ini_data)), f)
+    os.rename(tmp_file, snapshot_file)
+  except (IOError, OSError) as e:
+    sys.stderr.write("Error writing INI snapshot, %s: %s\n" % (snapshot_file, e))
+
+# Returns the values in ini_file's snapshot, or None if there isn't an up to date snapshot
+def loadSnapshot(ini_file):
+  try:
+    with open(snapshotPath(ini_file), 'rb') as f:
+      (format, mtime, size, values) = marshal.load(f)
+  except (IOError, EOFError, ValueError, TypeError):
+    return None
+
+  try:
+    if format != SNAPSHOT_FORMAT or (mtime, size) != iniStat(ini_file):
+      return None
+  except OSError:
+    return None
+
+  return values
+
+# Returns a dict mapping (section, name) to typed value for every parameter in ini_file,
+# from the snapshot if it's up to date, otherwise by parsing ini_file.
+def readIniValues(ini_file):
+  values = loadSnapshot(ini_file)
+  if values is None:
+    sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"))
+    from ini import read_ini_data
+    values = buildValues(read_ini_data(ini_file))
+  return values
+
+def getValue(values, section, name, default=None):
+  return values.get((section, name), default)
@@ -0,0 +1,75 @@
+# GPIO.py
+# A stand in for Adafruit_BBIO.GPIO. Pins are only set up and watched for edges, which are generated by a
+# SpindleClock, a simulated spindle encoder that pulses a pin pulses_per_revolution times per revolution.
+
+import threading
+import time
+
+IN = 0
+OUT = 1
+
+RISING = 1
+FALLING = 2
+BOTH = 3
+
+_directions = {}
+_callbacks = {}
+_lock = threading.Lock()
+
+def setup(pin, direction, pull_up_down=None, initial=None):
+  _directions[pin] = direction
+
+def add_event_detect(pin, edge, callback=None, bouncetime=None):
+  with _lock:
+    _callbacks.setdefault(pin, [])
+    if callback is not None:
+      _callbacks[pin].append(callback)
+
+def add_event_callback(pin, callback, bouncetime=None):
+  with _lock:
+    _callbacks.setdefault(pin, []).append(callback)
+
+def remove_event_detect(pin):
+  with _lock:
+    _callbacks.pop(pin, None)
+
+def cleanup():
+  with _lock:
+    _callbacks.clear()
+  _directions.clear()
+
+# Calls the callbacks of pin as if it had a rising edge
+def edge(pin):
+  with _lock:
+    callbacks = list(_callbacks.get(pin, []))
+  for callback in callbacks:
+    callback(pin)
+
+class SpindleClock(threading.Thread):
+  def __init__(self, pin, rpm=0, pulses_per_revolution=4):
+    threading.Thread.__init__(self, name="spindle clock")
+    self.daemon = True
+    self.pin = pin
+    self.rpm = rpm
+    self.pulses_per_revolution = pulses_per_revolution
+    self.edges = 0
+    self.running = True
+
+  def stop(self):
+    self.running = False
+    self.join()
+
+  def run(self):
+    next_edge = time.time()
+    while self.running:
+      if self.rpm <= 0:
+        time.sleep(0.01)
+        next_edge = time.time()
+        continue
+
+      next_edge += 60.0 / (self.rpm * self.pulses_per_revolution)
+      delay = next_edge - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      self.edges += 1
+      edge(self.pin)
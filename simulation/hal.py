@@ -0,0 +1,79 @@
+# hal.py
+# A stand in for LinuxCNC's hal module, so userspace components can be run off the machine by putting
+# the simulation directory first on sys.path (see simulate.py).
+#
+# Components behave as they do under LinuxCNC, except that nothing is linked to their pins. Instead,
+# every pin write and read is recorded with its time, so loop periods and latencies can be measured
+# from outside, and input pins are set by the simulation with component.set.
+
+import threading
+import time
+
+HAL_BIT = 1
+HAL_FLOAT = 2
+HAL_S32 = 3
+HAL_U32 = 4
+
+HAL_IN = 16
+HAL_OUT = 32
+HAL_IO = HAL_IN | HAL_OUT
+
+HAL_RO = 64
+HAL_RW = 192
+
+# Every component created in this process, by name
+components = {}
+
+def coerce(type, value):
+  if type == HAL_BIT:
+    return bool(value)
+  if type == HAL_FLOAT:
+    return float(value)
+  return int(value)
+
+class component(object):
+  def __init__(self, name):
+    self.name = name
+    self.types = {}
+    self.values = {}
+    self.writes = {}
+    self.reads = {}
+    self.ready_time = None
+    self.lock = threading.Lock()
+    components[name] = self
+
+  def newpin(self, name, type, direction):
+    if self.ready_time is not None:
+      raise RuntimeError("Pin %s.%s created after ready()" % (self.name, name))
+    self.types[name] = type
+    self.values[name] = coerce(type, 0)
+    self.writes[name] = []
+    self.reads[name] = []
+
+  newparam = newpin
+
+  def ready(self):
+    self.ready_time = time.time()
+
+  def exit(self):
+    pass
+
+  def __getitem__(self, name):
+    with self.lock:
+      self.reads[name].append(time.time())
+      return self.values[name]
+
+  def __setitem__(self, name, value):
+    with self.lock:
+      value = coerce(self.types[name], value)
+      self.values[name] = value
+      self.writes[name].append((time.time(), value))
+
+  # Sets a pin as if something linked to it had, without recording it as a write by the component
+  def set(self, name, value):
+    with self.lock:
+      self.values[name] = coerce(self.types[name], value)
+
+  def items(self):
+    with self.lock:
+      return sorted(self.values.items())
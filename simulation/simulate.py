@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+# simulate.py
+# Runs a userspace component on any Linux box, with the hardware it talks to simulated:
+#   hal                  hal.py in this directory, which records every pin read and write
+#   Adafruit_BBIO.GPIO   Adafruit_BBIO/GPIO.py in this directory, with a SpindleClock generating edges
+#   I2C devices          simulated_devices.py, on an i2c_bus.FakeBus
+#   PocketNC.ini         a minimal PocketNC.ini and snapshot in a temporary POCKETNC_DIRECTORY
+#
+# The component runs as it would under LinuxCNC while a scenario changes what its sensors read and what
+# its input pins are set to. After --duration seconds, a report is printed, or written as json to
+# --report, with:
+#   loop         the period of the component's main loop, from the times of a pin it reads or writes every loop
+#   latencies    for each scenario signal, the time from a change to the component acting on it
+#   cpu_percent  CPU time of the whole process, including the simulation, as a percentage of wall time
+#   bus          i2c_bus stats of each device
+#
+# Components:
+#   hss_sensors       pressure and temperature changes to the pressure and temperature pins
+#   spindle_voltage   bursts of speed_in changes to the DAC code of the last, spindle clock RPM changes to speed_measured,
+#                     and how many DAC writes each burst took and how often speed_in is polled
+#   detect_hss_mprls  time taken by each call to detect()
+#   interlock         door openings to spindle-inhibit and feed-inhibit, start button presses to feed-inhibit
+#                     cleared, and the interlock's own latency.* pins
+#
+# Usage: simulation/simulate.py COMPONENT [--duration S] [--latency S] [--fault-rate F] [--report FILE]
+#   --latency adds S seconds to every I2C transaction, --fault-rate fails that fraction of them
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+SIMULATION_DIR = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_DIR = os.path.dirname(SIMULATION_DIR)
+
+sys.path.insert(0, SETTINGS_DIR)
+sys.path.insert(0, SIMULATION_DIR)
+
+import hal
+import Adafruit_BBIO.GPIO as GPIO
+import i2c_bus
+from simulated_devices import simulatedBus
+
+SPINDLE_CLOCK_PIN = "P8_8"
+
+# The parameters spindle_voltage.py reads, as in the high_speed_spindle overlay
+INI_VALUES = [ ("POCKETNC_PINS", "SPINDLE_CLOCK_PIN", SPINDLE_CLOCK_PIN),
+               ("POCKETNC", "SPINDLE_PULSES_PER_REVOLUTION", "1"),
+               ("POCKETNC", "SPINDLE_LOW_VOLTAGE", ".14"),
+               ("POCKETNC", "SPINDLE_LOW_RPM", "1000"),
+               ("POCKETNC", "SPINDLE_HIGH_VOLTAGE", "3.08"),
+               ("POCKETNC", "SPINDLE_HIGH_RPM", "50100.0") ]
+
+def percentile(values, p):
+  values = sorted(values)
+  index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+  return values[index]
+
+def summarize(values):
+  if not values:
+    return { 'count': 0 }
+  return { 'count': len(values),
+           'mean': sum(values) / len(values),
+           'p50': percentile(values, 50),
+           'p99': percentile(values, 99),
+           'max': max(values) }
+
+# Writes a PocketNC.ini with INI_VALUES and its snapshot into a temporary POCKETNC_DIRECTORY
+def makePocketNCDirectory():
+  from ini_snapshot import writeSnapshot
+  pocketnc_dir = tempfile.mkdtemp(prefix="simulate")
+  settings_dir = os.path.join(pocketnc_dir, "Settings")
+  os.makedirs(settings_dir)
+  ini_file = os.path.join(settings_dir, "PocketNC.ini")
+
+  sections = []
+  with open(ini_file, 'w') as f:
+    for (section, name, value) in INI_VALUES:
+      if section not in sections:
+        f.write("\n[%s]\n" % section)
+        sections.append(section)
+      f.write("%s=%s\n" % (name, value))
+
+  writeSnapshot({ 'parameters': [ { 'values': { 'section': section, 'name': name, 'value': value } } for (section, name, value) in INI_VALUES ],
+                  'sections': dict([ (section, {}) for section in sections ]) }, ini_file)
+  return pocketnc_dir
+
+def waitForComponent(name):
+  while name not in hal.components or hal.components[name].ready_time is None:
+    time.sleep(0.01)
+  return hal.components[name]
+
+# Returns the time from each change to the first of times after it, up to the next change.
+# changes is a list of (time, target) and times a list of (time, value). matches(value, target)
+# says whether a time counts. Changes that aren't matched before the next change are counted as missed.
+def latencies(changes, times, matches):
+  result = []
+  missed = 0
+  for (i, (changed, target)) in enumerate(changes):
+    until = changes[i + 1][0] if i + 1 < len(changes) else float("inf")
+    acted = [ t for (t, value) in times if changed <= t < until and matches(value, target) ]
+    if acted:
+      result.append(acted[0] - changed)
+    elif i + 1 < len(changes):
+      missed += 1
+  summary = summarize(result)
+  summary['missed'] = missed
+  return summary
+
+def loopPeriods(times):
+  return summarize([ b - a for (a, b) in zip(times, times[1:]) ])
+
+# Each scenario runs on its own thread until the report is made, then returns the report's loop and latencies
+class HssSensorsScenario(object):
+  path = "features/high_speed_spindle/hss_sensors.py"
+
+  def __init__(self, devices):
+    self.devices = devices
+    self.pressure_changes = []
+    self.temperature_changes = []
+
+  def run(self):
+    h = waitForComponent("hss_sensors")
+    step = 0
+    while True:
+      time.sleep(0.5)
+      step += 1
+      pressure = 0.14 if step % 2 else 0.13
+      self.devices['mprls'].pressure = pressure
+      self.pressure_changes.append((time.time(), pressure))
+      if step % 4 == 0:
+        temperature = 25.0 if step % 8 else 30.0
+        self.devices['mcp9808'].temperature = temperature
+        self.temperature_changes.append((time.time(), temperature))
+
+  def report(self):
+    h = hal.components["hss_sensors"]
+    return { 'loop': loopPeriods([ t for (t, value) in h.writes['abort'] ]),
+             'latencies': { 'pressure': latencies(self.pressure_changes, h.writes['pressure'], lambda value, target: abs(value - target) < 0.0005),
+                            'temperature': latencies(self.temperature_changes, h.writes['temperature'], lambda value, target: abs(value - target) < 0.1) } }
+
+class SpindleVoltageScenario(object):
+  path = "spindle_voltage.py"
+
+  def __init__(self, devices):
+    self.devices = devices
+    self.clock = GPIO.SpindleClock(SPINDLE_CLOCK_PIN, pulses_per_revolution=1)
+    self.speed_changes = []
+
+  # Each speed change is a burst of three, like a program sending S words in quick succession
+  def run(self):
+    h = waitForComponent("spindle_voltage")
+    self.clock.start()
+    step = 0
+    while True:
+      rpm = 9000.0 if step % 2 else 5000.0
+      self.speed_changes.append((time.time(), rpm))
+      for burst in [ rpm - 200, rpm - 100, rpm ]:
+        h.set('speed_in', burst)
+        time.sleep(0.001)
+      self.clock.rpm = rpm
+      step += 1
+      time.sleep(3)
+
+  def report(self):
+    from spindle_dac import SpeedToDac
+    values = dict([ (name, float(value)) for (section, name, value) in INI_VALUES[1:] ])
+    speedToDac = SpeedToDac(values['SPINDLE_LOW_RPM'], values['SPINDLE_HIGH_RPM'], values['SPINDLE_LOW_VOLTAGE'], values['SPINDLE_HIGH_VOLTAGE'])
+    h = hal.components["spindle_voltage"]
+    return { 'loop': loopPeriods([ t for (t, value) in h.writes['speed_measured'] ]),
+             'dac_writes_per_change': len(self.devices['dac'].writes) / float(max(1, len(self.speed_changes))),
+             'speed_in_polls_per_second': len(h.reads['speed_in']) / (time.time() - h.ready_time),
+             'latencies': { 'dac': latencies(self.speed_changes, self.devices['dac'].writes, lambda value, target: value == speedToDac.code(target)),
+                            'speed_measured': latencies(self.speed_changes, h.writes['speed_measured'], lambda value, target: abs(value - target) < target * 0.02) } }
+
+class DetectScenario(object):
+  path = None
+
+  def __init__(self, devices):
+    self.calls = []
+
+  def run(self):
+    sys.path.insert(0, os.path.join(SETTINGS_DIR, "features/high_speed_spindle"))
+    from detect_hss_mprls import detect
+    while True:
+      start = time.time()
+      detect()
+      self.calls.append(time.time() - start)
+      time.sleep(0.01)
+
+  def report(self):
+    return { 'loop': { 'count': 0 },
+             'latencies': { 'detect': summarize(self.calls) } }
+
+class InterlockScenario(object):
+  path = "features/interlock/interlock.py"
+
+  def __init__(self, devices):
+    self.opens = []
+    self.resumes = []
+
+  # Runs a program, opens the door, stops the motion once pause-program is set, then closes the door
+  # and presses the start button, over and over
+  def run(self):
+    h = waitForComponent("interlock")
+    while True:
+      for (name, value) in [ ('closed', True), ('program-running', True), ('program-is-paused', False),
+                             ('spindle-is-enabled', True), ('spindle-is-turning', True), ('current-vel', 1.0) ]:
+        h.set(name, value)
+      time.sleep(0.5)
+
+      self.opens.append((time.time(), True))
+      h.set('closed', False)
+      while not h.values['pause-program']:
+        time.sleep(0.001)
+      # decelerating
+      time.sleep(0.05)
+      h.set('current-vel', 0.0)
+      h.set('program-running', False)
+      h.set('program-is-paused', True)
+      time.sleep(0.5)
+
+      h.set('closed', True)
+      time.sleep(0.1)
+      self.resumes.append((time.time(), False))
+      h.set('start-button-pulse', True)
+      time.sleep(0.02)
+      h.set('start-button-pulse', False)
+      while not h.values['resume-program']:
+        time.sleep(0.001)
+      h.set('program-is-paused', False)
+
+  def report(self):
+    from interlock_latency import TRANSITIONS
+    h = hal.components["interlock"]
+    return { 'loop': loopPeriods([ t for (t, value) in h.writes['program-paused-by-interlock.not'] ]),
+             'latencies': { 'spindle-inhibit': latencies(self.opens, h.writes['spindle-inhibit'], lambda value, target: value == target),
+                            'feed-inhibit': latencies(self.opens, h.writes['feed-inhibit'], lambda value, target: value == target),
+                            'feed-release': latencies(self.resumes, h.writes['feed-inhibit'], lambda value, target: value == target) },
+             'pins': dict([ ("latency.%s.%s" % (name, stat), h.values["latency.%s.%s" % (name, stat)])
+                            for name in TRANSITIONS for stat in [ 'max', 'p99', 'count' ] ]) }
+
+SCENARIOS = { 'hss_sensors': HssSensorsScenario,
+              'interlock': InterlockScenario,
+              'spindle_voltage': SpindleVoltageScenario,
+              'detect_hss_mprls': DetectScenario }
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run a userspace component against simulated hardware")
+  parser.add_argument("component", choices=sorted(SCENARIOS))
+  parser.add_argument("--duration", type=float, default=10, help="seconds to run the component for")
+  parser.add_argument("--latency", type=float, default=0, help="seconds added to every I2C transaction")
+  parser.add_argument("--fault-rate", type=float, default=0, help="fraction of I2C transactions that fail")
+  parser.add_argument("--report", help="write the report as json to this file instead of printing it")
+  args = parser.parse_args()
+
+  pocketnc_dir = makePocketNCDirectory()
+  os.environ["POCKETNC_DIRECTORY"] = pocketnc_dir
+
+  (bus, devices) = simulatedBus(latency=args.latency, fault_rate=args.fault_rate, seed=1)
+  manager = i2c_bus.BusManager(bus)
+  i2c_bus.useBus(manager)
+
+  scenario = SCENARIOS[args.component](devices)
+  started = time.time()
+  startedUsage = resource.getrusage(resource.RUSAGE_SELF)
+
+  def stop():
+    time.sleep(args.duration)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    report = scenario.report()
+    report['component'] = args.component
+    report['cpu_percent'] = 100.0 * (usage.ru_utime + usage.ru_stime - startedUsage.ru_utime - startedUsage.ru_stime) / (time.time() - started)
+    report['bus'] = manager.stats()
+
+    if args.report:
+      with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    else:
+      print json.dumps(report, indent=2, sort_keys=True)
+
+    shutil.rmtree(pocketnc_dir)
+    sys.stdout.flush()
+    os._exit(0)
+
+  for target in [ scenario.run, stop ]:
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+
+  if scenario.path:
+    sys.argv = [ os.path.join(SETTINGS_DIR, scenario.path) ]
+    sys.path.insert(0, os.path.dirname(sys.argv[0]))
+    execfile(sys.argv[0], { '__name__': "__main__", '__file__': sys.argv[0] })
+  else:
+    while True:
+      time.sleep(1)
@@ -0,0 +1,188 @@
+# simulated_devices.py
+# Simulated versions of the I2C devices the userspace components talk to, for an i2c_bus.FakeBus:
+#   SimulatedMPRLS     pressure sensor of the high speed spindle, 0x18
+#   SimulatedMCP9808   temperature sensor of the high speed spindle, 0x19
+#   SimulatedMCP4725   DAC setting the spindle speed, 0x60
+#   SimulatedEEPROM    EEPROM only on v2revR boards, 0x50
+#
+# Each device takes latency, seconds added to every transaction, and fault_rate, the fraction of
+# transactions that fail with an IOError. Faults can also be forced with failNext, and a device that
+# isn't present doesn't acknowledge its address, like one that's been unplugged.
+
+import errno
+import random
+import threading
+import time
+
+from i2c_bus import FakeBus
+
+MPRLS_I2CADDR = 0x18
+MCP9808_I2CADDR = 0x19
+MCP4725_I2CADDR = 0x60
+EEPROM_I2CADDR = 0x50
+
+class SimulatedDevice(object):
+  def __init__(self, latency=0.0, fault_rate=0.0, seed=None):
+    self.latency = latency
+    self.fault_rate = fault_rate
+    self.present = True
+    self.forced_faults = 0
+    self.transactions = 0
+    self.faults = 0
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+
+  def failNext(self, count=1):
+    with self.lock:
+      self.forced_faults += count
+
+  def transfer(self, write, read_length):
+    if self.latency:
+      time.sleep(self.latency)
+
+    with self.lock:
+      self.transactions += 1
+      if not self.present:
+        raise IOError(errno.ENXIO, "Simulated device not present")
+      if self.forced_faults or (self.fault_rate and self.random.random() < self.fault_rate):
+        self.forced_faults = max(0, self.forced_faults - 1)
+        self.faults += 1
+        raise IOError(errno.EIO, "Simulated fault")
+      return self.handle(list(write), read_length)
+
+  def handle(self, write, read_length):
+    raise NotImplementedError
+
+class SimulatedMPRLS(SimulatedDevice):
+  STATUS_POWERED = 0x40
+  STATUS_BUSY = 0x20
+
+  def __init__(self, pressure=0.14, conversion_time=0.005, **options):
+    SimulatedDevice.__init__(self, **options)
+    self.pressure = pressure
+    self.conversion_time = conversion_time
+    self.converting_until = 0
+    self.raw = self.rawPressure(pressure)
+
+  # Inverse of the transfer function in hss_sensors.readPressure
+  def rawPressure(self, mpa):
+    psi = mpa / 0.0068947572932
+    raw = int(round(psi * (0xE66666 - 0x19999A) / 25.0 + 0x19999A))
+    return min(max(raw, 0), 0xFFFFFF)
+
+  def handle(self, write, read_length):
+    now = time.time()
+    if write and write[0] == 0xAA:
+      self.converting_until = now + self.conversion_time
+      self.raw = self.rawPressure(self.pressure)
+
+    status = self.STATUS_POWERED
+    if now < self.converting_until:
+      status |= self.STATUS_BUSY
+    data = [ status, (self.raw >> 16) & 0xFF, (self.raw >> 8) & 0xFF, self.raw & 0xFF ]
+    return (data * (read_length // 4 + 1))[:read_length]
+
+class SimulatedMCP9808(SimulatedDevice):
+  REG_CONFIG = 0x01
+  REG_AMBIENT_TEMP = 0x05
+  REG_RESOLUTION = 0x08
+  CONFIG_SHUTDOWN = 0x0100
+
+  # Conversion time at each resolution
+  CONVERSION_TIMES = [ 0.03, 0.065, 0.13, 0.25 ]
+
+  def __init__(self, temperature=25.0, **options):
+    SimulatedDevice.__init__(self, **options)
+    self.temperature = temperature
+    self.config = self.CONFIG_SHUTDOWN
+    self.resolution = 3
+    self.pointer = 0
+    self.converted = None
+    self.converted_at = 0
+
+  # The ambient temperature register only changes at the end of each conversion
+  def convert(self):
+    now = time.time()
+    if self.config & self.CONFIG_SHUTDOWN:
+      return
+    if self.converted is None or now - self.converted_at >= self.CONVERSION_TIMES[self.resolution]:
+      self.converted = self.temperature
+      self.converted_at = now
+
+  def ambientRegister(self):
+    if self.converted is None:
+      return 0
+    raw = int(round(self.converted * 16)) & 0x1FFF
+    return raw
+
+  def handle(self, write, read_length):
+    if write:
+      self.pointer = write[0]
+      data = write[1:]
+      if self.pointer == self.REG_CONFIG and len(data) >= 2:
+        # write16 sends the least significant byte first
+        self.convert()
+        self.config = data[0] | (data[1] << 8)
+      elif self.pointer == self.REG_RESOLUTION and data:
+        self.resolution = data[0] & 0x03
+
+    self.convert()
+    if self.pointer == self.REG_AMBIENT_TEMP:
+      value = self.ambientRegister()
+    elif self.pointer == self.REG_CONFIG:
+      value = self.config
+    elif self.pointer == self.REG_RESOLUTION:
+      value = self.resolution << 8
+    else:
+      value = 0
+    return [ (value >> 8) & 0xFF, value & 0xFF ][:read_length] + [ 0 ] * max(0, read_length - 2)
+
+class SimulatedMCP4725(SimulatedDevice):
+  def __init__(self, vdd=4.9, **options):
+    SimulatedDevice.__init__(self, **options)
+    self.vdd = vdd
+    self.code = 0
+    # (time, code) of every write to the DAC register
+    self.writes = []
+
+  def voltage(self):
+    return self.code / 4095.0 * self.vdd
+
+  def handle(self, write, read_length):
+    # Write DAC register (0x40) or DAC register and EEPROM (0x60): 12 bit code, D11-D4 then D3-D0
+    if len(write) >= 3 and write[0] & 0xE0 in (0x40, 0x60):
+      self.code = (write[1] << 4) | (write[2] >> 4)
+      self.writes.append((time.time(), self.code))
+    return [ 0xC0, self.code >> 4, (self.code & 0x0F) << 4 ][:read_length] + [ 0 ] * max(0, read_length - 3)
+
+class SimulatedEEPROM(SimulatedDevice):
+  def __init__(self, size=256, **options):
+    SimulatedDevice.__init__(self, **options)
+    self.memory = [ 0xFF ] * size
+    self.pointer = 0
+
+  def handle(self, write, read_length):
+    if write:
+      self.pointer = write[0] % len(self.memory)
+      for value in write[1:]:
+        self.memory[self.pointer] = value
+        self.pointer = (self.pointer + 1) % len(self.memory)
+
+    data = []
+    for i in range(read_length):
+      data.append(self.memory[self.pointer])
+      self.pointer = (self.pointer + 1) % len(self.memory)
+    return data
+
+# Returns a FakeBus with all of the simulated devices, and a dict of the devices by name. options are
+# passed to every device.
+def simulatedBus(**options):
+  devices = { 'mprls': SimulatedMPRLS(**options),
+              'mcp9808': SimulatedMCP9808(**options),
+              'dac': SimulatedMCP4725(**options),
+              'eeprom': SimulatedEEPROM(**options) }
+  bus = FakeBus({ MPRLS_I2CADDR: devices['mprls'],
+                  MCP9808_I2CADDR: devices['mcp9808'],
+                  MCP4725_I2CADDR: devices['dac'],
+                  EEPROM_I2CADDR: devices['eeprom'] })
+  return (bus, devices)
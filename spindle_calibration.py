@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+# spindle_calibration.py
+# Fits the spindle's RPM to voltage curve from spindle_logging's logs and writes it to
+# CalibrationOverlay.inc, as SPINDLE_CALIBRATION_RPM and SPINDLE_CALIBRATION_VOLTAGE (see spindle_dac.py).
+# It's an offline tool and needs NumPy, spindle_voltage.py doesn't. The logs are read with
+# features/spindle_logging/spindle_log_query.py, so they can be the spindle log store, the csv files or both.
+#
+# Each measured speed is paired with the commanded speed in effect when it was logged, and samples taken
+# within --settle seconds of a speed change, or while the spindle was commanded off, are dropped. The
+# voltage the DAC was set to for each commanded speed is worked out from the current PocketNC.ini, so
+# the logs should only cover the time since the calibration last changed (see --since).
+#
+# Samples are grouped by DAC code and the median measured RPM of each code is taken. A monotone curve
+# is fitted to those medians with the pool adjacent violators algorithm, weighting each code by its
+# number of samples, then reduced to at most --points points.
+#
+# Usage: ./spindle_calibration.py [--logs DIR] [--since TIME] [--settle S] [--min-samples N] [--points N]
+#                                 [--overlay FILE] [--dry-run]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+INI_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/PocketNC.ini")
+CALIBRATION_OVERLAY_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/CalibrationOverlay.inc")
+SETTINGS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
+sys.path.insert(0, os.path.join(SETTINGS_DIR, "features/spindle_logging"))
+
+from ini_snapshot import readIniValues
+from spindle_dac import readSpeedToDac, DAC_CODES, DAC_VDD
+from spindle_log_store import LOG_DIR, COMMANDED, MEASURED
+from spindle_log_query import SpindleLogs, commandedAt
+
+DEFAULT_SETTLE = 3.0
+DEFAULT_MIN_SAMPLES = 3
+DEFAULT_POINTS = 16
+
+# Returns (codes, medians, counts), the median measured RPM for each DAC code with at least min_samples samples
+def medianByCode(codes, measured, min_samples):
+  order = np.lexsort((measured, codes))
+  codes = codes[order]
+  measured = measured[order]
+  (unique, starts, counts) = np.unique(codes, return_index=True, return_counts=True)
+  lower = measured[starts + (counts - 1) // 2]
+  upper = measured[starts + counts // 2]
+  keep = counts >= min_samples
+  return (unique[keep], ((lower + upper) / 2.0)[keep], counts[keep])
+
+# Pool adjacent violators. Returns the non-decreasing fit of values, in the given order, that minimizes
+# the weighted squared error.
+def isotonic(values, weights):
+  blocks = []
+  for (value, weight) in zip(values, weights):
+    blocks.append([ float(value), float(weight), 1 ])
+    while len(blocks) > 1 and blocks[-2][0] >= blocks[-1][0]:
+      (v2, w2, n2) = blocks.pop()
+      (v1, w1, n1) = blocks.pop()
+      blocks.append([ (v1 * w1 + v2 * w2) / (w1 + w2), w1 + w2, n1 + n2 ])
+  return np.concatenate([ np.repeat(value, n) for (value, weight, n) in blocks ])
+
+# Returns the curve as (rpms, voltages), with strictly increasing rpms, through at most points points
+def fitCurve(voltages, medians, counts, points):
+  rpms = isotonic(medians, counts)
+
+  # each run of equal rpms, which the fit makes of violators, becomes a single point at its mean voltage
+  (rpms, inverse) = np.unique(rpms, return_inverse=True)
+  voltages = np.bincount(inverse, weights=voltages * counts) / np.bincount(inverse, weights=counts)
+
+  if len(rpms) > points:
+    knots = np.linspace(voltages[0], voltages[-1], points)
+    rpms = np.interp(knots, voltages, rpms)
+    voltages = knots
+  return (rpms, voltages)
+
+# The median rather than the mean, so a few bad samples, like a spindle that was stalled, don't dominate it
+def medianErrorPercent(predicted, measured):
+  return 100 * np.median(np.abs(predicted - measured) / measured)
+
+def writeCurve(overlay_path, rpms, voltages):
+  from ini import read_ini_data, write_ini_data, set_parameter
+  if os.path.isfile(overlay_path):
+    overlay = read_ini_data(overlay_path)
+  else:
+    overlay = { 'parameters': [], 'sections': {} }
+
+  if "POCKETNC" not in overlay['sections']:
+    overlay['sections']["POCKETNC"] = { 'comment': '', 'help': '' }
+  set_parameter(overlay, "POCKETNC", "SPINDLE_CALIBRATION_RPM", " ".join([ "%.1f" % rpm for rpm in rpms ]))
+  set_parameter(overlay, "POCKETNC", "SPINDLE_CALIBRATION_VOLTAGE", " ".join([ "%.4f" % voltage for voltage in voltages ]))
+  write_ini_data(overlay, overlay_path)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Fit the spindle calibration curve from the spindle logs")
+  parser.add_argument("--logs", default=LOG_DIR, help="directory of the spindle logs")
+  parser.add_argument("--since", type=float, default=0, help="only use samples logged after this unix time")
+  parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE, help="seconds after a speed change before samples are used")
+  parser.add_argument("--min-samples", type=int, default=DEFAULT_MIN_SAMPLES, help="samples needed for a DAC code to be used")
+  parser.add_argument("--points", type=int, default=DEFAULT_POINTS, help="maximum number of points in the curve")
+  parser.add_argument("--overlay", default=CALIBRATION_OVERLAY_FILE, help="calibration overlay to write the curve to")
+  parser.add_argument("--dry-run", action="store_true", help="print the curve without writing it")
+  args = parser.parse_args()
+
+  start = time.time()
+  logs = SpindleLogs(args.logs)
+  (commandedTimes, commandedValues) = logs.read(COMMANDED, args.since)
+  (times, measured) = logs.read(MEASURED, args.since)
+  (commanded, age, index) = commandedAt(commandedTimes, commandedValues, times)
+
+  used = (age >= args.settle) & (commanded > 0) & (measured > 0)
+  print "Read %d commanded and %d measured samples in %.2fs, %d measured samples are settled" % (len(commandedTimes), len(times), time.time() - start, used.sum())
+
+  speedToDac = readSpeedToDac(readIniValues(INI_FILE))
+  commanded = commanded[used]
+  measured = measured[used]
+
+  # the voltage for each distinct commanded speed, rather than each sample
+  (speeds, inverse) = np.unique(commanded, return_inverse=True)
+  codes = np.array([ speedToDac.dacCode(speedToDac.voltage(speed)) for speed in speeds ], dtype=int)[inverse]
+
+  (fitCodes, medians, counts) = medianByCode(codes, measured, args.min_samples)
+  if len(fitCodes) < 2:
+    sys.stderr.write("Need settled samples at 2 or more speeds with at least %d samples each, found %d\n" % (args.min_samples, len(fitCodes)))
+    sys.exit(1)
+
+  (rpms, voltages) = fitCurve(fitCodes * DAC_VDD / (DAC_CODES - 1), medians, counts, args.points)
+  if len(rpms) < 2:
+    sys.stderr.write("Measured speeds don't increase with voltage, not fitting a curve\n")
+    sys.exit(1)
+
+  sampleVoltages = codes * DAC_VDD / (DAC_CODES - 1)
+  current = np.array([ speedToDac.rpm(voltage) for voltage in sampleVoltages ])
+  print "Median error of the current calibration: %.2f%%" % medianErrorPercent(current, measured)
+  print "Median error of the fitted curve:        %.2f%%" % medianErrorPercent(np.interp(sampleVoltages, voltages, rpms), measured)
+  print
+  print "%10s %10s" % ("rpm", "voltage")
+  for (rpm, voltage) in zip(rpms, voltages):
+    print "%10.1f %10.4f" % (rpm, voltage)
+
+  if not args.dry_run:
+    writeCurve(args.overlay, rpms, voltages)
+    print
+    print "Wrote the curve to %s, it's used once PocketNC.ini is regenerated on the next start" % args.overlay
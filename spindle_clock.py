@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# spindle_clock.py
+# Measures spindle speed from the time of each spindle clock edge, rather than by counting pulses each second.
+#
+# Edge times are recorded in a preallocated ring buffer, an EdgeRing. On the machine, they come from a
+# SysfsEdgeWatcher thread, which waits in epoll on the GPIO's sysfs value file. Each edge costs a single
+# wake up and read, with no Adafruit_BBIO callback dispatch. If the pin has no sysfs GPIO, for example
+# in the simulation, Adafruit_BBIO's event callbacks are used instead.
+#
+# An RpmEstimator turns the edges in the last window seconds into an RPM. It always uses at least
+# MIN_EDGES edges, so the estimate doesn't quantize at low speeds. It also reports:
+#   confidence  1 for evenly spaced edges, falling towards 0 with fewer edges or more jitter
+#   stale       no edge for stale_timeout seconds, the spindle has stopped or the clock isn't connected
+# A spindle slowing down is seen without waiting for its next edge, because the RPM is capped at what
+# the time since the last edge allows.
+
+import array
+import math
+import os
+import select
+import sys
+import threading
+import time
+
+from bb_pins import gpioPath
+
+DEFAULT_RING_SIZE = 2048
+DEFAULT_WINDOW = 0.25
+DEFAULT_STALE_TIMEOUT = 1.0
+MIN_EDGES = 3
+# The spindle is taken to be slowing once there's been no edge for this many mean periods, which
+# leaves room for edge timing jitter
+SLOWING_PERIODS = 1.5
+# Number of periods needed for full confidence
+CONFIDENT_PERIODS = 8
+
+# Edge times are pushed by a single thread. Without a lock, readers treat the oldest slot as being
+# overwritten and never read it.
+class EdgeRing(object):
+  def __init__(self, size=DEFAULT_RING_SIZE):
+    self.size = size
+    self.times = array.array('d', [ 0.0 ]) * size
+    self.count = 0
+
+  def push(self, t):
+    self.times[self.count % self.size] = t
+    self.count += 1
+
+  # Returns the time of the edge with the given index, counting every edge ever pushed
+  def time(self, index):
+    return self.times[index % self.size]
+
+  # Returns (first, end), the range of indices of the edges that can be read
+  def readable(self):
+    end = self.count
+    return (max(0, end - self.size + 1), end)
+
+  # Returns the index of the first edge at or after t, between first and end
+  def firstSince(self, t, first, end):
+    while first < end:
+      middle = (first + end) // 2
+      if self.time(middle) < t:
+        first = middle + 1
+      else:
+        end = middle
+    return first
+
+class RpmEstimator(object):
+  def __init__(self, ring, pulses_per_revolution, window=DEFAULT_WINDOW, stale_timeout=DEFAULT_STALE_TIMEOUT):
+    self.ring = ring
+    self.pulses_per_revolution = float(pulses_per_revolution)
+    self.window = window
+    self.stale_timeout = stale_timeout
+
+  # Returns (rpm, confidence, stale) as of now
+  def measure(self, now=None):
+    if now is None:
+      now = time.time()
+
+    ring = self.ring
+    (oldest, end) = ring.readable()
+    if end == oldest or now - ring.time(end - 1) > self.stale_timeout:
+      return (0.0, 0.0, True)
+
+    # the edges in the window, but at least MIN_EDGES of them from within the stale timeout
+    first = ring.firstSince(now - self.window, oldest, end)
+    first = max(min(first, end - MIN_EDGES), ring.firstSince(now - self.stale_timeout, oldest, end))
+    periods = end - 1 - first
+    if periods < 1:
+      return (0.0, 0.0, False)
+
+    last = ring.time(end - 1)
+    mean = (last - ring.time(first)) / periods
+    if mean <= 0:
+      return (0.0, 0.0, False)
+
+    # no edge for longer than expected means the spindle is slowing, it's at most this fast
+    period = max(mean, (now - last) / SLOWING_PERIODS)
+    rpm = 60.0 / (period * self.pulses_per_revolution)
+
+    # jitter is judged on the most recent periods only, so it costs the same at any speed
+    recent = [ ring.time(i + 1) - ring.time(i) for i in range(max(first, end - 1 - CONFIDENT_PERIODS), end - 1) ]
+    deviation = math.sqrt(sum([ (p - mean) ** 2 for p in recent ]) / len(recent))
+    confidence = max(0.0, 1.0 - deviation / mean) * min(1.0, periods / float(CONFIDENT_PERIODS))
+    return (rpm, confidence, False)
+
+# Records the time of each rising edge of a sysfs GPIO, waiting for them in epoll
+class SysfsEdgeWatcher(threading.Thread):
+  def __init__(self, gpio_path, ring):
+    threading.Thread.__init__(self, name="spindle clock")
+    self.daemon = True
+    self.ring = ring
+
+    with open(os.path.join(gpio_path, "edge"), 'w') as f:
+      f.write("rising")
+
+    self.fd = os.open(os.path.join(gpio_path, "value"), os.O_RDONLY | os.O_NONBLOCK)
+    self.epoll = select.epoll()
+    self.epoll.register(self.fd, select.EPOLLPRI | select.EPOLLERR)
+
+    # clear the pending event sysfs reports when the value file is opened
+    os.read(self.fd, 8)
+
+  def run(self):
+    while True:
+      for (fd, event) in self.epoll.poll():
+        t = time.time()
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.read(self.fd, 8)
+        self.ring.push(t)
+
+# Starts recording the spindle clock's edges in ring. pin is an Adafruit_BBIO pin name, already set up
+# as an input. Returns "sysfs" or "callback", depending on which was used.
+def startEdgeSource(pin, ring, GPIO):
+  path = gpioPath(pin)
+  if path and os.path.isfile(os.path.join(path, "edge")):
+    try:
+      SysfsEdgeWatcher(path, ring).start()
+      return "sysfs"
+    except (IOError, OSError) as e:
+      sys.stderr.write("Error watching %s for spindle clock edges, falling back to callbacks: %s\n" % (path, e))
+
+  GPIO.add_event_detect(pin, GPIO.RISING, lambda channel: ring.push(time.time()))
+  return "callback"
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# spindle_dac.py
+# Sets the spindle DAC, an MCP4725, from spindle_voltage's speed_in pin as soon as it changes.
+#
+# HAL pins can't be waited on, so a watcher thread reads speed_in every POLL_PERIOD seconds and hands
+# changes to a writer thread. When the writer is handed a change, it waits until MIN_WRITE_INTERVAL after
+# the change was seen before writing the latest commanded speed, so a burst of changes that arrives within
+# that window, like a program sending S words in quick succession, is coalesced into one bus transaction.
+# Writes are also at least MIN_WRITE_INTERVAL apart. The writes for all 4096 DAC codes are built ahead of
+# time, so an update is a table lookup and a write.
+#
+# POLL_PERIOD is a few milliseconds rather than less, since the watcher runs for as long as the machine
+# is up on a single core.
+#
+# The RPM to voltage map is linear between SPINDLE_LOW_RPM/VOLTAGE and SPINDLE_HIGH_RPM/VOLTAGE, unless
+# PocketNC.ini has a calibration curve fitted by spindle_calibration.py:
+#   SPINDLE_CALIBRATION_RPM      space separated, increasing RPMs
+#   SPINDLE_CALIBRATION_VOLTAGE  the voltage at each of them
+# Either way, the map is turned into a table of DAC codes for TABLE_SIZE evenly spaced RPMs when
+# spindle_voltage starts, so each change of speed_in is converted with a single index.
+#
+# The time from a change being seen to the DAC write finishing, which includes the MIN_WRITE_INTERVAL
+# window, is published on dac_latency and the largest since startup on dac_latency_max. A change can
+# take up to POLL_PERIOD longer to be seen.
+#
+# A failed write is retried with the interval between attempts doubling up to MAX_RETRY_INTERVAL, so a
+# dead DAC doesn't hog the bus the pressure sensor shares. Only the first failure is reported, and then
+# the recovery once a write succeeds.
+
+import array
+import sys
+import threading
+import time
+
+from ini_snapshot import getValue
+
+# MCP4725 fast mode write of the DAC register, the 12 bit code follows as D11-D4 then D3-D0
+DAC_WRITE = 0x40
+DAC_CODES = 4096
+DAC_VDD = 4.9
+TABLE_SIZE = 4096
+
+POLL_PERIOD = 0.005
+MIN_WRITE_INTERVAL = 0.01
+MAX_RETRY_INTERVAL = 1.0
+
+# Maps commanded RPM to DAC code through a curve of (rpm, voltage) points, by default the line from
+# (loRPM, loVoltage) to (hiRPM, hiVoltage). Between points the voltage is interpolated and past the ends
+# the end segments are extended, then it's clamped to loVoltage-hiVoltage.
+class SpeedToDac(object):
+  def __init__(self, loRPM, hiRPM, loVoltage, hiVoltage, curve=None):
+    self.loVoltage = loVoltage
+    self.hiVoltage = hiVoltage
+    self.curve = curve or [ (loRPM, loVoltage), (hiRPM, hiVoltage) ]
+    self.writes = [ [ code >> 4, (code & 0x0F) << 4 ] for code in range(DAC_CODES) ]
+
+    # the table covers 0 up to where the voltage is clamped at hiVoltage
+    self.tableRPM = max(self.rpm(hiVoltage), 1.0)
+    self.scale = (TABLE_SIZE - 1) / self.tableRPM
+    self.codes = array.array('H', [ self.dacCode(self.voltage(i / self.scale)) for i in range(TABLE_SIZE) ])
+
+  # Returns the index of the curve segment to use for x, where x is the rpm (column 0) or voltage (column 1)
+  def segment(self, x, column):
+    curve = self.curve
+    i = 1
+    while i < len(curve) - 1 and curve[i][column] < x:
+      i += 1
+    return (curve[i - 1], curve[i])
+
+  def voltage(self, rpm):
+    ((r0, v0), (r1, v1)) = self.segment(rpm, 0)
+    voltage = v0 + (v1 - v0) * (rpm - r0) / (r1 - r0)
+    return max(min(voltage, self.hiVoltage), self.loVoltage)
+
+  # The inverse of voltage, without clamping
+  def rpm(self, voltage):
+    ((r0, v0), (r1, v1)) = self.segment(voltage, 1)
+    if v1 == v0:
+      return r1
+    return r0 + (r1 - r0) * (voltage - v0) / (v1 - v0)
+
+  def dacCode(self, voltage):
+    return min(max(int(voltage / DAC_VDD * (DAC_CODES - 1)), 0), DAC_CODES - 1)
+
+  def code(self, rpm):
+    return self.codes[min(max(int(rpm * self.scale + 0.5), 0), TABLE_SIZE - 1)]
+
+  # Returns the bytes written after DAC_WRITE to set code
+  def write(self, code):
+    return self.writes[code]
+
+# Returns the calibration curve in PocketNC.ini's values, as a list of (rpm, voltage), or None if there
+# isn't a valid one
+def readCurve(iniValues):
+  rpms = str(getValue(iniValues, "POCKETNC", "SPINDLE_CALIBRATION_RPM", "")).split()
+  voltages = str(getValue(iniValues, "POCKETNC", "SPINDLE_CALIBRATION_VOLTAGE", "")).split()
+  if not rpms and not voltages:
+    return None
+
+  try:
+    curve = [ (float(rpm), float(voltage)) for (rpm, voltage) in zip(rpms, voltages) ]
+  except ValueError:
+    curve = []
+  if len(curve) < 2 or len(rpms) != len(voltages) or \
+     any([ r1 <= r0 or v1 < v0 for ((r0, v0), (r1, v1)) in zip(curve, curve[1:]) ]):
+    sys.stderr.write("Ignoring invalid spindle calibration curve, SPINDLE_CALIBRATION_RPM=%s SPINDLE_CALIBRATION_VOLTAGE=%s\n" % (" ".join(rpms), " ".join(voltages)))
+    return None
+  return curve
+
+# Returns the SpeedToDac configured by PocketNC.ini's values
+def readSpeedToDac(iniValues):
+  loVoltage = float(getValue(iniValues, "POCKETNC", "SPINDLE_LOW_VOLTAGE", .24))
+  loRPM = float(getValue(iniValues, "POCKETNC", "SPINDLE_LOW_RPM", 764.15))
+
+  hiVoltage = float(getValue(iniValues, "POCKETNC", "SPINDLE_HIGH_VOLTAGE", 2.49))
+  hiRPM = float(getValue(iniValues, "POCKETNC", "SPINDLE_HIGH_RPM", 10000.0))
+
+  return SpeedToDac(loRPM, hiRPM, loVoltage, hiVoltage, readCurve(iniValues))
+
+class DacUpdater(object):
+  def __init__(self, h, i2c, speedToDac, poll_period=POLL_PERIOD, min_write_interval=MIN_WRITE_INTERVAL):
+    self.h = h
+    self.i2c = i2c
+    self.speedToDac = speedToDac
+    self.poll_period = poll_period
+    self.min_write_interval = min_write_interval
+    self.condition = threading.Condition()
+    self.target = None
+    self.written = None
+    self.changed = None
+
+  def start(self):
+    for (name, target) in [ ("dac watcher", self.watch), ("dac writer", self.writeChanges) ]:
+      t = threading.Thread(target=target, name=name)
+      t.daemon = True
+      t.start()
+
+  def watch(self):
+    # like the DAC's power on value, nothing is written until speed_in first changes from 0
+    rpm = 0
+    while True:
+      speed_in = self.h['speed_in']
+      if speed_in != rpm:
+        rpm = speed_in
+        code = self.speedToDac.code(rpm)
+        with self.condition:
+          if code != self.target:
+            self.target = code
+            if self.changed is None:
+              self.changed = time.time()
+            self.condition.notify()
+      time.sleep(self.poll_period)
+
+  def writeChanges(self):
+    interval = self.min_write_interval
+    failures = 0
+    while True:
+      with self.condition:
+        while self.target is None or self.target == self.written:
+          self.condition.wait()
+        changed = self.changed
+
+      # let the rest of a burst of changes arrive before writing
+      time.sleep(max(0, changed + self.min_write_interval - time.time()))
+
+      with self.condition:
+        code = self.target
+        self.changed = None
+
+      start = time.time()
+      try:
+        self.i2c.writeList(DAC_WRITE, self.speedToDac.write(code))
+        self.written = code
+        latency = time.time() - changed
+        self.h['dac_latency'] = latency
+        self.h['dac_latency_max'] = max(self.h['dac_latency_max'], latency)
+        if failures:
+          sys.stderr.write("Spindle DAC set after %d failed writes\n" % failures)
+        interval = self.min_write_interval
+        failures = 0
+      except IOError as e:
+        if not failures:
+          sys.stderr.write("Error setting spindle DAC, retrying quietly until it works: %s\n" % e)
+        interval = min(interval * 2, MAX_RETRY_INTERVAL)
+        failures += 1
+        with self.condition:
+          if self.changed is None:
+            self.changed = changed
+
+      time.sleep(max(0, interval - (time.time() - start)))
@@ -1,94 +1,66 @@
 #!/usr/bin/python
 
+# spindle_voltage.py
+# Sets the spindle DAC from the commanded spindle speed, speed_in, within about 20 milliseconds of it
+# changing (see spindle_dac.py), and measures the spindle's speed from its clock pin (see spindle_clock.py).
+# The measurement is published SPINDLE_MEASUREMENT_RATE times a second on these pins:
+#   speed_measured             RPM over the last SPINDLE_MEASUREMENT_WINDOW seconds
+#   speed_measured_confidence  1 for a steady clock, falling towards 0 with few or uneven edges
+#   speed_measured_stale       set when there hasn't been a clock edge for a second
+
 import os
 import sys
 import datetime
 
-POCKETNC_DIRECTORY = "/home/pocketnc/pocketnc"
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
 INI_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/PocketNC.ini")
 
-sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
-from ini import read_ini_data, get_parameter
+from ini_snapshot import readIniValues, getValue
+from i2c_bus import Device
+from spindle_clock import EdgeRing, RpmEstimator, startEdgeSource, DEFAULT_WINDOW
+from spindle_dac import readSpeedToDac, DacUpdater
 
 import Adafruit_BBIO.GPIO as GPIO
 
-try:
-  from Adafruit_GPIO.I2C import Device
-  i2c = Device(0x60, 2)
-except:
-  from Adafruit_I2C import Adafruit_I2C
-  i2c = Adafruit_I2C(0x60)
+i2c = Device(0x60)
 
 import hal
 import time
 
-iniData = read_ini_data(INI_FILE)
-spindleClockPinParam = get_parameter(iniData,"POCKETNC_PINS", "SPINDLE_CLOCK_PIN")
+iniValues = readIniValues(INI_FILE)
+spindleClockPin = getValue(iniValues, "POCKETNC_PINS", "SPINDLE_CLOCK_PIN")
 
-resetTime = time.time()
-pulses = 0
-def countPulses(x):
-  global pulses
-  pulses += 1
+pulsesPerRevolution = float(getValue(iniValues, "POCKETNC", "SPINDLE_PULSES_PER_REVOLUTION", 4))
+measurementPeriod = 1.0 / float(getValue(iniValues, "POCKETNC", "SPINDLE_MEASUREMENT_RATE", 20))
+measurementWindow = float(getValue(iniValues, "POCKETNC", "SPINDLE_MEASUREMENT_WINDOW", DEFAULT_WINDOW))
 
-def resetPulses():
-  global resetTime
-  global pulses
-  resetTime = time.time()
-  pulses = 0
+edges = EdgeRing()
+estimator = RpmEstimator(edges, pulsesPerRevolution, measurementWindow)
 
-if spindleClockPinParam:
-  GPIO.setup(spindleClockPinParam["values"]["value"], GPIO.IN)
-  GPIO.add_event_detect(spindleClockPinParam["values"]["value"], GPIO.RISING, countPulses)
+if spindleClockPin:
+  GPIO.setup(spindleClockPin, GPIO.IN)
+  startEdgeSource(spindleClockPin, edges, GPIO)
 
 h = hal.component("spindle_voltage")
 h.newpin("speed_in", hal.HAL_FLOAT, hal.HAL_IN)
 h.newpin("speed_measured", hal.HAL_FLOAT, hal.HAL_OUT)
+h.newpin("speed_measured_confidence", hal.HAL_FLOAT, hal.HAL_OUT)
+h.newpin("speed_measured_stale", hal.HAL_BIT, hal.HAL_OUT)
+# seconds from a change of speed_in being seen to the DAC being set, the last time and at most
+h.newpin("dac_latency", hal.HAL_FLOAT, hal.HAL_OUT)
+h.newpin("dac_latency_max", hal.HAL_FLOAT, hal.HAL_OUT)
 h.ready()
 
-loVoltageParam = get_parameter(iniData, "POCKETNC", "SPINDLE_LOW_VOLTAGE")
-loRPMParam = get_parameter(iniData, "POCKETNC", "SPINDLE_LOW_RPM")
-
-hiVoltageParam = get_parameter(iniData, "POCKETNC", "SPINDLE_HIGH_VOLTAGE")
-hiRPMParam = get_parameter(iniData, "POCKETNC", "SPINDLE_HIGH_RPM")
-
-pulsesPerRevolutionParam = get_parameter(iniData, "POCKETNC", "SPINDLE_PULSES_PER_REVOLUTION")
-pulsesPerRevolution = float(pulsesPerRevolutionParam["values"]["value"]) if pulsesPerRevolutionParam else 4
-
-loVoltage = float(loVoltageParam["values"]["value"]) if loVoltageParam else .24
-loRPM = float(loRPMParam["values"]["value"]) if loRPMParam else 764.15
-
-hiVoltage = float(hiVoltageParam["values"]["value"]) if hiVoltageParam else 2.49
-hiRPM = float(hiRPMParam["values"]["value"]) if hiRPMParam else 10000.0
-
-lastRPM = 0
-lastSpindleOn = False
+DacUpdater(h, i2c, readSpeedToDac(iniValues)).start()
 
 try:
   while True:
-    if h['speed_in'] != lastRPM:
-      currentRPM = h['speed_in']
-      t = (currentRPM-loRPM)/(hiRPM-loRPM)
-      currentVoltage = max(min(loVoltage+(hiVoltage-loVoltage)*t, hiVoltage), loVoltage)
-      currentDAC = int(currentVoltage/4.9*4095)
-
-      i = min(max(currentDAC, 0), 4095)
-
-      lo = i & 15 << 4
-      hi = i >> 4
-
-      combined = (lo << 8) | hi
-
-      i2c.write16(64, combined)
-      lastRPM = currentRPM
-    time.sleep(.1)
+    time.sleep(measurementPeriod)
 
-    now = time.time()
-    duration = now-resetTime
-    if duration > 1:
-        rpmMeasured = pulses/pulsesPerRevolution/duration*60
-        resetPulses()
-        h['speed_measured'] = rpmMeasured
+    (rpmMeasured, confidence, stale) = estimator.measure()
+    h['speed_measured'] = rpmMeasured
+    h['speed_measured_confidence'] = confidence
+    h['speed_measured_stale'] = stale
 
 except KeyboardInterrupt:
   raise SystemExit
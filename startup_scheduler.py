@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# startup_scheduler.py
+# Runs the startup scripts of the active features in parallel. Startup scripts are independent unless
+# a feature lists the features whose startup scripts must finish before its own starts in a startup.after
+# file in its feature directory, one feature name per line. Lines starting with # are ignored, as are
+# features that aren't active or don't have a startup script. Total startup time is then bounded by the
+# longest chain of dependent startup scripts rather than the sum of all of them.
+#
+# If a startup script fails, the startup scripts that depend on it aren't run, the others are allowed
+# to finish and then the failure is raised as a subprocess.CalledProcessError, like
+# subprocess.check_output does.
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_STARTUP_WORKERS = 4
+
+# Returns the names of the features listed in a feature's startup.after file
+def readStartupAfter(features_dir, feature):
+  after = set()
+  try:
+    with open(os.path.join(features_dir, feature, "startup.after"), 'r') as f:
+      for line in f:
+        line = line.strip()
+        if line and not line.startswith("#"):
+          after.add(line)
+  except IOError:
+    pass
+  return after
+
+# Raises a ValueError if the dependencies form a cycle, since none of the features in it could ever start
+def checkForCycles(dependencies):
+  visited = set()
+  visiting = []
+
+  def visit(feature):
+    if feature in visiting:
+      raise ValueError("startup.after dependencies form a cycle: %s" % " -> ".join(visiting[visiting.index(feature):] + [ feature ]))
+    if feature in visited:
+      return
+    visiting.append(feature)
+    for dependency in sorted(dependencies[feature]):
+      visit(dependency)
+    visiting.pop()
+    visited.add(feature)
+
+  for feature in sorted(dependencies):
+    visit(feature)
+
+# startups is a dict mapping feature name to the path of its startup script. Runs the startup scripts on
+# at most workers threads, respecting the startup.after files in features_dir. If timer, a
+# startup_timing.PhaseTimer, is provided, the time each startup script takes is recorded. If env
+# is provided, it's used as the environment of the startup scripts.
+def runStartupScripts(features_dir, startups, workers=DEFAULT_STARTUP_WORKERS, timer=None, env=None):
+  dependencies = dict([ (feature, readStartupAfter(features_dir, feature) & set(startups)) for feature in startups ])
+  checkForCycles(dependencies)
+
+  pending = set(startups)
+  running = set()
+  done = set()
+  failed = {}
+  condition = threading.Condition()
+
+  def run(feature):
+    start = time.time()
+    error = None
+    try:
+      subprocess.check_output(startups[feature], env=env)
+    except Exception as e:
+      error = e
+
+    if timer:
+      timer.record("startup %s" % feature, start, time.time() - start)
+
+    with condition:
+      running.remove(feature)
+      if error is None:
+        done.add(feature)
+      else:
+        sys.stderr.write("Error running startup for feature, %s: %s\n" % (feature, error))
+        failed[feature] = error
+      condition.notify_all()
+
+  with condition:
+    while pending or running:
+      for feature in sorted(pending):
+        if dependencies[feature] & set(failed):
+          sys.stderr.write("Not running startup for feature, %s, because a feature it depends on failed\n" % feature)
+          pending.remove(feature)
+          failed[feature] = None
+
+      ready = sorted([ feature for feature in pending if dependencies[feature] <= done ])
+      for feature in ready[:max(1, workers) - len(running)]:
+        pending.remove(feature)
+        running.add(feature)
+        t = threading.Thread(target=run, args=(feature,))
+        t.daemon = True
+        t.start()
+
+      if running:
+        condition.wait()
+
+  errors = [ failed[feature] for feature in sorted(failed) if failed[feature] is not None ]
+  if errors:
+    raise errors[0]
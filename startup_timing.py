@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# startup_timing.py
+# Records how long each phase of generateINI.py takes (detecting each feature, running each feature's
+# startup script, reading each INI file, merging and writing) so we can see where LinuxCNC startup
+# time goes. The timings of the last few boots are kept in a json file, so a regression after a
+# software update can be spotted by comparing boots.
+#
+# Run as a script to print a summary of the recorded boots:
+#   ./startup_timing.py [timing file]
+
+import datetime
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+TIMING_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/startup_timing.json")
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+DEFAULT_HISTORY = 10 # number of boots kept in the timing file
+
+def readBootId():
+  try:
+    with open(BOOT_ID_FILE, 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+class PhaseTimer(object):
+  def __init__(self):
+    self.started = time.time()
+    self.phases = []
+
+  # Records a phase that has already been timed. Safe to call from multiple threads.
+  def record(self, name, start, seconds):
+    self.phases.append({ 'name': name, 'start': start - self.started, 'seconds': seconds })
+
+  # Times the body of a with statement as a phase, for example:
+  #   with timer.phase("merge"):
+  #     merged = mergeLayers(defaults, layers)
+  @contextmanager
+  def phase(self, name):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, start, time.time() - start)
+
+  def report(self):
+    return {
+      'time': datetime.datetime.utcfromtimestamp(self.started).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+      'boot_id': readBootId(),
+      'total': time.time() - self.started,
+      'phases': sorted(self.phases, key=lambda p: p['start'])
+    }
+
+  # Adds this run's report to timing_file, keeping only the most recent history reports
+  def writeReport(self, timing_file, history=DEFAULT_HISTORY):
+    reports = readReports(timing_file)
+    reports.append(self.report())
+    reports = reports[-max(1, history):]
+
+    tmp_file = "%s.tmp" % timing_file
+    try:
+      with open(tmp_file, 'w') as f:
+        json.dump({ 'boots': reports }, f, indent=2, sort_keys=True)
+      os.rename(tmp_file, timing_file)
+    except (IOError, OSError) as e:
+      sys.stderr.write("Error writing startup timing, %s: %s\n" % (timing_file, e))
+
+def readReports(timing_file):
+  try:
+    with open(timing_file, 'r') as f:
+      return json.load(f).get('boots', [])
+  except (IOError, ValueError, AttributeError):
+    return []
+
+def formatReport(report):
+  lines = [ "%s  total %.3fs" % (report['time'], report['total']) ]
+  for p in report['phases']:
+    lines.append("  %8.3fs  +%.3fs  %s" % (p['seconds'], p['start'], p['name']))
+  return "\n".join(lines)
+
+if __name__ == "__main__":
+  timing_file = sys.argv[1] if len(sys.argv) > 1 else TIMING_FILE
+  reports = readReports(timing_file)
+
+  if not reports:
+    print "No startup timing recorded in %s" % timing_file
+    sys.exit(1)
+
+  for report in reports:
+    print formatReport(report)
+    print
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# verify_ini_merge.py
+# Golden output check for ini_merge.py. For every machine version in versions/, generates the INI with the
+# merge_ini_data/append_ini_data pipeline that generateINI.py used before ini_merge.mergeLayers existed
+# and with mergeLayers, for no features and for every feature enabled, and checks that both write
+# byte for byte identical files. Exits with a non-zero status if any of them differ.
+#
+# Without a calibration overlay, the output of mergeLayers is also compared against the golden output
+# checked in to ini_merge_golden/<version>-<feature set>.txt, so a change in what's generated is noticed
+# even if the legacy pipeline changes with it. A golden output lists every section, then every parameter in
+# order, as [SECTION] NAME=VALUE, so it doesn't depend on how Rockhopper writes comments and help text.
+# --update writes the golden outputs instead of comparing against them.
+#
+# Usage: ./verify_ini_merge.py [--update] [CalibrationOverlay.inc]
+
+import argparse
+import os
+import sys
+import tempfile
+
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+SETTINGS_DIR = os.path.dirname(os.path.abspath(__file__))
+VERSIONS_DIR = os.path.join(SETTINGS_DIR, "versions")
+FEATURES_DIR = os.path.join(SETTINGS_DIR, "features")
+GOLDEN_DIR = os.path.join(SETTINGS_DIR, "ini_merge_golden")
+
+sys.path.insert(0, os.path.join(POCKETNC_DIRECTORY, "Rockhopper"));
+from ini import read_ini_data, merge_ini_data, write_ini_data, append_ini_data
+from ini_merge import mergeLayers, featureFlagLayer, MERGE, APPEND
+
+EMPTY_INI = { 'parameters': [], 'sections': {} }
+
+# The overlays of configure_cape_universal and load_pocketnc_driver are generated by their
+# startup scripts from a per version overlay, so use that if they haven't been generated.
+def featureOverlayPath(feature, version):
+  path = os.path.join(FEATURES_DIR, feature, "overlay.inc")
+  if not os.path.isfile(path):
+    path = os.path.join(FEATURES_DIR, feature, "versions", version, "overlay.inc")
+  return path
+
+def readFeatureFiles(features, version):
+  files = []
+  for feature in features:
+    overlay_path = featureOverlayPath(feature, version)
+    append_path = os.path.join(FEATURES_DIR, feature, "append.inc")
+
+    overlay = read_ini_data(overlay_path) if os.path.isfile(overlay_path) else None
+    append = read_ini_data(append_path) if os.path.isfile(append_path) else None
+    files.append((feature, overlay, append))
+  return files
+
+# The pipeline generateINI.py used before mergeLayers
+def legacyMerge(defaults, overlay, feature_files):
+  merged = merge_ini_data(defaults, overlay)
+
+  for (feature, feature_overlay, feature_append) in feature_files:
+    if feature_overlay is not None:
+      merged = merge_ini_data(merged, feature_overlay)
+
+    if feature_append is not None:
+      merged = append_ini_data(merged, feature_append)
+
+    merged = merge_ini_data(merged, featureFlagLayer(feature))
+
+  return merge_ini_data(merged, overlay)
+
+def layeredMerge(defaults, overlay, feature_files):
+  layers = [ (MERGE, overlay) ]
+
+  for (feature, feature_overlay, feature_append) in feature_files:
+    if feature_overlay is not None:
+      layers.append((MERGE, feature_overlay))
+
+    if feature_append is not None:
+      layers.append((APPEND, feature_append))
+
+    layers.append((MERGE, featureFlagLayer(feature)))
+
+  layers.append((MERGE, overlay))
+
+  return mergeLayers(defaults, layers)
+
+def writeToString(ini_data):
+  (fd, path) = tempfile.mkstemp(suffix=".ini")
+  os.close(fd)
+  try:
+    write_ini_data(ini_data, path)
+    with open(path, 'r') as f:
+      return f.read()
+  finally:
+    os.remove(path)
+
+# The golden output of ini_data, its sections in sorted order and then its parameters in order
+def goldenText(ini_data):
+  lines = [ "[%s]" % section for section in sorted(ini_data['sections']) ]
+  lines.extend([ "[%s] %s=%s" % (param['values']['section'], param['values']['name'], param['values']['value'])
+                 for param in ini_data['parameters'] ])
+  return "\n".join(lines) + "\n"
+
+def goldenPath(version, description):
+  return os.path.join(GOLDEN_DIR, "%s-%s.txt" % (version, description.replace(" ", "_")))
+
+# Returns True if merged matches its golden output, or writes it as the golden output if update is set
+def checkGolden(merged, version, description, update):
+  path = goldenPath(version, description)
+  actual = goldenText(merged)
+
+  if update:
+    if not os.path.isdir(GOLDEN_DIR):
+      os.makedirs(GOLDEN_DIR)
+    with open(path, 'w') as f:
+      f.write(actual)
+    return True
+
+  try:
+    with open(path, 'r') as f:
+      return f.read() == actual
+  except IOError:
+    return False
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Check ini_merge.mergeLayers against the legacy merge pipeline and the golden outputs")
+  parser.add_argument("--update", action="store_true", help="write the golden outputs instead of comparing against them")
+  parser.add_argument("overlay", nargs="?", help="a CalibrationOverlay.inc to apply, which skips the golden outputs")
+  args = parser.parse_args()
+
+  overlay = read_ini_data(args.overlay) if args.overlay else EMPTY_INI
+
+  all_features = sorted([ feature for feature in os.listdir(FEATURES_DIR) if os.path.isdir(os.path.join(FEATURES_DIR, feature)) ])
+  failed = False
+
+  for version in sorted(os.listdir(VERSIONS_DIR)):
+    defaults = read_ini_data(os.path.join(VERSIONS_DIR, version, "PocketNC.ini"))
+
+    for (description, features) in [ ("no features", []), ("all features", all_features) ]:
+      feature_files = readFeatureFiles(features, version)
+
+      expected = writeToString(legacyMerge(defaults, overlay, feature_files))
+      merged = layeredMerge(defaults, overlay, feature_files)
+      actual = writeToString(merged)
+
+      if expected == actual:
+        print "OK       %s, %s" % (version, description)
+      else:
+        print "MISMATCH %s, %s" % (version, description)
+        failed = True
+
+      if not args.overlay:
+        if checkGolden(merged, version, description, args.update):
+          print "%s %s, %s golden" % ("UPDATED " if args.update else "OK      ", version, description)
+        else:
+          print "MISMATCH %s, %s golden, %s" % (version, description, goldenPath(version, description))
+          failed = True
+
+  sys.exit(1 if failed else 0)
@@ -14,63 +14,78 @@
 # 3) TODO - Eventually we want to use an EEPROM chip to read the version of the machine. We may move toward treating
 #    our boards as capes (in which case a hardware change would be necessary), but we may do our own versioning using
 #    the EEPROM chip at address 0x50, which was installed on v2revR.
+#
+# Probing the I2C bus is slow, so the result is cached in Settings/version_cache along with the kernel's boot id.
+# Every caller during the same boot gets the cached version without importing the I2C libraries. Run with
+# --invalidate to clear the cache, for example after swapping boards, so the next call probes again.
 
 import os
-POCKETNC_DIRECTORY = "/home/pocketnc/pocketnc"
+POCKETNC_DIRECTORY = os.environ.get("POCKETNC_DIRECTORY", "/home/pocketnc/pocketnc")
+VERSION_CACHE_FILE = os.path.join(POCKETNC_DIRECTORY, "Settings/version_cache")
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
 
-def getVersion():
-  version = "v2revP" # default version if we don't find another using the version file or i2c
+def readBootId():
+  try:
+    with open(BOOT_ID_FILE, 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+# Returns the version cached during this boot, or None
+def readVersionCache(bootId):
+  try:
+    with open(VERSION_CACHE_FILE, 'r') as f:
+      (cachedBootId, version) = f.read().split()
+  except (IOError, ValueError):
+    return None
+
+  if bootId is None or cachedBootId != bootId:
+    return None
+  return version
+
+def writeVersionCache(bootId, version):
+  if bootId is None:
+    return
+
+  tmpFile = "%s.tmp" % VERSION_CACHE_FILE
+  try:
+    with open(tmpFile, 'w') as f:
+      f.write("%s %s\n" % (bootId, version))
+    os.rename(tmpFile, VERSION_CACHE_FILE)
+  except (IOError, OSError):
+    pass
+
+def invalidateVersionCache():
+  try:
+    os.remove(VERSION_CACHE_FILE)
+  except OSError:
+    pass
 
+def getVersion():
   try:
     with open(os.path.join(POCKETNC_DIRECTORY, "Settings/version"), 'r') as versionFile:
-      version = versionFile.read().strip();
+      return versionFile.read().strip();
   except:
-    # Adafruit_I2C calls output text to stdout when an error occurs.
-    # We only want to know that there was an error. We don't want the error output
-    # to stdout as this script outputs only the version of this machine.
-    # So, we need to capture stdout when running i2c calls.
-
-    # Capturing class for capturing stdout 
-    # taken from https://stackoverflow.com/questions/16571150/how-to-capture-stdout-output-from-a-python-function-call
-    from cStringIO import StringIO
-    import sys
-
-    class Capturing(list):
-      def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
-        return self
-      def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio    # free up some memory
-        sys.stdout = self._stdout
-
-    try:
-      from Adafruit_GPIO.I2C import Device
-
-      i2c = Device(0x50, 2)
-      try:
-        test = i2c.readU8(0)
-        # TODO put version information on EEPROM chip.
-        version = "v2revR"
-      except:
-        pass
-    except:
-      # Older machines have an old version of Adafruit_I2C.
-      # Adafruit_I2C was replaced by Adafruit_GPIO on newer
-      # machines.
-      from Adafruit_I2C import Adafruit_I2C
-      i2c = Adafruit_I2C(0x50)
-
-      # TODO put version information on EEPROM chip.
-      # An EEPRROM chip is included on the v2revR board at i2c address (0x50)
-      # but we aren't currently using it. For now, just checking if we can
-      # read from it.
-      with Capturing() as output:
-        test = i2c.readU8(0)
-
-      if test != -1:
-        version = "v2revR"
+    pass
+
+  bootId = readBootId()
+  version = readVersionCache(bootId)
+  if version is None:
+    version = probeVersion()
+    writeVersionCache(bootId, version)
+  return version
+
+# Checks the I2C bus for the EEPROM chip that's only on v2revR
+def probeVersion():
+  version = "v2revP" # default version if we don't find another using i2c
+
+  # TODO put version information on EEPROM chip.
+  # An EEPRROM chip is included on the v2revR board at i2c address (0x50)
+  # but we aren't currently using it. For now, just checking if we can
+  # read from it.
+  from i2c_bus import probe
+  if probe(0x50):
+    version = "v2revR"
 
   return version
 
@@ -90,4 +105,8 @@ def clearVersionFile():
   os.remove(os.path.join(POCKETNC_DIRECTORY, "Settings/version"))
 
 if __name__ == "__main__":
-  print getVersion()
+  import sys
+  if "--invalidate" in sys.argv[1:]:
+    invalidateVersionCache()
+  else:
+    print getVersion()